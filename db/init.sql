@@ -14,7 +14,10 @@ CREATE TABLE "deadlines" (
 CREATE TABLE "reminders" (
   "id" SERIAL PRIMARY KEY,
   "deadline_id" integer,
-  "reminder_time" timestamp
+  "reminder_time" timestamp,
+  "sent_at" timestamp,
+  "leased_by" varchar,
+  "leased_until" timestamp
 );
 
 CREATE TABLE "messages" (
@@ -0,0 +1,12 @@
+-- every message looks up the user by chat id
+CREATE INDEX IF NOT EXISTS "users_chat_id_idx" ON "users" ("chat_id");
+
+-- due reminders are found by time, and reminders are listed and cascaded by deadline
+CREATE INDEX IF NOT EXISTS "reminders_reminder_time_idx" ON "reminders" ("reminder_time");
+CREATE INDEX IF NOT EXISTS "reminders_deadline_id_idx" ON "reminders" ("deadline_id");
+
+-- conversation history is read newest first per user
+CREATE INDEX IF NOT EXISTS "messages_user_id_created_at_idx" ON "messages" ("user_id", "created_at" DESC);
+
+-- deadlines are listed per user within a due date range
+CREATE INDEX IF NOT EXISTS "deadlines_user_id_due_date_idx" ON "deadlines" ("user_id", "due_date");
@@ -0,0 +1,10 @@
+-- reminders are claimed by one instance at a time and marked once delivered
+ALTER TABLE "reminders" ADD COLUMN IF NOT EXISTS "sent_at" timestamp;
+ALTER TABLE "reminders" ADD COLUMN IF NOT EXISTS "leased_by" varchar;
+ALTER TABLE "reminders" ADD COLUMN IF NOT EXISTS "leased_until" timestamp;
+
+-- reminders already past went out before the scheduler kept track of them
+UPDATE "reminders" SET "sent_at" = "reminder_time" WHERE "sent_at" IS NULL AND "reminder_time" <= now();
+
+-- due reminders are leased in time order among the undelivered ones
+CREATE INDEX IF NOT EXISTS "reminders_unsent_reminder_time_idx" ON "reminders" ("reminder_time") WHERE "sent_at" IS NULL;
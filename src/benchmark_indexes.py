@@ -0,0 +1,116 @@
+"""Compares query plans and latencies of the hot path queries before and after the migrations.
+
+Each size builds the schema from init.sql in a scratch schema, fills it with synthetic rows,
+runs every query with EXPLAIN ANALYZE, applies the migrations and runs them again. The scratch
+schema is dropped afterwards, so this is safe to point at a development database.
+
+    python benchmark_indexes.py --sizes 10000 100000 1000000
+"""
+import argparse
+import json
+import statistics
+
+from psycopg2 import sql
+
+from migrations import MIGRATION_DIR, MigrationRunner, connect
+
+INIT_SQL = '../db/init.sql'
+SCHEMA = 'benchmark_indexes'
+# deadlines, reminders and messages get the benchmark size in rows, spread over this many users each
+ROWS_PER_USER = 100
+
+POPULATE = [
+    'INSERT INTO "users" ("username", "chat_id") SELECT \'user\' || i, i FROM generate_series(1, %(users)s) AS i',
+    'INSERT INTO "deadlines" ("user_id", "description", "due_date") '
+    'SELECT 1 + i %% %(users)s, \'deadline \' || i, DATE \'2024-01-01\' + (i %% 730) FROM generate_series(1, %(rows)s) AS i',
+    'INSERT INTO "reminders" ("deadline_id", "reminder_time") '
+    'SELECT i, TIMESTAMP \'2024-01-01 08:00\' + (i %% 1051200) * INTERVAL \'1 minute\' FROM generate_series(1, %(rows)s) AS i',
+    'INSERT INTO "messages" ("user_id", "text", "fromUser", "created_at") '
+    'SELECT 1 + i %% %(users)s, \'message \' || i, i %% 2 = 0, TIMESTAMP \'2024-01-01\' + i * INTERVAL \'1 second\' '
+    'FROM generate_series(1, %(rows)s) AS i',
+]
+
+QUERIES = {
+    'user_by_chat_id': 'SELECT "id" FROM "users" WHERE "chat_id" = %(chat_id)s',
+    'latest_messages': 'SELECT "text", "fromUser" FROM "messages" WHERE "user_id" = %(user_id)s '
+                        'ORDER BY "created_at" DESC LIMIT 10',
+    'deadlines_in_range': 'SELECT "id", "description", "due_date" FROM "deadlines" WHERE "user_id" = %(user_id)s '
+                           'AND ("due_date" >= \'2024-03-01\' AND "due_date" <= \'2024-03-31\') ORDER BY "due_date" ASC',
+    'due_reminders': 'SELECT "users"."chat_id", "deadlines"."id", "deadlines"."description", "deadlines"."due_date" '
+                      'FROM "users" INNER JOIN "deadlines" ON "users"."id" = "deadlines"."user_id" '
+                      'INNER JOIN "reminders" ON "deadlines"."id" = "reminders"."deadline_id" '
+                      'WHERE "reminders"."reminder_time" = TIMESTAMP \'2024-06-01 08:00\'',
+    'reminders_by_deadline_ids': 'SELECT "deadline_id", "reminder_time" FROM "reminders" '
+                                  'WHERE "deadline_id" = ANY(%(deadline_ids)s)',
+}
+
+
+def plan_nodes(plan: dict) -> list[str]:
+    nodes = [plan['Node Type'] + (f' on {plan["Index Name"]}' if 'Index Name' in plan else '')]
+    for child in plan.get('Plans', []):
+        nodes.extend(plan_nodes(child))
+    return nodes
+
+
+def run_queries(cursor, users: int, repeat: int) -> dict:
+    values = {'chat_id': users // 2, 'user_id': users // 2, 'deadline_ids': [1, users, users * 2]}
+    results = {}
+    for name, query in QUERIES.items():
+        timings = []
+        for _ in range(repeat):
+            cursor.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + query, values)
+            explain = cursor.fetchone()[0][0]
+            timings.append(explain['Execution Time'])
+        results[name] = {'ms': statistics.median(timings), 'plan': plan_nodes(explain['Plan'])}
+    return results
+
+
+def benchmark(conn, rows: int, repeat: int) -> dict:
+    users = max(1, rows // ROWS_PER_USER)
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL('DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema}; SET search_path TO {schema}').format(
+            schema=sql.Identifier(SCHEMA)))
+        with open(INIT_SQL) as infile:
+            cursor.execute(infile.read())
+        for statement in POPULATE:
+            cursor.execute(statement, {'users': users, 'rows': rows})
+        cursor.execute('ANALYZE')
+        conn.commit()
+
+        before = run_queries(cursor, users, repeat)
+        conn.commit()
+        MigrationRunner(conn, MIGRATION_DIR).migrate()
+        cursor.execute('ANALYZE')
+        after = run_queries(cursor, users, repeat)
+
+        cursor.execute(sql.SQL('DROP SCHEMA {schema} CASCADE; SET search_path TO DEFAULT').format(
+            schema=sql.Identifier(SCHEMA)))
+        conn.commit()
+
+    return {name: {'before': before[name], 'after': after[name]} for name in QUERIES}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark hot path queries before and after the migrations.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    conn = connect()
+    try:
+        results = {}
+        for rows in args.sizes:
+            results[rows] = benchmark(conn, rows, args.repeat)
+            print(f'\n{rows} rows')
+            for name, result in results[rows].items():
+                print(f'  {name:<28}{result["before"]["ms"]:>10.3f} ms -> {result["after"]["ms"]:>8.3f} ms')
+                for stage in ('before', 'after'):
+                    scans = [node for node in result[stage]['plan'] if 'Scan' in node]
+                    print(f'    {stage:<8}{", ".join(scans)}')
+    finally:
+        conn.close()
+
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
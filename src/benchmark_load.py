@@ -0,0 +1,508 @@
+"""Drives the bot end to end under load, without Telegram or OpenAI.
+
+Synthetic users are created in the configured database with a few deadlines and reminders each,
+then send text, and optionally voice, messages through the real handlers at a fixed concurrency.
+Completions come from an in process OpenAI compatible stub and Bot API calls from a fake that
+records them, both with configurable latency. Reminders of every synthetic user are delivered
+through reminder_callback afterwards. The synthetic users are deleted at the end, so this is safe
+to point at a development database, but it needs one: start the Postgres container with
+docker-compose up -d and point the POSTGRES_* variables at it first, as for the bot itself.
+
+After the mixed run, --stream-requests small talk messages are sent with streamed replies edited
+in every --stream-interval seconds, and their time to the first chunk is reported with the rest.
+
+The bot is configured from the environment as usual. Raise TELEGRAM_GLOBAL_RATE and
+TELEGRAM_CHAT_RATE to measure the bot rather than Telegram's flood limits.
+
+    python benchmark_load.py --requests 2000 --concurrency 50 --llm-latency lognormal:0.6:0.4
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import logging
+import math
+import random
+import re
+import time
+from collections import Counter, defaultdict
+from datetime import date, datetime, timedelta
+from typing import Callable, Optional
+
+import httpx
+import psycopg2
+from openai import AsyncOpenAI
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+from gpt import PROMPT_DIR
+from prompt_registry import PLACEHOLDER_PATTERN, PromptRegistry
+from telebot import Telebot
+
+BENCHMARK_TOKEN = '123456:benchmark'
+# synthetic chats are numbered from here, near the top of the integer chat_id column
+CHAT_ID_BASE = 2_100_000_000
+DEADLINES = ['Orbital Milestone 2', 'CS2030S Lab 3', 'CS2040S Problem Set 4', 'MA1521 Tutorial 5']
+# deadlines are rendered into prompts as id|description|due date lines
+DEADLINE_PATTERN = re.compile(r'^(\d+)\|(.*)\|\d{4}-\d{2}-\d{2}$', re.MULTILINE)
+
+current_timings: contextvars.ContextVar[dict] = contextvars.ContextVar('current_timings')
+
+
+def latency_sampler(spec: str) -> Callable[[], float]:
+    """Parses fixed:SECONDS, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA into a sampler of seconds."""
+    kind, *params = spec.split(':')
+    params = [float(param) for param in params]
+    if kind == 'fixed' and len(params) == 1:
+        return lambda: params[0]
+    if kind == 'uniform' and len(params) == 2:
+        return lambda: random.uniform(*params)
+    if kind == 'lognormal' and len(params) == 2:
+        return lambda: random.lognormvariate(math.log(params[0]), params[1])
+    raise ValueError(f'Unknown latency distribution {spec}')
+
+
+def scenarios(today: date) -> dict[str, dict]:
+    """The message each intent is driven with and the fields the stub extracts from it."""
+    milestone = DEADLINES[0]
+    # the seeded reminder of the milestone, a day before it is due at 8am
+    milestone_reminder = f'{today + timedelta(days=4)} 08:00'
+    return {
+        'create_deadline': {
+            'message': 'Add a deadline for my CS2100 assignment due next Friday',
+            'intention': ('CREATE', 'deadline'),
+            'fields': {'description': 'CS2100 Assignment 2', 'due_date': str(today + timedelta(days=7))}
+        },
+        'read_deadline': {
+            'message': 'What deadlines do I have in the next two weeks?',
+            'intention': ('READ', 'deadline'),
+            'fields': {'start_date': str(today), 'end_date': str(today + timedelta(days=14))}
+        },
+        'update_deadline': {
+            'message': 'Please push my orbital milestone back by three days',
+            'intention': ('UPDATE', 'deadline'),
+            'fields': {'description': milestone, 'new_due_date': str(today + timedelta(days=8))}
+        },
+        'delete_deadline': {
+            'message': 'I am done with orbital milestone 2, remove it',
+            'intention': ('DELETE', 'deadline'),
+            'fields': {'description': milestone}
+        },
+        'create_reminder': {
+            'message': 'Remind me about orbital milestone 2 the day after tomorrow at 9am',
+            'intention': ('CREATE', 'reminder'),
+            'fields': {'description': milestone, 'reminder_time': f'{today + timedelta(days=2)} 09:00'}
+        },
+        'read_reminder': {
+            'message': 'Which reminders have I set?',
+            'intention': ('READ', 'reminder'),
+            'fields': {}
+        },
+        'update_reminder': {
+            'message': 'Move my orbital milestone reminder to the evening before',
+            'intention': ('UPDATE', 'reminder'),
+            'fields': {'description': milestone, 'old_reminder_time': milestone_reminder,
+                       'new_reminder_time': f'{today + timedelta(days=3)} 20:00'}
+        },
+        'delete_reminder': {
+            'message': 'Cancel the reminder for orbital milestone 2',
+            'intention': ('DELETE', 'reminder'),
+            'fields': {'description': milestone, 'reminder_time': milestone_reminder}
+        },
+        'converse': {
+            'message': 'Thanks for the help today!',
+            'intention': ('NONE', None),
+            'fields': {}
+        },
+        # only sent in the streamed run after the mixed one
+        'converse_stream': {
+            'message': 'Any tips for keeping on top of all my deadlines?',
+            'intention': ('NONE', None),
+            'fields': {}
+        }
+    }
+
+
+class StubLLM:
+    """OpenAI compatible chat completions that answer every prompt from the scenario being sent.
+
+    Prompts are told apart by their static text before the first placeholder. Extraction prompts
+    get every field of the scenario, the handlers only read the ones they asked for.
+    """
+
+    def __init__(self, prompts: PromptRegistry, scenarios: dict[str, dict], latency: Callable[[], float]):
+        self.prefixes = sorted(
+            ((PLACEHOLDER_PATTERN.split(template.text)[0], name) for name, template in prompts.templates.items()),
+            key=lambda prefix: -len(prefix[0]))
+        self.scenarios = {scenario['message']: scenario for scenario in scenarios.values()}
+        # anything else, like transcribed voice messages, is small talk
+        self.default = scenarios['converse']
+        self.latency = latency
+        self.calls = Counter()
+
+    def client(self) -> AsyncOpenAI:
+        return AsyncOpenAI(
+            api_key='benchmark',
+            base_url='http://llm.benchmark/v1',
+            max_retries=0,
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(self.handle)))
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        messages = body['messages']
+        name = next((name for prefix, name in self.prefixes if messages[0]['content'].startswith(prefix)), None)
+        self.calls[name] += 1
+        await asyncio.sleep(self.latency())
+        if body.get('stream'):
+            return httpx.Response(200, headers={'content-type': 'text/event-stream'},
+                                  content=self.stream(body['model'], self.complete(name, messages)))
+        return httpx.Response(200, json={
+            'id': 'chatcmpl-benchmark',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body['model'],
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': self.complete(name, messages)}}]
+        })
+
+    async def stream(self, model: str, content: str):
+        """Server sent events of the completion a word at a time, the latency was spent before the first."""
+        for word in re.findall(r'\S+\s*', content):
+            chunk = {'id': 'chatcmpl-benchmark', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                     'model': model, 'choices': [{'index': 0, 'delta': {'content': word}, 'finish_reason': None}]}
+            yield f'data: {json.dumps(chunk)}\n\n'.encode()
+            await asyncio.sleep(0)
+        yield b'data: [DONE]\n\n'
+
+    def complete(self, name: Optional[str], messages: list[dict]) -> str:
+        if name == 'response':
+            return messages[-1]['content']
+        if name == 'conversation':
+            return 'Happy to help, good luck with your deadlines!'
+
+        deadlines = DEADLINE_PATTERN.findall(messages[0]['content'])
+        if name == 'filter_deadlines':
+            description = messages[-1]['content'].lower()
+            return json.dumps({'ids': [int(id) for id, desc in deadlines if description in desc.lower()]})
+
+        user_messages = [message['content'] for message in messages if message['role'] == 'user']
+        scenario = self.scenarios.get(user_messages[-1], self.default)
+        fields = scenario['fields']
+        action, target = scenario['intention']
+        return json.dumps({
+            'action': action,
+            'target': target,
+            'ids': [int(id) for id, desc in deadlines if desc == fields.get('description')],
+            'confirmation': False,
+            'old_deadline_description': fields.get('description'),
+            'deadline_description': fields.get('description'),
+            **fields
+        })
+
+
+class FakeBotApi(BaseRequest):
+    """Bot API stand in that counts every call and answers with just enough for the handlers."""
+
+    def __init__(self, latency: Callable[[], float], voice: Optional[bytes] = None):
+        self.latency = latency
+        self.voice = voice
+        self.calls = Counter()
+        self.message_id = 0
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(
+            self,
+            url: str,
+            method: str,
+            request_data: Optional[RequestData] = None,
+            read_timeout=None,
+            write_timeout=None,
+            connect_timeout=None,
+            pool_timeout=None) -> tuple[int, bytes]:
+        await asyncio.sleep(self.latency())
+        if '/file/' in url:
+            self.calls['download'] += 1
+            return 200, self.voice or b''
+
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] += 1
+        parameters = request_data.parameters if request_data else {}
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        elif endpoint == 'getFile':
+            file_id = parameters['file_id']
+            result = {'file_id': file_id, 'file_unique_id': file_id, 'file_path': f'voice/{file_id}.ogg'}
+        else:
+            self.message_id += 1
+            result = {
+                'message_id': self.message_id,
+                'date': int(time.time()),
+                'chat': {'id': parameters.get('chat_id', 0), 'type': 'private'},
+                'text': parameters.get('text', '')
+            }
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+def timed(stage: str, method):
+    """Wraps an async method to add its duration to the stage of the request being measured."""
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            timings = current_timings.get(None)
+            if timings is not None:
+                timings[stage] += time.perf_counter() - start
+    return wrapper
+
+
+def timed_stream(stage: str, method):
+    """Wraps an async generator method like timed, and records when the request got its first chunk."""
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            async for chunk in method(*args, **kwargs):
+                timings = current_timings.get(None)
+                if timings is not None and 'first_chunk' not in timings:
+                    timings['first_chunk'] = time.perf_counter() - timings['start']
+                yield chunk
+        finally:
+            timings = current_timings.get(None)
+            if timings is not None:
+                timings[stage] += time.perf_counter() - start
+    return wrapper
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest rank percentile of already sorted values."""
+    return values[max(0, min(len(values) - 1, math.ceil(q / 100 * len(values)) - 1))]
+
+
+def summarize(samples: list[dict]) -> dict:
+    latencies = sorted(sample['latency'] for sample in samples)
+    first_chunks = sorted(sample['first_chunk'] for sample in samples if 'first_chunk' in sample)
+    summary = {
+        'count': len(samples),
+        'errors': sum(sample['error'] for sample in samples),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'db_ms': sum(sample['db'] for sample in samples) / len(samples) * 1000,
+        'llm_ms': sum(sample['llm'] for sample in samples) / len(samples) * 1000
+    }
+    if first_chunks:
+        summary['first_chunk_p50_ms'] = percentile(first_chunks, 50) * 1000
+        summary['first_chunk_p95_ms'] = percentile(first_chunks, 95) * 1000
+    return summary
+
+
+class LoadBenchmark:
+    def __init__(
+            self,
+            users: int,
+            llm_latency: str,
+            bot_latency: str,
+            voice: Optional[bytes] = None):
+        self.today = date.today()
+        self.scenarios = scenarios(self.today)
+        self.llm = StubLLM(PromptRegistry(PROMPT_DIR), self.scenarios, latency_sampler(llm_latency))
+        self.bot_api = FakeBotApi(latency_sampler(bot_latency), voice)
+        self.bot = Telebot(token=BENCHMARK_TOKEN, request=self.bot_api, llm=self.llm.client())
+        self.bot.db.run = timed('db', self.bot.db.run)
+        self.bot.gpt.query = timed('llm', self.bot.gpt.query)
+        self.bot.gpt.stream_query = timed_stream('llm', self.bot.gpt.stream_query)
+        self.bot.app.add_error_handler(self.record_error)
+        self.chat_ids = [CHAT_ID_BASE + i for i in range(users)]
+        self.reminder_ids: list[int] = []
+        self.results: dict[str, list[dict]] = defaultdict(list)
+        self.errors = Counter()
+        self.update_id = 0
+
+    async def start(self):
+        await self.bot.app.initialize()
+        await self.bot.startup(self.bot.app)
+        await asyncio.gather(*(self.seed(chat_id) for chat_id in self.chat_ids))
+
+    async def stop(self):
+        # buffered messages have to reach the database before their users are deleted
+        await self.bot.db.flush()
+        await asyncio.gather(*(self.bot.db.delete_user_account_query(chat_id) for chat_id in self.chat_ids))
+        await self.bot.app.shutdown()
+        await self.bot.shutdown(self.bot.app)
+
+    async def seed(self, chat_id: int):
+        db = self.bot.db
+        if await db.account_exists_query(chat_id):
+            await db.delete_user_account_query(chat_id)
+        await db.create_user_account_query(f'benchmark{chat_id - CHAT_ID_BASE}', chat_id)
+        for offset, description in enumerate(DEADLINES):
+            due_date = self.today + timedelta(days=5 + offset)
+            deadline_id = await db.create_deadline_query(chat_id, description, due_date)
+            reminder_time = datetime(due_date.year, due_date.month, due_date.day, 8) - timedelta(days=1)
+            self.reminder_ids.append(await db.create_reminders_query(deadline_id, reminder_time))
+
+    async def record_error(self, update, context):
+        self.errors[repr(context.error)] += 1
+        timings = current_timings.get(None)
+        if timings is not None:
+            timings['error'] = True
+
+    def update(self, chat_id: int, text: Optional[str]) -> Update:
+        self.update_id += 1
+        message = {
+            'message_id': self.update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Benchmark',
+                     'username': f'benchmark{chat_id - CHAT_ID_BASE}'}
+        }
+        if text is None:
+            file_id = f'benchmark-voice-{self.update_id}'
+            message['voice'] = {'file_id': file_id, 'file_unique_id': file_id, 'duration': 3}
+        else:
+            message['text'] = text
+        return Update.de_json({'update_id': self.update_id, 'message': message}, self.bot.app.bot)
+
+    async def measure(self, intent: str, work):
+        start = time.perf_counter()
+        timings = {'db': 0.0, 'llm': 0.0, 'error': False, 'start': start}
+        current_timings.set(timings)
+        try:
+            await work
+        except Exception as e:
+            self.errors[repr(e)] += 1
+            timings['error'] = True
+        timings['latency'] = time.perf_counter() - timings.pop('start')
+        self.results[intent].append(timings)
+
+    async def drive(self, requests: int, concurrency: int, mix: dict[str, float]) -> float:
+        """Sends requests updates from concurrency workers, returning the elapsed seconds."""
+        intents = random.choices(list(mix), weights=list(mix.values()), k=requests)
+        pending = [(intent, random.choice(self.chat_ids)) for intent in intents]
+
+        async def worker():
+            while pending:
+                intent, chat_id = pending.pop()
+                text = None if intent == 'voice' else self.scenarios[intent]['message']
+                update = self.update(chat_id, text)
+                # through the update processor, as the application would, so updates of a chat queue up
+                await self.measure(intent, self.bot.update_processor.process_update(
+                    update, self.bot.app.process_update(update)))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return time.perf_counter() - start
+
+    async def drive_streamed(self, requests: int, concurrency: int, interval: float):
+        bot_data = self.bot.app.context_types.context.bot_data
+        previous = bot_data.get('stream_interval')
+        bot_data['stream_interval'] = interval
+        try:
+            await self.drive(requests, concurrency, {'converse_stream': 1.0})
+        finally:
+            bot_data['stream_interval'] = previous
+
+    async def deliver_reminders(self, batch_size: int):
+        for i in range(0, len(self.reminder_ids), batch_size):
+            await self.measure('reminders', self.bot.scheduler.callback(self.reminder_ids[i:i + batch_size]))
+
+    def report(self, elapsed: float) -> dict:
+        handled = sum(len(samples) for intent, samples in self.results.items()
+                      if intent not in ('reminders', 'converse_stream'))
+        return {
+            'elapsed_s': elapsed,
+            'messages_per_second': handled / elapsed if elapsed else 0.0,
+            'intents': {intent: summarize(samples) for intent, samples in sorted(self.results.items())},
+            'errors': dict(self.errors),
+            'llm_calls': dict(self.llm.calls),
+            'bot_api_calls': dict(self.bot_api.calls),
+            'components': {
+                'pool': self.bot.db.stats.as_dict(),
+                'identity_cache': self.bot.db.identity_cache.as_dict(),
+                'conversations': self.bot.db.conversations.as_dict(),
+                'deadlines': self.bot.db.deadlines.as_dict(),
+                'write_behind': self.bot.db.write_behind_stats.as_dict(),
+                'dispatcher': self.bot.dispatcher.stats.as_dict(),
+                'intent_classifier': self.bot.intent_classifier.stats.as_dict(),
+                'deadline_index': self.bot.deadline_index.stats.as_dict(),
+                'response_cache': self.bot.response_cache.stats.as_dict()
+            }
+        }
+
+
+async def main(args) -> dict:
+    mix = {intent: 1.0 for intent in scenarios(date.today()) if intent != 'converse_stream'}
+    voice = None
+    if args.voice:
+        with open(args.voice, 'rb') as infile:
+            voice = infile.read()
+        mix['voice'] = 1.0
+    for weight in args.mix:
+        intent, _, value = weight.partition('=')
+        mix[intent] = float(value)
+    mix = {intent: weight for intent, weight in mix.items() if weight > 0}
+
+    benchmark = LoadBenchmark(args.users, args.llm_latency, args.bot_latency, voice)
+    await benchmark.start()
+    try:
+        elapsed = await benchmark.drive(args.requests, args.concurrency, mix)
+        if args.stream_requests:
+            await benchmark.drive_streamed(args.stream_requests, args.concurrency, args.stream_interval)
+        await benchmark.deliver_reminders(args.reminder_batch)
+    finally:
+        await benchmark.stop()
+    return benchmark.report(elapsed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the handlers end to end against stubbed OpenAI and Telegram.')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--mix', nargs='*', default=[], metavar='INTENT=WEIGHT',
+                        help='relative weight of an intent, every intent defaults to 1 and 0 leaves it out')
+    parser.add_argument('--voice', help='ogg file sent as every voice message, voice messages are left out without it')
+    parser.add_argument('--llm-latency', default='lognormal:0.5:0.4',
+                        help='fixed:SECONDS, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA')
+    parser.add_argument('--bot-latency', default='fixed:0.05')
+    parser.add_argument('--stream-requests', type=int, default=100,
+                        help='small talk messages sent with streamed replies after the mixed run, 0 to skip')
+    parser.add_argument('--stream-interval', type=float, default=0.5,
+                        help='seconds between edits of a streamed reply')
+    parser.add_argument('--reminder-batch', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    logging.basicConfig(level=logging.WARNING)
+    try:
+        results = asyncio.run(main(args))
+    except psycopg2.OperationalError as e:
+        parser.exit(1, f'The benchmark needs the database configured by the POSTGRES_* variables: {e}\n')
+    results['config'] = vars(args)
+
+    print(f'{results["messages_per_second"]:.1f} messages/s over {results["elapsed_s"]:.1f} s')
+    print(f'  {"intent":<18}{"count":>7}{"errors":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"db ms":>10}{"llm ms":>10}')
+    for intent, summary in results['intents'].items():
+        print(f'  {intent:<18}{summary["count"]:>7}{summary["errors"]:>8}{summary["p50_ms"]:>10.1f}'
+              f'{summary["p95_ms"]:>10.1f}{summary["p99_ms"]:>10.1f}{summary["db_ms"]:>10.1f}{summary["llm_ms"]:>10.1f}')
+    for intent, summary in results['intents'].items():
+        if 'first_chunk_p50_ms' in summary:
+            print(f'  {intent} first chunk p50 {summary["first_chunk_p50_ms"]:.1f} ms, p95 {summary["first_chunk_p95_ms"]:.1f} ms')
+    for error, count in results['errors'].items():
+        print(f'  {count} x {error}')
+
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
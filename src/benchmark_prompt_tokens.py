@@ -0,0 +1,98 @@
+"""Compares prompt tokens of deadline lists rendered as Python reprs and as compact lines.
+
+Every prompt that lists deadlines is rendered for synthetic users with the given numbers of
+deadlines, or with --from-db for every user in the configured database, once with the repr the
+prompts used to interpolate and once with serialize_deadlines, with and without a token budget.
+Tokens are counted with tiktoken when it is installed, otherwise estimated from the length.
+
+    python benchmark_prompt_tokens.py --sizes 5 20 100 500 --budget 1500
+"""
+import argparse
+import json
+import random
+from collections import defaultdict
+from datetime import date, timedelta
+
+from gpt import PROMPT_DIR, estimate_tokens, serialize_deadlines
+from prompt_registry import PromptRegistry
+
+PROMPTS = ['extract_all', 'extract_delete_ids', 'filter_deadlines']
+MODULES = ['CS1101S', 'CS1231S', 'CS2030S', 'CS2040S', 'CS2100', 'CS2103T', 'MA1521', 'MA2001', 'ST2334', 'GEA1000']
+TASKS = ['Lab {}', 'Problem Set {}', 'Tutorial {}', 'Assignment {}', 'Midterm', 'Final Exam', 'Project Milestone {}',
+         'Reading Quiz {}', 'Peer Review {}', 'Group Presentation']
+NOW = '09:00AM on January 15, 2025'
+
+
+def count_tokens():
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding('o200k_base')
+        return 'tiktoken o200k_base', lambda text: len(encoding.encode(text))
+    except ImportError:
+        return 'estimated', estimate_tokens
+
+
+def synthetic_deadlines(size: int, today: date) -> list[tuple[int, str, date]]:
+    """A semester of deadlines around today, a few weeks back to a few months ahead."""
+    return [(id, f'{random.choice(MODULES)} {random.choice(TASKS).format(random.randint(1, 10))}',
+             today + timedelta(days=random.randint(-30, 120)))
+            for id in range(1, size + 1)]
+
+
+def database_deadlines() -> dict[str, list[tuple[int, str, date]]]:
+    from migrations import connect
+
+    conn = connect()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT "user_id", "id", "description", "due_date" FROM "deadlines" ORDER BY "due_date"')
+            users = defaultdict(list)
+            for user_id, *deadline in cursor.fetchall():
+                users[f'user {user_id}'].append(tuple(deadline))
+            return dict(users)
+    finally:
+        conn.close()
+
+
+def measure(prompts: PromptRegistry, tokens, deadlines: list[tuple[int, str, date]], budget: int, today: date) -> dict:
+    results = {}
+    for name in PROMPTS:
+        values = {'now': NOW} if 'now' in prompts.templates[name].placeholders else {}
+        results[name] = {
+            'repr': tokens(prompts.render(name, deadlines=deadlines, **values)),
+            'compact': tokens(prompts.render(name, deadlines=serialize_deadlines(deadlines), **values)),
+            'budgeted': tokens(prompts.render(name, deadlines=serialize_deadlines(deadlines, budget, today), **values))
+        }
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure prompt tokens of deadline lists before and after compaction.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5, 20, 100, 500])
+    parser.add_argument('--budget', type=int, default=1500)
+    parser.add_argument('--from-db', action='store_true', help='measure the deadlines of every user in the database')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    today = date(2025, 1, 15)
+    tokenizer, tokens = count_tokens()
+    prompts = PromptRegistry(PROMPT_DIR)
+    if args.from_db:
+        datasets = database_deadlines()
+        today = date.today()
+    else:
+        datasets = {f'{size} deadlines': synthetic_deadlines(size, today) for size in args.sizes}
+
+    results = {dataset: measure(prompts, tokens, deadlines, args.budget, today) for dataset, deadlines in datasets.items()}
+    print(f'prompt tokens, {tokenizer}, budget {args.budget}')
+    for dataset, prompt_results in results.items():
+        print(f'\n{dataset}')
+        for name, result in prompt_results.items():
+            print(f'  {name:<20}{result["repr"]:>8} -> {result["compact"]:>8} compact{result["budgeted"]:>8} budgeted'
+                  f'  ({1 - result["compact"] / result["repr"]:.0%} saved)')
+
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump({'tokenizer': tokenizer, 'budget': args.budget, 'results': results}, outfile, indent=2)
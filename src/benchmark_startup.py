@@ -0,0 +1,90 @@
+"""Measures how long the bot takes to start and the memory it holds, with Whisper loaded lazily or eagerly.
+
+Every run starts a fresh interpreter that imports the bot and builds Telebot against the configured
+database, then loads the Whisper model as the first voice message would. The eager mode imports
+faster_whisper up front and loads the model while starting, as the bot used to. Memory is the
+resident set size after each step.
+
+    python benchmark_startup.py --runs 3 --json startup.json
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARK_TOKEN = '123456:benchmark'
+MODES = ['lazy', 'eager']
+
+
+def rss_mb() -> float:
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # peak rather than current outside linux, still comparable between the modes
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def measure(mode: str) -> dict:
+    start = time.perf_counter()
+    if mode == 'eager':
+        import faster_whisper  # noqa: F401
+    from telebot import Telebot
+    imported = time.perf_counter()
+
+    bot = Telebot(token=BENCHMARK_TOKEN)
+    if mode == 'eager':
+        bot.transcriber.load()
+    started = time.perf_counter()
+    result = {
+        'import_seconds': imported - start,
+        'init_seconds': started - imported,
+        'startup_seconds': started - start,
+        'startup_rss_mb': rss_mb()
+    }
+
+    bot.transcriber.load()
+    result['first_voice_seconds'] = time.perf_counter() - started
+    result['loaded_rss_mb'] = rss_mb()
+    bot.transcriber.close()
+    bot.db.close()
+    return result
+
+
+def run(mode: str) -> dict:
+    output = subprocess.run([sys.executable, __file__, '--child', mode], capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure startup time and memory of the bot.')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child)))
+        sys.exit()
+
+    results = {}
+    for mode in MODES:
+        runs = [run(mode) for _ in range(args.runs)]
+        results[mode] = {key: statistics.median(result[key] for result in runs) for key in runs[0]}
+
+    print(f'median of {args.runs} runs')
+    print(f'{"":<8}{"import":>10}{"init":>10}{"startup":>10}{"rss":>10}{"1st voice":>12}{"rss":>10}')
+    for mode, result in results.items():
+        print(f'{mode:<8}{result["import_seconds"]:>9.2f}s{result["init_seconds"]:>9.2f}s{result["startup_seconds"]:>9.2f}s'
+              f'{result["startup_rss_mb"]:>7.0f} MB{result["first_voice_seconds"]:>11.2f}s{result["loaded_rss_mb"]:>7.0f} MB')
+
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump({'runs': args.runs, 'results': results}, outfile, indent=2)
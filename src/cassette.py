@@ -0,0 +1,78 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import re
+
+# the current time rendered into prompts, masked so recordings replay on later days
+NOW_PATTERN = re.compile(r'\d{2}:\d{2}[AP]M on [A-Z][a-z]+ \d{2}, \d{4}')
+
+
+class CassetteMiss(KeyError):
+    pass
+
+
+class Cassette:
+    """Completions recorded to a gzipped json lines file and replayed by a hash of their request.
+
+    In record mode every completion is appended to the file along with its request and latency.
+    In replay mode completions are served from the file without touching the network, after the
+    recorded latency if inject_latency is set, and requests that were never recorded raise
+    CassetteMiss.
+    """
+
+    def __init__(self, path: str, mode: str = 'replay', inject_latency: bool = False):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f'Unknown cassette mode {mode}')
+        self.path = path
+        self.mode = mode
+        self.inject_latency = inject_latency
+        self.entries: dict[str, dict] = {}
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(path):
+            with gzip.open(path, 'rt') as infile:
+                for line in infile:
+                    entry = json.loads(line)
+                    self.entries[entry['key']] = entry
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == 'replay'
+
+    @staticmethod
+    def key(model: str, messages: list, json_format: bool) -> str:
+        request = json.dumps({
+            'model': model,
+            'messages': [{**message, 'content': NOW_PATTERN.sub('<now>', message['content'])} for message in messages],
+            'json': bool(json_format)
+        }, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    async def replay(self, model: str, messages: list, json_format: bool) -> str:
+        entry = self.entries.get(self.key(model, messages, json_format))
+        if entry is None:
+            self.misses += 1
+            raise CassetteMiss(f'No recorded completion for {messages[-1]["content"]!r} in {self.path}')
+        self.hits += 1
+        if self.inject_latency:
+            await asyncio.sleep(entry['latency'])
+        return entry['completion']
+
+    def record(self, model: str, messages: list, json_format: bool, completion: str, latency: float):
+        key = self.key(model, messages, json_format)
+        entry = {
+            'key': key,
+            'model': model,
+            'messages': messages,
+            'json': bool(json_format),
+            'completion': completion,
+            'latency': round(latency, 4)
+        }
+        self.entries[key] = entry
+        with gzip.open(self.path, 'at') as outfile:
+            outfile.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+    def as_dict(self) -> dict:
+        return {'mode': self.mode, 'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
@@ -1,17 +1,261 @@
-from typing import Optional
+import asyncio
+import bisect
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Optional, TypeVar
 
 import psycopg2
 from psycopg2 import sql
-from datetime import datetime, date
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from datetime import datetime, date, timedelta
+
+from metrics import span
+
+T = TypeVar('T')
+
+logger = logging.getLogger(__name__)
+
+HISTORY_LIMIT = 10
+
+
+class IdentityCache:
+    """Bounded LRU map of chat id to user id, where None records that the chat has no account."""
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.entries: OrderedDict[int, Optional[int]] = OrderedDict()
+        # sessions of AsyncPostgresDb share the cache across worker threads
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id: int) -> tuple[bool, Optional[int]]:
+        with self.lock:
+            if chat_id in self.entries:
+                self.entries.move_to_end(chat_id)
+                self.hits += 1
+                return True, self.entries[chat_id]
+            self.misses += 1
+            return False, None
+
+    def put(self, chat_id: int, user_id: Optional[int]):
+        with self.lock:
+            self.entries[chat_id] = user_id
+            self.entries.move_to_end(chat_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, chat_id: int):
+        with self.lock:
+            self.entries.pop(chat_id, None)
+
+    def as_dict(self) -> dict:
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class ConversationCache:
+    """Ring buffers of each chat's latest messages, bounded in total size with idle chats evicted first.
+
+    Chats are hydrated from the messages table on first use, and new messages are appended only to
+    chats already held in memory, so the table remains the durable record.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, history_limit: int = HISTORY_LIMIT):
+        self.max_bytes = max_bytes
+        self.history_limit = history_limit
+        self.chats: OrderedDict[int, deque[tuple[str, bool]]] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def message_size(message: tuple[str, bool]) -> int:
+        return len(message[0].encode())
+
+    def get(self, chat_id: int) -> Optional[list[tuple[str, bool]]]:
+        if chat_id not in self.chats:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.chats.move_to_end(chat_id)
+        return list(self.chats[chat_id])
+
+    def load(self, chat_id: int, messages: list[tuple[str, bool]]):
+        self.evict(chat_id)
+        self.chats[chat_id] = deque(maxlen=self.history_limit)
+        for message in messages:
+            self.append(chat_id, message)
+
+    def append(self, chat_id: int, message: tuple[str, bool]):
+        if chat_id not in self.chats:
+            return
+        history = self.chats[chat_id]
+        if len(history) == history.maxlen:
+            self.size -= self.message_size(history[0])
+        history.append(message)
+        self.size += self.message_size(message)
+        self.chats.move_to_end(chat_id)
+        while self.size > self.max_bytes and len(self.chats) > 1:
+            self.evict(next(iter(self.chats)))
+            self.evictions += 1
+
+    def evict(self, chat_id: int):
+        history = self.chats.pop(chat_id, None)
+        if history:
+            self.size -= sum(map(self.message_size, history))
+
+    def as_dict(self) -> dict:
+        return {'chats': len(self.chats), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class DeadlineSnapshot:
+    """One user's deadlines sorted by due date, with the reminders that were upcoming when loaded."""
+
+    def __init__(self, deadlines: list[tuple[int, str, date]], reminders: list[tuple[int, int, datetime]]):
+        self.deadlines = sorted(deadlines, key=lambda deadline: deadline[2])
+        self.due_dates = [deadline[2] for deadline in self.deadlines]
+        self.by_id = {deadline[0]: deadline for deadline in self.deadlines}
+        self.reminders: dict[int, list[tuple[int, datetime]]] = {}
+        for reminder_id, deadline_id, reminder_time in sorted(reminders, key=lambda reminder: reminder[2]):
+            self.reminders.setdefault(deadline_id, []).append((reminder_id, reminder_time))
+
+    def in_range(self, start_date: date, end_date: date) -> list[tuple[int, str, date]]:
+        start = bisect.bisect_left(self.due_dates, start_date)
+        end = bisect.bisect_right(self.due_dates, end_date)
+        return self.deadlines[start:end]
+
+    def exists(self, description: str) -> bool:
+        return any(deadline[1] == description for deadline in self.deadlines)
+
+    def by_ids(self, ids: list[int]) -> list[tuple[int, str, date]]:
+        wanted = set(ids)
+        return [deadline for deadline in self.deadlines if deadline[0] in wanted]
+
+    def upcoming_reminders(self, ids: list[int]) -> list[tuple[str, list[datetime]]]:
+        now = datetime.now()
+        reminders = {}
+        for id in ids:
+            times = [reminder_time for _, reminder_time in self.reminders.get(id, []) if reminder_time >= now]
+            if id in self.by_id and times:
+                reminders.setdefault(self.by_id[id][1], []).extend(times)
+        return [(description, sorted(times)) for description, times in reminders.items()]
+
+
+class DeadlineCache:
+    """Snapshots of each user's deadlines and reminders, evicted least recently used first.
+
+    Every write through AsyncPostgresDb invalidates the snapshot of the user it touches and stamps
+    that user with the next version, and a snapshot read at some version is only installed if its
+    user was not written since, so a load racing a write can never bring stale rows back while
+    writes of other users leave it be. Writes whose user is unknown, and the stamps of users pushed
+    out of the last max_users written, raise a floor that fails every load read before them.
+    """
+
+    def __init__(self, max_users: int = 1000):
+        self.max_users = max_users
+        self.version = 0
+        self.floor = 0
+        self.written: OrderedDict[int, int] = OrderedDict()
+        self.snapshots: OrderedDict[int, DeadlineSnapshot] = OrderedDict()
+        self.deadline_owners: dict[int, int] = {}
+        self.reminder_owners: dict[int, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id: int) -> Optional[DeadlineSnapshot]:
+        snapshot = self.snapshots.get(chat_id)
+        if snapshot is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.snapshots.move_to_end(chat_id)
+        return snapshot
+
+    def owner(self, deadline_ids: list[int]) -> Optional[DeadlineSnapshot]:
+        """The loaded snapshot holding every one of deadline_ids, if there is one."""
+        owners = {self.deadline_owners.get(id) for id in deadline_ids}
+        if len(owners) != 1 or None in owners:
+            self.misses += 1
+            return None
+        return self.get(owners.pop())
+
+    def load(self, chat_id: int, version: int, snapshot: DeadlineSnapshot) -> bool:
+        if version < max(self.floor, self.written.get(chat_id, 0)):
+            return False
+        self.drop(chat_id)
+        self.snapshots[chat_id] = snapshot
+        for id in snapshot.by_id:
+            self.deadline_owners[id] = chat_id
+        for reminders in snapshot.reminders.values():
+            for reminder_id, _ in reminders:
+                self.reminder_owners[reminder_id] = chat_id
+        while len(self.snapshots) > self.max_users:
+            self.drop(next(iter(self.snapshots)))
+        return True
+
+    def invalidate(self, chat_id: int):
+        self.version += 1
+        self.written[chat_id] = self.version
+        self.written.move_to_end(chat_id)
+        while len(self.written) > self.max_users:
+            self.floor = max(self.floor, self.written.popitem(last=False)[1])
+        self.drop(chat_id)
+
+    def invalidate_all(self):
+        self.version += 1
+        self.floor = self.version
+
+    def drop(self, chat_id: int):
+        snapshot = self.snapshots.pop(chat_id, None)
+        if snapshot:
+            for id in snapshot.by_id:
+                self.deadline_owners.pop(id, None)
+            for reminders in snapshot.reminders.values():
+                for reminder_id, _ in reminders:
+                    self.reminder_owners.pop(reminder_id, None)
+
+    def invalidate_deadlines(self, ids: list[int]):
+        owners = {self.deadline_owners.get(id) for id in ids}
+        if None in owners:
+            # the deadline may belong to a user whose snapshot is being read right now
+            self.invalidate_all()
+            owners.discard(None)
+        for chat_id in owners:
+            self.invalidate(chat_id)
+
+    def invalidate_reminder(self, reminder_id: int, deadline_id: Optional[int] = None):
+        chat_id = self.reminder_owners.get(reminder_id, self.deadline_owners.get(deadline_id))
+        if chat_id is None:
+            self.invalidate_all()
+        else:
+            self.invalidate(chat_id)
+
+    def as_dict(self) -> dict:
+        return {'users': len(self.snapshots), 'version': self.version, 'hits': self.hits, 'misses': self.misses}
 
 
 class PostgresDb:
-    def __init__(self, db: str, host: str, port: int, user: str, password: str):
+    def __init__(
+            self,
+            db: str,
+            host: str,
+            port: int,
+            user: str,
+            password: str,
+            identity_cache: Optional[IdentityCache] = None):
         self.db = db
         self.host = host
         self.port = port
         self.user = user
         self.password = password
+        self.identity_cache = identity_cache
         self.conn = None
         self.cursor = None
 
@@ -24,6 +268,16 @@ class PostgresDb:
             password=self.password)
         self.cursor = self.conn.cursor()
 
+    @classmethod
+    def from_connection(cls, conn, identity_cache: Optional[IdentityCache] = None) -> 'PostgresDb':
+        # Bind a session to an already opened connection, e.g. one checked out of a pool
+        db = cls.__new__(cls)
+        db.db = db.host = db.port = db.user = db.password = None
+        db.identity_cache = identity_cache
+        db.conn = conn
+        db.cursor = conn.cursor()
+        return db
+
     def close(self):
         self.cursor.close()
         self.conn.close()
@@ -32,12 +286,7 @@ class PostgresDb:
         self.cursor.execute(query, vals)
 
     def account_exists_query(self, chat_id: int) -> bool:
-        query = sql.SQL('SELECT 1 FROM {table} WHERE {field} = %s').format(
-            table=sql.Identifier('users'),
-            field=sql.Identifier('chat_id')
-        )
-        self.query(query, (chat_id,))
-        return self.cursor.fetchone() is not None
+        return self.get_userid_from_chatid(chat_id) is not None
 
     def delete_user_account_query(self, chat_id: int):
         query = sql.SQL('DELETE FROM {table} WHERE {field} = %s').format(
@@ -46,6 +295,8 @@ class PostgresDb:
         )
         self.query(query, (chat_id,))
         self.conn.commit()
+        if self.identity_cache:
+            self.identity_cache.invalidate(chat_id)
 
     def create_user_account_query(self, username: str, chat_id: int):
         query = sql.SQL('INSERT INTO {table} ({field1}, {field2}) VALUES(%s, %s)').format(
@@ -55,27 +306,40 @@ class PostgresDb:
         )
         self.query(query, (username, chat_id))
         self.conn.commit()
+        if self.identity_cache:
+            self.identity_cache.invalidate(chat_id)
 
-    def get_userid_from_chatid(self, chat_id: int) -> int:
+    def fetch_user_id_query(self, chat_id: int) -> Optional[int]:
         query = sql.SQL('SELECT {field1} FROM {table} WHERE {field2} = %s').format(
             table=sql.Identifier('users'),
             field1=sql.Identifier('id'),
             field2=sql.Identifier('chat_id')
         )
         self.query(query, (chat_id,))
-        return self.cursor.fetchone()[0]
+        row = self.cursor.fetchone()
+        user_id = row[0] if row else None
+        if self.identity_cache:
+            self.identity_cache.put(chat_id, user_id)
+        return user_id
+
+    def get_userid_from_chatid(self, chat_id: int) -> Optional[int]:
+        if self.identity_cache:
+            cached, user_id = self.identity_cache.get(chat_id)
+            if cached:
+                return user_id
+        return self.fetch_user_id_query(chat_id)
 
     def fetch_latest_messages_query(self, chat_id: int) -> list[tuple[str, bool]]:
         user_id = self.get_userid_from_chatid(chat_id)
         query = sql.SQL('SELECT {field1}, {field2} FROM {table} WHERE {field3} = %s '
-                        'ORDER BY {field4} DESC LIMIT 10').format(
+                        'ORDER BY {field4} DESC LIMIT %s').format(
             table=sql.Identifier('messages'),
             field1=sql.Identifier('text'),
             field2=sql.Identifier('fromUser'),
             field3=sql.Identifier('user_id'),
             field4=sql.Identifier('created_at')
         )
-        self.query(query, (user_id,))
+        self.query(query, (user_id, HISTORY_LIMIT))
         messages = self.cursor.fetchall()
         messages.reverse()
         return messages
@@ -91,6 +355,18 @@ class PostgresDb:
         self.query(query, (user_id, text, from_user))
         self.conn.commit()
 
+    def create_messages_query(self, messages: list[tuple[int, str, bool, datetime]]):
+        """Inserts (user_id, text, from_user, created_at) rows in a single statement."""
+        query = sql.SQL('INSERT INTO {table} ({field1}, {field2}, {field3}, {field4}) VALUES %s').format(
+            table=sql.Identifier('messages'),
+            field1=sql.Identifier('user_id'),
+            field2=sql.Identifier('text'),
+            field3=sql.Identifier('fromUser'),
+            field4=sql.Identifier('created_at')
+        )
+        execute_values(self.cursor, query, messages, page_size=len(messages))
+        self.conn.commit()
+
     def create_deadline_query(self, chat_id: int, description: str, due_date: date) -> int:
         user_id = self.get_userid_from_chatid(chat_id)
         query = sql.SQL('INSERT INTO {table} ({field1}, {field2}, {field3}) VALUES(%s, %s, %s) RETURNING {field4}').format(
@@ -134,6 +410,31 @@ class PostgresDb:
         self.query(query, (user_id, start_date, end_date))
         return self.cursor.fetchall()
 
+    def fetch_deadline_snapshot_query(self, chat_id: int) -> DeadlineSnapshot:
+        user_id = self.get_userid_from_chatid(chat_id)
+        query = sql.SQL('SELECT {field1}, {field2}, {field3} FROM {table} WHERE {field4} = %s').format(
+            table=sql.Identifier('deadlines'),
+            field1=sql.Identifier('id'),
+            field2=sql.Identifier('description'),
+            field3=sql.Identifier('due_date'),
+            field4=sql.Identifier('user_id')
+        )
+        self.query(query, (user_id,))
+        deadlines = self.cursor.fetchall()
+
+        query = sql.SQL('SELECT {table2}.{field1}, {table2}.{field2}, {table2}.{field3} FROM {table1} '
+                        'INNER JOIN {table2} ON {table1}.{field1} = {table2}.{field2} '
+                        'WHERE {table1}.{field4} = %s AND {table2}.{field3} >= %s').format(
+            table1=sql.Identifier('deadlines'),
+            table2=sql.Identifier('reminders'),
+            field1=sql.Identifier('id'),
+            field2=sql.Identifier('deadline_id'),
+            field3=sql.Identifier('reminder_time'),
+            field4=sql.Identifier('user_id')
+        )
+        self.query(query, (user_id, datetime.now()))
+        return DeadlineSnapshot(deadlines, self.cursor.fetchall())
+
     def fetch_deadlines_query_by_ids(self, ids: list[int]) -> list[tuple[int, str, date]]:
         query = sql.SQL('SELECT {field1}, {field2}, {field3} FROM {table} '
                         'WHERE {field1} = ANY(%s) ORDER BY {field3} ASC').format(
@@ -165,6 +466,95 @@ class PostgresDb:
         self.query(query, (timestamp,))
         return self.cursor.fetchall()
 
+    def fetch_reminders_query_by_ids(self, ids: list[int]) -> list[tuple[int, int, str, date, int]]:
+        query = sql.SQL('SELECT {table1}.{field1}, {table2}.{field2}, {table2}.{field3}, {table2}.{field4}, {table3}.{field2} '
+                        'FROM {table1} '
+                        'INNER JOIN {table2} ON {table1}.{field2} = {table2}.{field5} '
+                        'INNER JOIN {table3} ON {table2}.{field2} = {table3}.{field6} '
+                        'WHERE {table3}.{field2} = ANY(%s)').format(
+            table1=sql.Identifier('users'),
+            table2=sql.Identifier('deadlines'),
+            table3=sql.Identifier('reminders'),
+            field1=sql.Identifier('chat_id'),
+            field2=sql.Identifier('id'),
+            field3=sql.Identifier('description'),
+            field4=sql.Identifier('due_date'),
+            field5=sql.Identifier('user_id'),
+            field6=sql.Identifier('deadline_id')
+        )
+
+        self.query(query, (ids,))
+        return self.cursor.fetchall()
+
+    def fetch_reminder_times_query(self, since: datetime) -> list[tuple[int, datetime, int]]:
+        query = sql.SQL('SELECT {table3}.{field1}, {table3}.{field2}, {table1}.{field3} FROM {table1} '
+                        'INNER JOIN {table2} ON {table1}.{field1} = {table2}.{field4} '
+                        'INNER JOIN {table3} ON {table2}.{field1} = {table3}.{field5} '
+                        'WHERE {table3}.{field2} > %s AND {table3}.{field6} IS NULL').format(
+            table1=sql.Identifier('users'),
+            table2=sql.Identifier('deadlines'),
+            table3=sql.Identifier('reminders'),
+            field1=sql.Identifier('id'),
+            field2=sql.Identifier('reminder_time'),
+            field3=sql.Identifier('chat_id'),
+            field4=sql.Identifier('user_id'),
+            field5=sql.Identifier('deadline_id'),
+            field6=sql.Identifier('sent_at')
+        )
+        self.query(query, (since,))
+        return self.cursor.fetchall()
+
+    def lease_due_reminders_query(self, now: datetime, owner: str, lease: timedelta, limit: int) -> list[int]:
+        """Claims up to limit undelivered reminders due by now that no other instance holds a lease on.
+
+        Rows another instance is claiming at the same moment are skipped rather than waited on, so
+        concurrent instances come away with disjoint batches.
+        """
+        query = sql.SQL('UPDATE {table} SET {field1} = %s, {field2} = %s WHERE {field3} IN ('
+                        'SELECT {field3} FROM {table} WHERE {field4} IS NULL AND {field5} <= %s '
+                        'AND ({field2} IS NULL OR {field2} < %s) '
+                        'ORDER BY {field5} LIMIT %s FOR UPDATE SKIP LOCKED) RETURNING {field3}').format(
+            table=sql.Identifier('reminders'),
+            field1=sql.Identifier('leased_by'),
+            field2=sql.Identifier('leased_until'),
+            field3=sql.Identifier('id'),
+            field4=sql.Identifier('sent_at'),
+            field5=sql.Identifier('reminder_time')
+        )
+        self.query(query, (owner, now + lease, now, now, limit))
+        self.conn.commit()
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def renew_reminder_leases_query(self, ids: list[int], owner: str, leased_until: datetime) -> int:
+        """Extends the leases owner still holds on the reminders, returning how many it held."""
+        query = sql.SQL('UPDATE {table} SET {field1} = %s WHERE {field2} = ANY(%s) AND {field3} = %s AND {field4} IS NULL').format(
+            table=sql.Identifier('reminders'),
+            field1=sql.Identifier('leased_until'),
+            field2=sql.Identifier('id'),
+            field3=sql.Identifier('leased_by'),
+            field4=sql.Identifier('sent_at')
+        )
+        self.query(query, (leased_until, ids, owner))
+        self.conn.commit()
+        return self.cursor.rowcount
+
+    def mark_reminders_sent_query(self, ids: list[int], owner: str, sent_at: datetime) -> int:
+        """Marks the reminders still leased by owner as delivered, returning how many were.
+
+        Reminders moved since they were leased have lost their lease, and stay due at their new time.
+        """
+        query = sql.SQL('UPDATE {table} SET {field1} = %s, {field2} = NULL '
+                        'WHERE {field3} = ANY(%s) AND {field4} = %s AND {field1} IS NULL AND {field2} IS NOT NULL').format(
+            table=sql.Identifier('reminders'),
+            field1=sql.Identifier('sent_at'),
+            field2=sql.Identifier('leased_until'),
+            field3=sql.Identifier('id'),
+            field4=sql.Identifier('leased_by')
+        )
+        self.query(query, (sent_at, ids, owner))
+        self.conn.commit()
+        return self.cursor.rowcount
+
     def delete_deadlines_query(self, ids: list[int]) -> list[tuple[str, date]]:
         query = sql.SQL('DELETE FROM {table} WHERE {field1} = ANY(%s) RETURNING {field2}, {field3}').format(
             table=sql.Identifier('deadlines'),
@@ -173,6 +563,7 @@ class PostgresDb:
             field3=sql.Identifier('due_date')
         )
         self.query(query, (ids,))
+        self.conn.commit()
         return self.cursor.fetchall()
 
     def update_deadline_query(self, id: int, description: Optional[str], due_date: Optional[date]):
@@ -186,14 +577,16 @@ class PostgresDb:
         self.query(query, (description, due_date, id))
         self.conn.commit()
 
-    def create_reminders_query(self, deadline_id: int, reminder_time: datetime):
-        query = sql.SQL('INSERT INTO {table} ({field1}, {field2}) VALUES(%s, %s)').format(
+    def create_reminders_query(self, deadline_id: int, reminder_time: datetime) -> int:
+        query = sql.SQL('INSERT INTO {table} ({field1}, {field2}) VALUES(%s, %s) RETURNING {field3}').format(
             table=sql.Identifier('reminders'),
             field1=sql.Identifier('deadline_id'),
             field2=sql.Identifier('reminder_time'),
+            field3=sql.Identifier('id')
         )
         self.query(query, (deadline_id, reminder_time))
         self.conn.commit()
+        return self.cursor.fetchone()[0]
 
     def fetch_reminders_query_by_deadline_ids(self, ids: list[int]) -> list[tuple[str, list[datetime]]]:
         query = sql.SQL('SELECT {table1}.{field1}, ARRAY_AGG({table2}.{field2} ORDER BY {table2}.{field2}) FROM {table1} '
@@ -218,19 +611,408 @@ class PostgresDb:
         self.query(query, (deadline_id, reminder_time))
         return self.cursor.fetchone()
 
-    def update_reminder_query(self, reminder_id: int, reminder_time: datetime):
-        query = sql.SQL('UPDATE {table} SET {field1} = %s WHERE {field2} = %s').format(
+    def update_reminder_query(self, reminder_id: int, reminder_time: datetime) -> Optional[int]:
+        # a moved reminder is delivered again at its new time, even by an instance delivering it right now
+        query = sql.SQL('UPDATE {table} SET {field1} = %s, {field3} = NULL, {field4} = NULL, {field6} = NULL '
+                        'WHERE {field2} = %s RETURNING {field5}').format(
             table=sql.Identifier('reminders'),
             field1=sql.Identifier('reminder_time'),
-            field2=sql.Identifier('id')
+            field2=sql.Identifier('id'),
+            field3=sql.Identifier('sent_at'),
+            field4=sql.Identifier('leased_until'),
+            field5=sql.Identifier('deadline_id'),
+            field6=sql.Identifier('leased_by')
         )
         self.query(query, (reminder_time, reminder_id))
         self.conn.commit()
+        row = self.cursor.fetchone()
+        return row[0] if row else None
 
-    def delete_reminder_query(self, reminder_id: int):
-        query = sql.SQL('DELETE FROM {table} WHERE {field} = %s').format(
+    def delete_reminder_query(self, reminder_id: int) -> Optional[int]:
+        query = sql.SQL('DELETE FROM {table} WHERE {field1} = %s RETURNING {field2}').format(
             table=sql.Identifier('reminders'),
-            field=sql.Identifier('id')
+            field1=sql.Identifier('id'),
+            field2=sql.Identifier('deadline_id')
         )
         self.query(query, (reminder_id,))
-        self.conn.commit()
\ No newline at end of file
+        self.conn.commit()
+        row = self.cursor.fetchone()
+        return row[0] if row else None
+
+
+class WriteBehindStats:
+    def __init__(self):
+        self.backlog = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.failures = 0
+        self.dropped = 0
+        self.total_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    def record_flush(self, rows: int, latency: float):
+        self.flushes += 1
+        self.flushed += rows
+        self.total_flush_latency += latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+
+    def as_dict(self) -> dict:
+        return {
+            'backlog': self.backlog,
+            'flushes': self.flushes,
+            'flushed': self.flushed,
+            'failures': self.failures,
+            'dropped': self.dropped,
+            'avg_flush_latency': self.total_flush_latency / self.flushes if self.flushes else 0.0,
+            'max_flush_latency': self.max_flush_latency
+        }
+
+
+class PoolStats:
+    def __init__(self, pool_size: int):
+        self.pool_size = pool_size
+        self.in_use = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record_wait(self, wait: float):
+        self.acquired += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self) -> dict:
+        return {
+            'pool_size': self.pool_size,
+            'in_use': self.in_use,
+            'waiting': self.waiting,
+            'acquired': self.acquired,
+            'timeouts': self.timeouts,
+            'avg_wait': self.total_wait / self.acquired if self.acquired else 0.0,
+            'max_wait': self.max_wait
+        }
+
+
+class AsyncPostgresDb:
+    """Awaitable counterpart of PostgresDb backed by a bounded connection pool.
+
+    Every query checks a connection out of the pool, runs the matching PostgresDb method on a
+    worker thread and returns the connection, so the event loop is never blocked on a socket.
+    """
+
+    def __init__(
+            self,
+            db: str,
+            host: str,
+            port: int,
+            user: str,
+            password: str,
+            pool_size: int = 10,
+            acquire_timeout: float = 10.0,
+            identity_cache_size: int = 10000,
+            conversation_cache_bytes: int = 32 * 1024 * 1024,
+            deadline_cache_users: int = 1000,
+            write_behind: bool = False,
+            flush_size: int = 100,
+            flush_interval: float = 1.0):
+        self.db = db
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.pool_size = pool_size
+        self.acquire_timeout = acquire_timeout
+        self.stats = PoolStats(pool_size)
+        self.identity_cache = IdentityCache(identity_cache_size)
+        self.conversations = ConversationCache(conversation_cache_bytes)
+        self.deadlines = DeadlineCache(deadline_cache_users)
+        self.write_behind = write_behind
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.write_behind_stats = WriteBehindStats()
+        self.message_buffer: list[tuple[int, str, bool, datetime]] = []
+        self.flush_event = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = None
+        self.stopping = False
+        self.pool = None
+        self.executor = None
+        self.semaphore = None
+
+    def connect(self):
+        self.pool = ThreadedConnectionPool(
+            1,
+            self.pool_size,
+            dbname=self.db,
+            host=self.host,
+            port=self.port,
+            user=self.user,
+            password=self.password)
+        self.executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='postgres')
+        self.semaphore = asyncio.Semaphore(self.pool_size)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.pool.closeall()
+
+    async def start(self):
+        if self.write_behind:
+            self.stopping = False
+            self.flush_task = asyncio.create_task(self.flush_messages())
+
+    async def stop(self):
+        if self.flush_task:
+            # the flush in flight runs to the end rather than being cancelled halfway through its insert
+            self.stopping = True
+            self.flush_event.set()
+            await self.flush_task
+            self.flush_task = None
+        await self.flush()
+
+    async def flush_messages(self):
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.flush_event.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_event.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Failed to flush %s buffered messages', len(self.message_buffer))
+
+    async def flush(self):
+        # one flush at a time, so waiting on the lock also waits for the rows of one in flight
+        async with self.flush_lock:
+            if not self.message_buffer:
+                return
+
+            messages, self.message_buffer = self.message_buffer, []
+            start = time.perf_counter()
+            flushed = False
+            try:
+                try:
+                    await self.run(PostgresDb.create_messages_query, messages)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    raise
+                except psycopg2.Error:
+                    # a single bad row, e.g. of an account deleted since, fails the whole batch
+                    messages = await self.flush_rows(messages)
+                flushed = True
+            finally:
+                if not flushed:
+                    # keep the rows, ahead of anything buffered meanwhile, for the next flush, also when
+                    # cancelled by stop() which flushes them once more
+                    self.message_buffer = messages + self.message_buffer
+                    self.write_behind_stats.failures += 1
+                self.write_behind_stats.backlog = len(self.message_buffer)
+            self.write_behind_stats.record_flush(len(messages), time.perf_counter() - start)
+
+    async def flush_rows(self, messages: list[tuple[int, str, bool, datetime]]) -> list[tuple[int, str, bool, datetime]]:
+        """Inserts the rows one by one, dropping those the database rejects, and returns the inserted ones.
+
+        Connection errors and cancellation stop the flush, with the rows not yet inserted left in
+        messages for the caller to requeue.
+        """
+        inserted = []
+        row = 0
+        try:
+            for row, message in enumerate(messages):
+                try:
+                    await self.run(PostgresDb.create_messages_query, [message])
+                    inserted.append(message)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    raise
+                except psycopg2.Error as e:
+                    self.write_behind_stats.dropped += 1
+                    logger.error('Dropped buffered message of user %s: %s', message[0], e)
+            row = len(messages)
+        finally:
+            del messages[:row]
+        return inserted
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[PostgresDb]:
+        """Check out a pooled connection wrapped in a PostgresDb session for several queries in a row."""
+        start = time.perf_counter()
+        self.stats.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.stats.timeouts += 1
+            raise
+        finally:
+            self.stats.waiting -= 1
+        self.stats.record_wait(time.perf_counter() - start)
+        self.stats.in_use += 1
+
+        loop = asyncio.get_running_loop()
+        try:
+            checkout = loop.run_in_executor(self.executor, self.pool.getconn)
+            try:
+                conn = await self.finish(checkout)
+            except asyncio.CancelledError:
+                if not checkout.cancelled() and checkout.exception() is None:
+                    self.pool.putconn(checkout.result())
+                raise
+            session = PostgresDb.from_connection(conn, self.identity_cache)
+            try:
+                yield session
+            finally:
+                await self.finish(loop.run_in_executor(self.executor, self._release, session))
+        finally:
+            self.stats.in_use -= 1
+            self.semaphore.release()
+
+    @staticmethod
+    async def finish(future: asyncio.Future):
+        """Awaits an executor job, letting it run to the end when cancelled before passing the cancellation on.
+
+        The thread keeps using its connection until then, so it must not go back to the pool any earlier.
+        """
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            while not future.done():
+                try:
+                    await asyncio.wait([future])
+                except asyncio.CancelledError:
+                    pass
+            raise
+
+    def _release(self, session: PostgresDb):
+        session.cursor.close()
+        # the pool rolls back any transaction left open by read-only queries
+        self.pool.putconn(session.conn)
+
+    async def run(self, method: Callable[..., T], *args) -> T:
+        """Run an unbound PostgresDb method against a pooled connection."""
+        with span('db', method.__name__):
+            async with self.acquire() as session:
+                return await self.finish(asyncio.get_running_loop().run_in_executor(self.executor, method, session, *args))
+
+    async def account_exists_query(self, chat_id: int) -> bool:
+        return await self.get_userid_from_chatid(chat_id) is not None
+
+    async def delete_user_account_query(self, chat_id: int):
+        await self.run(PostgresDb.delete_user_account_query, chat_id)
+        self.conversations.evict(chat_id)
+        self.deadlines.invalidate(chat_id)
+
+    async def create_user_account_query(self, username: str, chat_id: int):
+        await self.run(PostgresDb.create_user_account_query, username, chat_id)
+
+    async def get_userid_from_chatid(self, chat_id: int) -> Optional[int]:
+        # cached identities are answered without checking out a connection
+        cached, user_id = self.identity_cache.get(chat_id)
+        if cached:
+            return user_id
+        return await self.run(PostgresDb.fetch_user_id_query, chat_id)
+
+    async def fetch_latest_messages_query(self, chat_id: int) -> list[tuple[str, bool]]:
+        messages = self.conversations.get(chat_id)
+        if messages is None:
+            if self.write_behind:
+                # the chat's latest messages may still be buffered
+                await self.flush()
+            messages = await self.run(PostgresDb.fetch_latest_messages_query, chat_id)
+            self.conversations.load(chat_id, messages)
+        return messages
+
+    async def create_message_query(self, chat_id: int, text: str, from_user: bool):
+        if self.write_behind:
+            # timestamped now, as the insert happens on a later flush
+            user_id = await self.get_userid_from_chatid(chat_id)
+            self.message_buffer.append((user_id, text, from_user, datetime.now()))
+            self.write_behind_stats.backlog = len(self.message_buffer)
+            if len(self.message_buffer) >= self.flush_size:
+                self.flush_event.set()
+        else:
+            await self.run(PostgresDb.create_message_query, chat_id, text, from_user)
+        self.conversations.append(chat_id, (text, from_user))
+
+    async def create_deadline_query(self, chat_id: int, description: str, due_date: date) -> int:
+        id = await self.run(PostgresDb.create_deadline_query, chat_id, description, due_date)
+        self.deadlines.invalidate(chat_id)
+        return id
+
+    async def fetch_deadline_snapshot(self, chat_id: int) -> DeadlineSnapshot:
+        snapshot = self.deadlines.get(chat_id)
+        if snapshot is None:
+            version = self.deadlines.version
+            snapshot = await self.run(PostgresDb.fetch_deadline_snapshot_query, chat_id)
+            self.deadlines.load(chat_id, version, snapshot)
+        return snapshot
+
+    async def deadline_exists_query(self, chat_id: int, description: str) -> bool:
+        return (await self.fetch_deadline_snapshot(chat_id)).exists(description)
+
+    async def fetch_deadlines_query(
+            self,
+            chat_id: int,
+            start_date: Optional[str] = None,
+            end_date: Optional[str] = None) -> list[tuple[int, str, date]]:
+        try:
+            start = datetime.strptime(start_date or '1900-1-1', '%Y-%m-%d').date()
+            end = datetime.strptime(end_date or '2100-12-30', '%Y-%m-%d').date()
+        except ValueError:
+            # leave dates the snapshot cannot compare for postgres to interpret
+            return await self.run(PostgresDb.fetch_deadlines_query, chat_id, start_date, end_date)
+        return (await self.fetch_deadline_snapshot(chat_id)).in_range(start, end)
+
+    async def fetch_deadlines_query_by_ids(self, ids: list[int]) -> list[tuple[int, str, date]]:
+        snapshot = self.deadlines.owner(ids)
+        if snapshot is None:
+            return await self.run(PostgresDb.fetch_deadlines_query_by_ids, ids)
+        return snapshot.by_ids(ids)
+
+    async def fetch_reminders_query(self, timestamp: datetime) -> list[tuple[int, int, str, date]]:
+        return await self.run(PostgresDb.fetch_reminders_query, timestamp)
+
+    async def fetch_reminders_query_by_ids(self, ids: list[int]) -> list[tuple[int, int, str, date, int]]:
+        return await self.run(PostgresDb.fetch_reminders_query_by_ids, ids)
+
+    async def fetch_reminder_times_query(self, since: datetime) -> list[tuple[int, datetime, int]]:
+        return await self.run(PostgresDb.fetch_reminder_times_query, since)
+
+    async def lease_due_reminders_query(self, now: datetime, owner: str, lease: timedelta, limit: int) -> list[int]:
+        return await self.run(PostgresDb.lease_due_reminders_query, now, owner, lease, limit)
+
+    async def renew_reminder_leases_query(self, ids: list[int], owner: str, leased_until: datetime) -> int:
+        return await self.run(PostgresDb.renew_reminder_leases_query, ids, owner, leased_until)
+
+    async def mark_reminders_sent_query(self, ids: list[int], owner: str, sent_at: datetime) -> int:
+        return await self.run(PostgresDb.mark_reminders_sent_query, ids, owner, sent_at)
+
+    async def delete_deadlines_query(self, ids: list[int]) -> list[tuple[str, date]]:
+        deleted = await self.run(PostgresDb.delete_deadlines_query, ids)
+        self.deadlines.invalidate_deadlines(ids)
+        return deleted
+
+    async def update_deadline_query(self, id: int, description: Optional[str], due_date: Optional[date]):
+        await self.run(PostgresDb.update_deadline_query, id, description, due_date)
+        self.deadlines.invalidate_deadlines([id])
+
+    async def create_reminders_query(self, deadline_id: int, reminder_time: datetime) -> int:
+        id = await self.run(PostgresDb.create_reminders_query, deadline_id, reminder_time)
+        self.deadlines.invalidate_deadlines([deadline_id])
+        return id
+
+    async def fetch_reminders_query_by_deadline_ids(self, ids: list[int]) -> list[tuple[str, list[datetime]]]:
+        snapshot = self.deadlines.owner(ids)
+        if snapshot is None:
+            return await self.run(PostgresDb.fetch_reminders_query_by_deadline_ids, ids)
+        return snapshot.upcoming_reminders(ids)
+
+    async def fetch_reminder_query(self, deadline_id: int, reminder_time: datetime) -> tuple[int, str, datetime]:
+        return await self.run(PostgresDb.fetch_reminder_query, deadline_id, reminder_time)
+
+    async def update_reminder_query(self, reminder_id: int, reminder_time: datetime):
+        deadline_id = await self.run(PostgresDb.update_reminder_query, reminder_id, reminder_time)
+        self.deadlines.invalidate_reminder(reminder_id, deadline_id)
+
+    async def delete_reminder_query(self, reminder_id: int):
+        deadline_id = await self.run(PostgresDb.delete_reminder_query, reminder_id)
+        self.deadlines.invalidate_reminder(reminder_id, deadline_id)
@@ -0,0 +1,213 @@
+import re
+from collections import Counter, OrderedDict
+from datetime import date
+from typing import Optional
+
+import numpy as np
+
+NGRAM_SIZE = 3
+WHITESPACE_PATTERN = re.compile(r'\s+')
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+
+def normalize(text: str) -> str:
+    return WHITESPACE_PATTERN.sub(' ', text.lower()).strip()
+
+
+def tokens(text: str) -> set[str]:
+    return set(TOKEN_PATTERN.findall(text.lower()))
+
+
+def ngrams(text: str) -> Counter:
+    padded = f' {normalize(text)} '
+    return Counter(padded[i:i + NGRAM_SIZE] for i in range(len(padded) - NGRAM_SIZE + 1))
+
+
+class UserDeadlineIndex:
+    """Character n-gram TF-IDF vectors of one user's deadline descriptions.
+
+    Raw n-gram counts and document frequencies are kept so deadlines can be added and removed
+    incrementally, and the idf weighting is applied at search time.
+    """
+
+    def __init__(self, deadlines: list[tuple[int, str, date]]):
+        self.ids: list[int] = [deadline[0] for deadline in deadlines]
+        self.descriptions: list[str] = [normalize(deadline[1]) for deadline in deadlines]
+        grams = [ngrams(deadline[1]) for deadline in deadlines]
+        self.vocabulary: dict[str, int] = {}
+        for counts in grams:
+            for gram in counts:
+                self.vocabulary.setdefault(gram, len(self.vocabulary))
+
+        self.counts = np.zeros((len(deadlines), len(self.vocabulary)), dtype=np.float32)
+        for row, counts in enumerate(grams):
+            self.counts[row, [self.vocabulary[gram] for gram in counts]] = list(counts.values())
+        self.document_frequency = (self.counts > 0).sum(axis=0).astype(np.float32)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, id: int, description: str):
+        counts = ngrams(description)
+        new_grams = [gram for gram in counts if gram not in self.vocabulary]
+        for gram in new_grams:
+            self.vocabulary[gram] = len(self.vocabulary)
+        if new_grams:
+            self.counts = np.pad(self.counts, ((0, 0), (0, len(new_grams))))
+            self.document_frequency = np.pad(self.document_frequency, (0, len(new_grams)))
+
+        row = np.zeros(len(self.vocabulary), dtype=np.float32)
+        row[[self.vocabulary[gram] for gram in counts]] = list(counts.values())
+        self.counts = np.vstack([self.counts, row])
+        self.document_frequency += row > 0
+        self.ids.append(id)
+        self.descriptions.append(normalize(description))
+
+    def remove(self, id: int):
+        if id not in self.ids:
+            return
+        row = self.ids.index(id)
+        self.document_frequency -= self.counts[row] > 0
+        self.counts = np.delete(self.counts, row, axis=0)
+        del self.ids[row]
+        del self.descriptions[row]
+
+    def update(self, id: int, description: str):
+        self.remove(id)
+        self.add(id, description)
+
+    def search(self, description: str, ids: Optional[list[int]] = None) -> list[tuple[int, float]]:
+        """Cosine similarity of every indexed deadline, or only of ids, to description, best first."""
+        if ids is None:
+            rows = np.arange(len(self.ids))
+        else:
+            wanted = set(ids)
+            rows = np.array([row for row, id in enumerate(self.ids) if id in wanted], dtype=np.intp)
+        if not len(rows):
+            return []
+
+        idf = np.log((1 + len(self.ids)) / (1 + self.document_frequency)) + 1
+        documents = self.counts[rows] * idf
+        documents /= np.maximum(np.linalg.norm(documents, axis=1, keepdims=True), 1e-9)
+
+        query = np.zeros(len(self.vocabulary), dtype=np.float32)
+        # n-grams no deadline contains still count towards the query norm, with the highest idf
+        unseen_norm = 0.0
+        unseen_idf = np.log(1 + len(self.ids)) + 1
+        for gram, count in ngrams(description).items():
+            if gram in self.vocabulary:
+                query[self.vocabulary[gram]] = count * idf[self.vocabulary[gram]]
+            else:
+                unseen_norm += (count * unseen_idf) ** 2
+        norm = np.sqrt(np.dot(query, query) + unseen_norm)
+        if norm == 0:
+            return []
+
+        scores = documents @ (query / norm)
+        order = np.argsort(-scores, kind='stable')
+        return [(self.ids[rows[i]], float(scores[i])) for i in order]
+
+
+class IndexStats:
+    def __init__(self):
+        self.local_matches = 0
+        self.llm_fallbacks = 0
+        self.candidates_sent = 0
+
+    def as_dict(self) -> dict:
+        total = self.local_matches + self.llm_fallbacks
+        return {
+            'local_matches': self.local_matches,
+            'llm_fallbacks': self.llm_fallbacks,
+            'local_rate': self.local_matches / total if total else 0.0,
+            'avg_candidates_sent': self.candidates_sent / self.llm_fallbacks if self.llm_fallbacks else 0.0
+        }
+
+
+class DeadlineIndex:
+    """Per-user deadline text indexes, loaded lazily and evicted least recently used first.
+
+    resolve() returns the single matching deadline when it matches exactly, or when the best match
+    is close enough, clearly ahead of the runner up and contains every word and number of the
+    query, otherwise the top_k candidates for the LLM to choose from. Near misses such as another
+    lab number score high on shared n-grams, so they are always left to the LLM.
+    """
+
+    def __init__(self, threshold: float = 0.65, margin: float = 0.2, top_k: int = 10, max_users: int = 1000):
+        self.threshold = threshold
+        self.margin = margin
+        self.top_k = top_k
+        self.max_users = max_users
+        self.stats = IndexStats()
+        self.users: OrderedDict[int, UserDeadlineIndex] = OrderedDict()
+
+    def loaded(self, chat_id: int) -> bool:
+        return chat_id in self.users
+
+    def load(self, chat_id: int, deadlines: list[tuple[int, str, date]]):
+        self.users[chat_id] = UserDeadlineIndex(deadlines)
+        self.users.move_to_end(chat_id)
+        while len(self.users) > self.max_users:
+            self.users.popitem(last=False)
+
+    def add(self, chat_id: int, id: int, description: str):
+        # users not loaded yet will pick the deadline up from the database on first use
+        if chat_id in self.users:
+            self.users[chat_id].add(id, description)
+
+    def update(self, chat_id: int, id: int, description: str):
+        if chat_id in self.users:
+            self.users[chat_id].update(id, description)
+
+    def remove(self, chat_id: int, ids: list[int]):
+        if chat_id in self.users:
+            for id in ids:
+                self.users[chat_id].remove(id)
+
+    def evict(self, chat_id: int):
+        self.users.pop(chat_id, None)
+
+    def resolve(
+            self,
+            chat_id: int,
+            description: str,
+            deadlines: list[tuple[int, str, date]]) -> tuple[list[int], list[tuple[int, str, date]]]:
+        """Returns (matched ids, []) when resolved locally, otherwise ([], candidates for the LLM)."""
+        index = self.users[chat_id]
+        self.users.move_to_end(chat_id)
+
+        deadline_ids = [deadline[0] for deadline in deadlines]
+        exact = [id for id, desc in zip(index.ids, index.descriptions)
+                 if desc == normalize(description) and id in deadline_ids]
+        if len(exact) == 1:
+            self.stats.local_matches += 1
+            return exact, []
+
+        scores = index.search(description, deadline_ids)
+        if scores and scores[0][1] >= self.threshold and (
+                len(scores) == 1 or scores[0][1] - scores[1][1] >= self.margin) and (
+                tokens(description) <= tokens(index.descriptions[index.ids.index(scores[0][0])])):
+            self.stats.local_matches += 1
+            return [scores[0][0]], []
+
+        ranked = {id: rank for rank, (id, _) in enumerate(scores[:self.top_k])}
+        indexed = set(index.ids)
+        # deadlines created outside this process are unknown to the index, always pass them on
+        candidates = [deadline for deadline in deadlines if deadline[0] in ranked or deadline[0] not in indexed]
+        candidates.sort(key=lambda deadline: ranked.get(deadline[0], -1))
+        self.stats.llm_fallbacks += 1
+        self.stats.candidates_sent += len(candidates)
+        return [], candidates
+
+    def shortlist(self, chat_id: int, text: str, deadlines: list[tuple[int, str, date]]) -> list[tuple[int, str, date]]:
+        """The top_k deadlines closest to text in their original order, or all of them when there are no more."""
+        if len(deadlines) <= self.top_k:
+            return deadlines
+        index = self.users[chat_id]
+        self.users.move_to_end(chat_id)
+
+        ranked = {id for id, _ in index.search(text, [deadline[0] for deadline in deadlines])[:self.top_k]}
+        if not ranked:
+            return deadlines
+        indexed = set(index.ids)
+        return [deadline for deadline in deadlines if deadline[0] in ranked or deadline[0] not in indexed]
@@ -0,0 +1,114 @@
+import asyncio
+import time
+from datetime import timedelta
+from typing import Awaitable, Callable, TypeVar
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from metrics import span
+
+T = TypeVar('T')
+
+
+class RateLimiter:
+    """Spaces out acquisitions to at most rate per second by handing out slots in arrival order."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next_slot = 0.0
+
+    async def acquire(self):
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, delay: float):
+        self.next_slot = max(self.next_slot, time.monotonic() + delay)
+
+
+class DispatcherStats:
+    def __init__(self):
+        self.pending = 0
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record_latency(self, latency: float):
+        self.sent += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self) -> dict:
+        return {
+            'queue_depth': self.pending,
+            'sent': self.sent,
+            'retries': self.retries,
+            'failed': self.failed,
+            'avg_latency': self.total_latency / self.sent if self.sent else 0.0,
+            'max_latency': self.max_latency
+        }
+
+
+class MessageDispatcher:
+    """Sends outbound Telegram messages concurrently within the global and per chat rate limits.
+
+    Callers pass the chat id and a callable that performs the send, and sends for different chats
+    proceed in parallel. Flood control errors pause every send for the requested retry_after, and
+    timeouts or network errors are retried with exponential backoff.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, max_retries: int = 3, backoff: float = 1.0):
+        self.global_limiter = RateLimiter(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_limiters: dict[int, RateLimiter] = {}
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.stats = DispatcherStats()
+
+    def chat_limiter(self, chat_id: int) -> RateLimiter:
+        if len(self.chat_limiters) > 10000:
+            # forget chats whose slots have passed, they would not have to wait anyway
+            now = time.monotonic()
+            self.chat_limiters = {chat: limiter for chat, limiter in self.chat_limiters.items() if limiter.next_slot > now}
+        return self.chat_limiters.setdefault(chat_id, RateLimiter(self.chat_rate))
+
+    async def send(self, chat_id: int, send: Callable[[], Awaitable[T]]) -> T:
+        # partials of bot methods are labelled with the method name
+        with span('telegram', getattr(getattr(send, 'func', send), '__name__', 'send')):
+            return await self._send(chat_id, send)
+
+    async def _send(self, chat_id: int, send: Callable[[], Awaitable[T]]) -> T:
+        start = time.perf_counter()
+        self.stats.pending += 1
+        try:
+            await self.chat_limiter(chat_id).acquire()
+            for attempt in range(self.max_retries + 1):
+                await self.global_limiter.acquire()
+                try:
+                    result = await send()
+                    break
+                except RetryAfter as e:
+                    delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                    # flood control applies to the whole bot, so hold back every chat
+                    self.global_limiter.pause(delay)
+                    if attempt == self.max_retries:
+                        raise
+                except BadRequest:
+                    raise
+                except NetworkError:
+                    if attempt == self.max_retries:
+                        raise
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+                self.stats.retries += 1
+        except Exception:
+            self.stats.failed += 1
+            raise
+        finally:
+            self.stats.pending -= 1
+
+        self.stats.record_latency(time.perf_counter() - start)
+        return result
@@ -1,16 +1,87 @@
+import asyncio
 import json
+import time
 from datetime import datetime, date
 from enum import Enum
 from os import getenv
-from typing import Optional, TypedDict
+from typing import AsyncIterator, Optional, TypedDict
 
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
 from openai.types.chat.completion_create_params import ResponseFormat
 
+from cassette import Cassette
+from metrics import GPT_FIRST_TOKEN_SECONDS, GPT_STREAM_SECONDS, GPT_TOKENS, span
+from prompt_registry import PromptRegistry
+
 load_dotenv()
 
+MODEL = 'gpt-4o-mini'
 PROMPT_DIR = 'prompts'
+# rough number of characters per token, for budgeting prompts without a tokenizer
+CHARS_PER_TOKEN = 4
+PROMPT_PLACEHOLDERS = {
+    'conversation': {'now', 'username'},
+    'extract_all': {'now', 'deadlines'},
+    'create_deadline': {'now'},
+    'create_reminder': {'now'},
+    'extract_deadline_description': set(),
+    'extract_delete_ids': {'now', 'deadlines'},
+    'extract_delete_reminder': {'now'},
+    'extract_fetch_info': {'now'},
+    'extract_update_info': {'now'},
+    'extract_update_reminder': {'now'},
+    'filter_deadlines': {'deadlines'},
+    'intention': set(),
+    'response': {'intention'}
+}
+
+
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def serialize_deadlines(
+        deadlines: list[tuple[int, str, date]],
+        token_budget: Optional[int] = None,
+        today: Optional[date] = None) -> str:
+    """Renders deadlines for a prompt as one id|description|YYYY-MM-DD line each, ordered by due date.
+
+    Past token_budget, the deadlines due closest to today are kept, upcoming ones first on ties,
+    and a last line says how many were left out.
+    """
+    lines = {deadline[0]: f'{deadline[0]}|{" ".join(deadline[1].split())}|{deadline[2].isoformat()}' for deadline in deadlines}
+    kept = deadlines
+    if token_budget is not None and estimate_tokens('\n'.join(lines.values())) > token_budget:
+        today = today or date.today()
+        relevance = sorted(deadlines, key=lambda deadline: (abs((deadline[2] - today).days), deadline[2] < today))
+        kept, used = [], 0
+        for deadline in relevance:
+            used += estimate_tokens(lines[deadline[0]] + '\n')
+            if used > token_budget:
+                break
+            kept.append(deadline)
+
+    text = '\n'.join(lines[deadline[0]] for deadline in sorted(kept, key=lambda deadline: deadline[2]))
+    if len(kept) < len(deadlines):
+        text += f'\n({len(deadlines) - len(kept)} deadlines further from today left out)'
+    return text
+
+
+def window_messages(messages: list, token_budget: Optional[int] = None) -> list:
+    """Drops the oldest messages past token_budget.
+
+    System prompts are not counted and always kept, as is the latest message however long it is.
+    """
+    if token_budget is None:
+        return messages
+    kept, used = [], 0
+    for message in reversed([message for message in messages if message['role'] != 'system']):
+        used += estimate_tokens(message['content'])
+        if kept and used > token_budget:
+            break
+        kept.append(message)
+    return [message for message in messages if message['role'] == 'system'] + kept[::-1]
 
 
 class Intention(Enum):
@@ -79,118 +150,271 @@ class ReminderDeleteType(TypedDict):
     confirmation: bool
 
 
-class GPT:
-    def __init__(self):
-        self.llm = OpenAI(api_key=getenv('OPENAI_KEY'))
+class StructuredExtractionType(TypedDict):
+    action: Intention
+    target: str
+    description: Optional[str]
+    due_date: Optional[str]
+    start_date: Optional[str]
+    end_date: Optional[str]
+    new_description: Optional[str]
+    new_due_date: Optional[str]
+    reminder_time: Optional[str]
+    old_reminder_time: Optional[str]
+    new_reminder_time: Optional[str]
+    ids: list[int]
+    confirmation: bool
+
+
+class StructuredExtraction:
+    """Serves the extraction queries of GPT from a single extract_all_query response.
+
+    Exposes the same query methods the handlers call on GPT, so a handler can use either one.
+    """
+
+    def __init__(self, extraction: StructuredExtractionType):
+        self.extraction = extraction
+        self.intention: IntentionType = {'action': extraction['action'], 'target': extraction.get('target')}
+
+    def _pick(self, *keys: str) -> dict:
+        return {key: self.extraction.get(key) for key in keys}
+
+    async def create_deadline_query(self, messages: list[GPTMessageType]) -> DeadlineCreationType:
+        return self._pick('description', 'due_date', 'confirmation')
+
+    async def extract_fetch_info_query(self, message: str) -> FetchInfoType:
+        return self._pick('description', 'start_date', 'end_date')
+
+    async def extract_delete_ids_query(self, deadlines: list[tuple[int, str, date]], messages: list[GPTMessageType]) -> DeleteIdsType:
+        return {'ids': self.filter_ids(deadlines), 'confirmation': self.extraction.get('confirmation')}
+
+    async def filter_deadlines_query(self, deadlines: list[tuple[int, str, date]], description: str) -> FilterDeadlinesType:
+        return {'ids': self.filter_ids(deadlines)}
+
+    async def extract_deadline_description_query(self, messages: list[GPTMessageType]) -> DeadlineDescriptionType:
+        return {'old_deadline_description': self.extraction.get('description')}
+
+    async def extract_update_info_query(self, messages: list[GPTMessageType]) -> UpdateInfoType:
+        return self._pick('new_description', 'new_due_date', 'confirmation')
 
-    def query(self, messages: list, json: Optional[bool] = False) -> str:
-        completion = self.llm.chat.completions.create(
-            model='gpt-4o-mini',
-            messages=messages,
-            response_format=ResponseFormat(type='json_object') if json else ResponseFormat(type='text')
-        )
-        return completion.choices[0].message.content
+    async def create_reminder_query(self, messages: list[GPTMessageType]) -> ReminderCreationType:
+        return self._pick('reminder_time', 'confirmation')
 
-    def intention_query(self, messages: list[GPTMessageType]) -> IntentionType:
-        with open(f'{PROMPT_DIR}/intention.txt') as infile:
-            prompt = infile.read()
+    async def extract_update_reminder_query(self, messages: list[GPTMessageType]) -> ReminderUpdateType:
+        return self._pick('old_reminder_time', 'new_reminder_time', 'confirmation')
+
+    async def extract_delete_reminder_query(self, messages: list[GPTMessageType]) -> ReminderDeleteType:
+        return self._pick('reminder_time', 'confirmation')
+
+    def filter_ids(self, deadlines: list[tuple[int, str, date]]) -> list[int]:
+        # the ids were matched against every deadline, keep those within the deadlines being filtered
+        deadline_ids = {deadline[0] for deadline in deadlines}
+        return [id for id in self.extraction.get('ids') or [] if id in deadline_ids]
+
+
+class GPT:
+    def __init__(
+            self,
+            max_concurrency: int = 16,
+            timeout: float = 30.0,
+            prompt_watch_interval: Optional[float] = None,
+            llm: Optional[AsyncOpenAI] = None,
+            cassette: Optional[Cassette] = None,
+            deadline_token_budget: Optional[int] = None,
+            conversation_token_budget: Optional[int] = None):
+        self.prompts = PromptRegistry(PROMPT_DIR, prompt_watch_interval)
+        self.prompts.validate(PROMPT_PLACEHOLDERS)
+        # replaying never reaches openai, so it works without a key
+        if llm is None and not (cassette and cassette.replaying):
+            llm = AsyncOpenAI(api_key=getenv('OPENAI_KEY'), timeout=timeout)
+        self.llm = llm
+        self.timeout = timeout
+        # global cap on completions in flight across all chats
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.cassette = cassette
+        self.deadline_token_budget = deadline_token_budget
+        self.conversation_token_budget = conversation_token_budget
+
+    async def query(self, messages: list, json: Optional[bool] = False, prompt: str = '') -> str:
+        messages = window_messages(messages, self.conversation_token_budget)
+        with span('llm', prompt):
+            if self.cassette and self.cassette.replaying:
+                return await self.cassette.replay(MODEL, messages, json)
+
+            async with self.semaphore:
+                self.in_flight += 1
+                start = time.perf_counter()
+                try:
+                    completion = await asyncio.wait_for(self.llm.chat.completions.create(
+                        model=MODEL,
+                        messages=messages,
+                        response_format=ResponseFormat(type='json_object') if json else ResponseFormat(type='text')
+                    ), self.timeout)
+                finally:
+                    self.in_flight -= 1
+        if completion.usage:
+            GPT_TOKENS.inc(completion.usage.prompt_tokens, prompt=prompt, kind='prompt')
+            GPT_TOKENS.inc(completion.usage.completion_tokens, prompt=prompt, kind='completion')
+        content = completion.choices[0].message.content
+        if self.cassette:
+            self.cassette.record(MODEL, messages, json, content, time.perf_counter() - start)
+        return content
+
+    async def stream_query(self, messages: list, prompt: str = '') -> AsyncIterator[str]:
+        """Yields the text of a completion as it is generated.
+
+        Time to the first chunk and to the end of the completion are recorded separately, the
+        timeout applies to each.
+        """
+        messages = window_messages(messages, self.conversation_token_budget)
+        with span('llm', prompt):
+            start = time.perf_counter()
+            if self.cassette and self.cassette.replaying:
+                content = await self.cassette.replay(MODEL, messages, False)
+                GPT_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - start, prompt=prompt)
+                yield content
+                GPT_STREAM_SECONDS.observe(time.perf_counter() - start, prompt=prompt)
+                return
+
+            async with self.semaphore:
+                self.in_flight += 1
+                try:
+                    chunks = (await asyncio.wait_for(self.llm.chat.completions.create(
+                        model=MODEL,
+                        messages=messages,
+                        stream=True,
+                        stream_options={'include_usage': True}
+                    ), self.timeout)).__aiter__()
+                    parts = []
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(chunks.__anext__(), self.timeout)
+                        except StopAsyncIteration:
+                            break
+                        if chunk.usage:
+                            GPT_TOKENS.inc(chunk.usage.prompt_tokens, prompt=prompt, kind='prompt')
+                            GPT_TOKENS.inc(chunk.usage.completion_tokens, prompt=prompt, kind='completion')
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            if not parts:
+                                GPT_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - start, prompt=prompt)
+                            parts.append(chunk.choices[0].delta.content)
+                            yield chunk.choices[0].delta.content
+                finally:
+                    self.in_flight -= 1
+            GPT_STREAM_SECONDS.observe(time.perf_counter() - start, prompt=prompt)
+        if self.cassette:
+            self.cassette.record(MODEL, messages, False, ''.join(parts), time.perf_counter() - start)
+
+    async def intention_query(self, messages: list[GPTMessageType]) -> IntentionType:
+        prompt = self.prompts.render('intention')
 
         messages = messages.copy()
         messages.insert(0, {'role': 'system', 'content': prompt})
-        response = json.loads(self.query(messages, json=True))
+        response = json.loads(await self.query(messages, json=True, prompt='intention'))
         response['action'] = Intention[response.get('action', 'NONE').upper()]
 
         return response
 
-    def response_query(self, intention: IntentionType, message: str) -> str:
-        with open(f'{PROMPT_DIR}/response.txt') as infile:
-            prompt = infile.read() % {'intention': intention['action'].name + ' ' + intention['target']}
+    async def extract_all_query(self, deadlines: list[tuple[int, str, date]], messages: list[GPTMessageType]) -> StructuredExtraction:
+        now = datetime.now().strftime('%I:%M%p on %B %d, %Y')
+        prompt = self.prompts.render(
+            'extract_all', now=now, deadlines=serialize_deadlines(deadlines, self.deadline_token_budget))
+
+        messages = messages.copy()
+        messages.insert(0, {'role': 'system', 'content': prompt})
+        response = json.loads(await self.query(messages, json=True, prompt='extract_all'))
+        response['action'] = Intention[(response.get('action') or 'NONE').upper()]
+
+        return StructuredExtraction(response)
+
+    async def response_query(self, intention: IntentionType, message: str) -> str:
+        prompt = self.prompts.render('response', intention=intention['action'].name + ' ' + intention['target'])
 
         messages = [{'role': 'system', 'content': prompt}, {'role': 'user', 'content': message}]
-        return self.query(messages)
+        return await self.query(messages, prompt='response')
+
+    async def converse_query(self, messages: list[GPTMessageType], username: str) -> str:
+        now = datetime.now().strftime('%I:%M%p on %B %d, %Y')
+        prompt = self.prompts.render('conversation', now=now, username=username)
+
+        messages = messages.copy()
+        messages.insert(0, {'role': 'system', 'content': prompt})
+        return await self.query(messages, prompt='conversation')
 
-    def converse_query(self, messages: list[GPTMessageType], username: str) -> str:
+    def converse_stream(self, messages: list[GPTMessageType], username: str) -> AsyncIterator[str]:
         now = datetime.now().strftime('%I:%M%p on %B %d, %Y')
-        with open(f'{PROMPT_DIR}/conversation.txt') as infile:
-            prompt = infile.read().format(now=now, username=username)
+        prompt = self.prompts.render('conversation', now=now, username=username)
 
         messages = messages.copy()
         messages.insert(0, {'role': 'system', 'content': prompt})
-        return self.query(messages)
+        return self.stream_query(messages, prompt='conversation')
 
-    def create_deadline_query(self, messages: list[GPTMessageType]) -> DeadlineCreationType:
+    async def create_deadline_query(self, messages: list[GPTMessageType]) -> DeadlineCreationType:
         now = datetime.now().strftime('%I:%M%p on %B %d, %Y')
-        with open(f'{PROMPT_DIR}/create_deadline.txt') as infile:
-            prompt = infile.read() % {'now': now}
+        prompt = self.prompts.render('create_deadline', now=now)
 
         messages = messages.copy()
         messages.insert(0, {'role': 'system', 'content': prompt})
-        return json.loads(self.query(messages, json=True))
+        return json.loads(await self.query(messages, json=True, prompt='create_deadline'))
 
-    def extract_fetch_info_query(self, message: str) -> FetchInfoType:
+    async def extract_fetch_info_query(self, message: str) -> FetchInfoType:
         now = datetime.now().strftime('%I:%M%p on %B %d, %Y')
-        with open(f'{PROMPT_DIR}/extract_fetch_info.txt') as infile:
-            prompt = infile.read() % {'now': now}
+        prompt = self.prompts.render('extract_fetch_info', now=now)
 
         messages = [{'role': 'system', 'content': prompt}, {'role': 'user', 'content': message}]
-        return json.loads(self.query(messages, json=True))
+        return json.loads(await self.query(messages, json=True, prompt='extract_fetch_info'))
 
-    def extract_delete_ids_query(self, deadlines: list[tuple[int, str, date]], messages: list[GPTMessageType]) -> DeleteIdsType:
+    async def extract_delete_ids_query(self, deadlines: list[tuple[int, str, date]], messages: list[GPTMessageType]) -> DeleteIdsType:
         now = datetime.now().strftime('%I:%M%p on %B %d, %Y')
-        with open(f'{PROMPT_DIR}/extract_delete_ids.txt') as infile:
-            prompt = infile.read() % {'now': now, 'deadlines': deadlines}
+        prompt = self.prompts.render(
+            'extract_delete_ids', now=now, deadlines=serialize_deadlines(deadlines, self.deadline_token_budget))
 
         messages = messages.copy()
         messages.insert(0, {'role': 'system', 'content': prompt})
-        return json.loads(self.query(messages, json=True))
+        return json.loads(await self.query(messages, json=True, prompt='extract_delete_ids'))
 
-    def filter_deadlines_query(self, deadlines: list[tuple[int, str, date]], description: str) -> FilterDeadlinesType:
-        with open(f'{PROMPT_DIR}/filter_deadlines.txt') as infile:
-            prompt = infile.read() % {'deadlines': deadlines}
+    async def filter_deadlines_query(self, deadlines: list[tuple[int, str, date]], description: str) -> FilterDeadlinesType:
+        prompt = self.prompts.render('filter_deadlines', deadlines=serialize_deadlines(deadlines, self.deadline_token_budget))
 
         messages = [{'role': 'system', 'content': prompt}, {'role': 'user', 'content': description}]
-        return json.loads(self.query(messages, json=True))
+        return json.loads(await self.query(messages, json=True, prompt='filter_deadlines'))
 
-    def extract_deadline_description_query(self, messages: list[GPTMessageType]) -> DeadlineDescriptionType:
-        with open(f'{PROMPT_DIR}/extract_deadline_description.txt') as infile:
-            prompt = infile.read()
+    async def extract_deadline_description_query(self, messages: list[GPTMessageType]) -> DeadlineDescriptionType:
+        prompt = self.prompts.render('extract_deadline_description')
 
         messages = messages.copy()
         messages.insert(0, {'role': 'system', 'content': prompt})
-        return json.loads(self.query(messages, json=True))
+        return json.loads(await self.query(messages, json=True, prompt='extract_deadline_description'))
 
-    def extract_update_info_query(self, messages: list[GPTMessageType]) -> UpdateInfoType:
+    async def extract_update_info_query(self, messages: list[GPTMessageType]) -> UpdateInfoType:
         now = datetime.now().strftime('%I:%M%p on %B %d, %Y')
-        with open(f'{PROMPT_DIR}/extract_update_info.txt') as infile:
-            prompt = infile.read() % {'now': now}
+        prompt = self.prompts.render('extract_update_info', now=now)
 
         messages = messages.copy()
         messages.insert(0, {'role': 'system', 'content': prompt})
-        return json.loads(self.query(messages, json=True))
+        return json.loads(await self.query(messages, json=True, prompt='extract_update_info'))
 
-    def create_reminder_query(self, messages: list[GPTMessageType]) -> ReminderCreationType:
+    async def create_reminder_query(self, messages: list[GPTMessageType]) -> ReminderCreationType:
         now = datetime.now().strftime('%I:%M%p on %B %d, %Y')
-        with open(f'{PROMPT_DIR}/create_reminder.txt') as infile:
-            prompt = infile.read() % {'now': now}
+        prompt = self.prompts.render('create_reminder', now=now)
 
         messages = messages.copy()
         messages.insert(0, {'role': 'system', 'content': prompt})
-        return json.loads(self.query(messages, json=True))
+        return json.loads(await self.query(messages, json=True, prompt='create_reminder'))
 
-    def extract_update_reminder_query(self, messages: list[GPTMessageType]) -> ReminderUpdateType:
+    async def extract_update_reminder_query(self, messages: list[GPTMessageType]) -> ReminderUpdateType:
         now = datetime.now().strftime('%I:%M%p on %B %d, %Y')
-        with open(f'{PROMPT_DIR}/extract_update_reminder.txt') as infile:
-            prompt = infile.read() % {'now': now}
+        prompt = self.prompts.render('extract_update_reminder', now=now)
 
         messages = messages.copy()
         messages.insert(0, {'role': 'system', 'content': prompt})
-        return json.loads(self.query(messages, json=True))
+        return json.loads(await self.query(messages, json=True, prompt='extract_update_reminder'))
 
-    def extract_delete_reminder_query(self, messages: list[GPTMessageType]) -> ReminderDeleteType:
+    async def extract_delete_reminder_query(self, messages: list[GPTMessageType]) -> ReminderDeleteType:
         now = datetime.now().strftime('%I:%M%p on %B %d, %Y')
-        with open(f'{PROMPT_DIR}/extract_delete_reminder.txt') as infile:
-            prompt = infile.read() % {'now': now}
+        prompt = self.prompts.render('extract_delete_reminder', now=now)
 
         messages = messages.copy()
         messages.insert(0, {'role': 'system', 'content': prompt})
-        return json.loads(self.query(messages, json=True))
+        return json.loads(await self.query(messages, json=True, prompt='extract_delete_reminder'))
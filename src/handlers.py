@@ -1,47 +1,119 @@
+import asyncio
 import datetime
+import logging
 import os
+import re
 from collections import defaultdict
+from functools import partial
+from typing import AsyncIterator
 from prettytable import PrettyTable, ALL
 
-from telegram import Update, constants
-from telegram.ext import CallbackContext, ContextTypes
+from telegram import Bot, Update, constants
+from telegram.ext import ContextTypes
 
-from database import PostgresDb
+from database import AsyncPostgresDb
+from deadline_index import DeadlineIndex
+from dispatcher import MessageDispatcher
 from gpt import GPT, Intention
+from intent_classifier import IntentClassifier
+from metrics import traced
+from response_cache import ResponseCache
+from scheduler import ReminderScheduler
+from transcriber import Transcriber, TranscriberBusy
+
+logger = logging.getLogger(__name__)
+
+TABLE_PATTERN = re.compile(r'```\n(.*?)```', re.DOTALL)
+
+
+async def reply(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, **kwargs):
+    dispatcher: MessageDispatcher = context.bot_data['dispatcher']
+    return await dispatcher.send(update.message.chat_id, partial(
+        update.effective_message.reply_text,
+        text,
+        reply_to_message_id=update.message.id,
+        **kwargs))
+
+
+async def stream_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, chunks: AsyncIterator[str], interval: float) -> str:
+    """Replies with the first chunk as soon as it arrives and edits in the rest at most once per interval.
+
+    The stream is read in its own task, so slow edits never hold up the completion. Returns the full text.
+    """
+    dispatcher: MessageDispatcher = context.bot_data['dispatcher']
+    parts = []
+    arrived = asyncio.Event()
+    finished = False
+
+    async def read():
+        nonlocal finished
+        try:
+            async for chunk in chunks:
+                parts.append(chunk)
+                arrived.set()
+        finally:
+            finished = True
+            arrived.set()
+
+    reader = asyncio.create_task(read())
+    message, sent = None, ''
+    try:
+        done = False
+        while not done:
+            await arrived.wait()
+            arrived.clear()
+            done = finished
+            text = ''.join(parts)
+            if text.strip() and text != sent:
+                if message is None:
+                    message = await reply(update, context, text)
+                else:
+                    await dispatcher.send(update.message.chat_id, partial(message.edit_text, text))
+                sent = text
+            if not done:
+                await asyncio.sleep(interval)
+    finally:
+        if not reader.done():
+            reader.cancel()
+    await reader
+    return ''.join(parts)
 
 
+@traced
 async def handle_unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.effective_message.reply_text(
-        'Available commands:\n/start: Create a new account with your telegram handle as your username.',
-        reply_to_message_id=update.message.id)
+    await reply(update, context, 'Available commands:\n/start: Create a new account with your telegram handle as your username.')
 
 
+@traced
 async def handle_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db: PostgresDb = context.bot_data['db']
-    if db.account_exists_query(update.message.chat_id):
-        await update.effective_message.reply_text(
-            'You have already created an account.',
-            reply_to_message_id=update.message.id)
+    db: AsyncPostgresDb = context.bot_data['db']
+    if await db.account_exists_query(update.message.chat_id):
+        await reply(update, context, 'You have already created an account.')
         return
 
     username = update.message.from_user.username
-    db.create_user_account_query(username, update.message.chat_id)
-    await update.effective_message.reply_text(
+    await db.create_user_account_query(username, update.message.chat_id)
+    await reply(
+        update,
+        context,
         f'Welcome {username}! Let me know of any deadlines you may have and I will help you keep track of them! '
-        'Reminders for any deadlines will be sent a day before the due date at 8am.',
-        reply_to_message_id=update.message.id)
+        'Reminders for any deadlines will be sent a day before the due date at 8am.')
 
 
+@traced
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    whisper = context.bot_data['whisper']
+    transcriber: Transcriber = context.bot_data['transcriber']
     voice_file = await context.bot.get_file(update.message.voice.file_id)
     filename = f'{update.message.voice.file_id}.ogg'
     try:
         await voice_file.download_to_drive(filename)
-        segments, _ = whisper.transcribe(filename)
-        speech = ''.join(map(lambda x: x.text, segments)).strip()
-        await update.message.reply_text(f"<i>Heard: \"{speech}\"</i>", parse_mode=constants.ParseMode.HTML,
-                                        reply_to_message_id=update.message.id)
+        try:
+            speech = await transcriber.transcribe(filename)
+        except TranscriberBusy:
+            await reply(update, context, 'I am busy processing other voice messages right now, please try again in a moment.')
+            return
+
+        await reply(update, context, f"<i>Heard: \"{speech}\"</i>", parse_mode=constants.ParseMode.HTML)
         await handle_query(update, context, speech)
 
     finally:
@@ -49,13 +121,14 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
             os.remove(filename)
 
 
+@traced
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await handle_query(update, context, update.message.text)
 
 
 async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE, user_msg: str):
-    def create_deadline():
-        deadline = gpt.create_deadline_query(messages)
+    async def create_deadline():
+        deadline = await extractor.create_deadline_query(messages)
 
         if not deadline.get('description'):
             response['text'] = 'Please provide a specific description for the deadline you want to create.'
@@ -73,21 +146,22 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE, user_
             response['parse_mode'] = constants.ParseMode.MARKDOWN_V2
             return
 
-        if db.deadline_exists_query(chat_id, deadline['description']):
+        if await db.deadline_exists_query(chat_id, deadline['description']):
             response['text'] = 'Cannot create deadline as deadline already exists.'
             return
 
-        deadline_id = db.create_deadline_query(chat_id, deadline['description'], due_date)
+        deadline_id = await db.create_deadline_query(chat_id, deadline['description'], due_date)
+        deadline_index.add(chat_id, deadline_id, deadline['description'])
         reminder_timestamp = datetime.datetime.combine(due_date, datetime.time(8)) - datetime.timedelta(days=1)
         response['text'] = 'Your deadline has been saved.'
 
         if reminder_timestamp > datetime.datetime.now():
-            db.create_reminders_query(deadline_id, reminder_timestamp)
+            scheduler.schedule(await db.create_reminders_query(deadline_id, reminder_timestamp), reminder_timestamp)
             response['text'] += f' You will be reminded at {reminder_timestamp.strftime("%a %d %b %Y, %H:%M")}'
 
-    def read_deadline():
-        deadline_info = gpt.extract_fetch_info_query(user_msg)
-        deadlines = db.fetch_deadlines_query(chat_id, deadline_info.get('start_date'), deadline_info.get('end_date'))
+    async def read_deadline():
+        deadline_info = await extractor.extract_fetch_info_query(user_msg)
+        deadlines = await db.fetch_deadlines_query(chat_id, deadline_info.get('start_date'), deadline_info.get('end_date'))
 
         if not deadlines:
             if deadline_info.get('start_date') or deadline_info.get('end_date'):
@@ -101,22 +175,22 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE, user_
             response['parse_mode'] = constants.ParseMode.MARKDOWN_V2
             return
 
-        deadline_ids = gpt.filter_deadlines_query(deadlines, deadline_info['description']).get('ids', [])
+        deadline_ids = await filter_deadlines(deadlines, deadline_info['description'])
         if not deadline_ids:
             response['text'] = 'No deadlines matched your query.'
             return
 
-        filtered_deadlines = db.fetch_deadlines_query_by_ids(deadline_ids)
+        filtered_deadlines = await db.fetch_deadlines_query_by_ids(deadline_ids)
         response['text'] = f'```\n{create_deadline_table(filtered_deadlines)}```'
         response['parse_mode'] = constants.ParseMode.MARKDOWN_V2
 
-    def update_deadline():
-        deadline = extract_deadline()
+    async def update_deadline():
+        deadline = await extract_deadline()
         if not deadline:
             return
 
         # Extract new description or new due date of the deadline
-        update_info = gpt.extract_update_info_query(messages)
+        update_info = await extractor.extract_update_info_query(messages)
 
         if not update_info.get('new_description') and not update_info.get('new_due_date'):
             response['text'] = 'Please provide a new description or due date for the deadline you want to update.'
@@ -134,59 +208,63 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE, user_
             response['parse_mode'] = constants.ParseMode.MARKDOWN_V2
             return
 
-        if new_desc != deadline[1] and db.deadline_exists_query(chat_id, new_desc):
+        if new_desc != deadline[1] and await db.deadline_exists_query(chat_id, new_desc):
             response['text'] = 'Cannot update deadline as new deadline description already exists.'
             return
 
-        db.update_deadline_query(deadline[0], new_desc, new_date)
+        await db.update_deadline_query(deadline[0], new_desc, new_date)
+        deadline_index.update(chat_id, deadline[0], new_desc)
         response['text'] = 'Updated deadline.'
 
         # Update old reminder for deadline at 8am to new deadline if due date has changed
         if new_date != deadline[2]:
-            old_reminder = db.fetch_reminder_query(
+            old_reminder = await db.fetch_reminder_query(
                 deadline[0],
                 datetime.datetime.combine(deadline[2], datetime.time(8)) - datetime.timedelta(days=1))
             new_reminder_time = datetime.datetime.combine(new_date, datetime.time(8)) - datetime.timedelta(days=1)
 
             if new_reminder_time > datetime.datetime.now():
                 if old_reminder:
-                    db.update_reminder_query(old_reminder[0], new_reminder_time)
+                    await db.update_reminder_query(old_reminder[0], new_reminder_time)
+                    scheduler.schedule(old_reminder[0], new_reminder_time)
                     response['text'] += f' Reminder has been updated to {new_reminder_time.strftime("%a %d %b %Y, %H:%M")}.'
                 else:
-                    db.create_reminders_query(deadline[0], new_reminder_time)
+                    scheduler.schedule(await db.create_reminders_query(deadline[0], new_reminder_time), new_reminder_time)
                     response['text'] += f' Reminder has been created on {new_reminder_time.strftime("%a %d %b %Y, %H:%M")}.'
             elif old_reminder:
-                db.delete_reminder_query(old_reminder[0])
+                await db.delete_reminder_query(old_reminder[0])
+                scheduler.cancel(old_reminder[0])
 
-    def delete_deadline():
-        deadlines = db.fetch_deadlines_query(chat_id)
+    async def delete_deadline():
+        deadlines = await db.fetch_deadlines_query(chat_id)
 
         if not deadlines:
             response['text'] = 'There are no deadlines in the database to delete.'
             return
 
-        delete_ids = gpt.extract_delete_ids_query(deadlines, messages)
+        delete_ids = await extractor.extract_delete_ids_query(deadlines, messages)
 
         if not delete_ids.get('ids'):
             response['text'] = 'No deadlines matched your query.'
             return
 
         if not delete_ids.get('confirmation'):
-            deadlines_to_delete = db.fetch_deadlines_query_by_ids(delete_ids['ids'])
+            deadlines_to_delete = await db.fetch_deadlines_query_by_ids(delete_ids['ids'])
             response['text'] = (f'Are you sure to delete the following deadlines:'
                                 f'```\n{create_deadline_table(deadlines_to_delete)}```')
             response['parse_mode'] = constants.ParseMode.MARKDOWN_V2
             return
 
-        deleted = db.delete_deadlines_query(delete_ids['ids'])
+        deleted = await db.delete_deadlines_query(delete_ids['ids'])
+        deadline_index.remove(chat_id, delete_ids['ids'])
         response['text'] = f'Deleted {len(deleted)} deadlines.'
 
-    def create_reminder():
-        deadline = extract_deadline()
+    async def create_reminder():
+        deadline = await extract_deadline()
         if not deadline:
             return
 
-        reminder = gpt.create_reminder_query(messages)
+        reminder = await extractor.create_reminder_query(messages)
 
         if not reminder.get('reminder_time'):
             response['text'] = (f'Please provide a specific date and time you want to be reminded of '
@@ -205,12 +283,12 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE, user_
             response['parse_mode'] = constants.ParseMode.MARKDOWN_V2
             return
 
-        db.create_reminders_query(deadline[0], reminder_time)
+        scheduler.schedule(await db.create_reminders_query(deadline[0], reminder_time), reminder_time)
         response['text'] = 'Your reminder has been created.'
 
-    def read_reminder():
-        deadline_info = gpt.extract_fetch_info_query(user_msg)
-        deadlines = db.fetch_deadlines_query(chat_id, deadline_info.get('start_date'), deadline_info.get('end_date'))
+    async def read_reminder():
+        deadline_info = await extractor.extract_fetch_info_query(user_msg)
+        deadlines = await db.fetch_deadlines_query(chat_id, deadline_info.get('start_date'), deadline_info.get('end_date'))
 
         if not deadlines:
             if deadline_info.get('start_date') or deadline_info.get('end_date'):
@@ -220,30 +298,30 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE, user_
             return
 
         if not deadline_info.get('description'):
-            reminders = db.fetch_reminders_query_by_deadline_ids([deadline[0] for deadline in deadlines])
+            reminders = await db.fetch_reminders_query_by_deadline_ids([deadline[0] for deadline in deadlines])
             response['text'] = f'```\n{create_reminder_table(reminders)}```'
             response['parse_mode'] = constants.ParseMode.MARKDOWN_V2
             return
 
-        deadline_ids = gpt.filter_deadlines_query(deadlines, deadline_info['description']).get('ids', [])
+        deadline_ids = await filter_deadlines(deadlines, deadline_info['description'])
         if not deadline_ids:
             response['text'] = 'No deadlines matched your query.'
             return
 
-        reminders = db.fetch_reminders_query_by_deadline_ids(deadline_ids)
+        reminders = await db.fetch_reminders_query_by_deadline_ids(deadline_ids)
         response['text'] = f'```\n{create_reminder_table(reminders)}```'
         response['parse_mode'] = constants.ParseMode.MARKDOWN_V2
 
-    def update_reminder():
-        deadline = extract_deadline()
+    async def update_reminder():
+        deadline = await extract_deadline()
         if not deadline:
             return
 
         # Extract old and new reminder times
-        update_info = gpt.extract_update_reminder_query(messages)
+        update_info = await extractor.extract_update_reminder_query(messages)
 
         if not update_info.get('old_reminder_time'):
-            reminders = db.fetch_reminders_query_by_deadline_ids([deadline[0]])
+            reminders = await db.fetch_reminders_query_by_deadline_ids([deadline[0]])
             response['text'] = (f'Please provide the specific reminder time you want to update from the following '
                                 f'reminders:```\n{create_reminder_table(reminders)}```')
             response['parse_mode'] = constants.ParseMode.MARKDOWN_V2
@@ -255,7 +333,7 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE, user_
             response['text'] = 'Cannot update reminder as old reminder time is in the past.'
             return
 
-        reminder = db.fetch_reminder_query(deadline[0], old_reminder_time)
+        reminder = await db.fetch_reminder_query(deadline[0], old_reminder_time)
         if not reminder:
             response['text'] = 'No reminders matched your query.'
             return
@@ -275,19 +353,20 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE, user_
             response['parse_mode'] = constants.ParseMode.MARKDOWN_V2
             return
 
-        if db.fetch_reminder_query(deadline[0], new_reminder_time):
+        if await db.fetch_reminder_query(deadline[0], new_reminder_time):
             response['text'] = 'Cannot update reminder as new reminder already exists.'
             return
 
-        db.update_reminder_query(reminder[0], new_reminder_time)
+        await db.update_reminder_query(reminder[0], new_reminder_time)
+        scheduler.schedule(reminder[0], new_reminder_time)
         response['text'] = 'Updated reminder.'
 
-    def delete_reminder():
-        deadline = extract_deadline()
+    async def delete_reminder():
+        deadline = await extract_deadline()
         if not deadline:
             return
 
-        delete_info = gpt.extract_delete_reminder_query(messages)
+        delete_info = await extractor.extract_delete_reminder_query(messages)
 
         if not delete_info.get('reminder_time'):
             response['text'] = 'Please provide a reminder time for the reminder you want to delete.'
@@ -304,35 +383,67 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE, user_
             response['parse_mode'] = constants.ParseMode.MARKDOWN_V2
             return
 
-        reminder = db.fetch_reminder_query(deadline[0], reminder_time)
+        reminder = await db.fetch_reminder_query(deadline[0], reminder_time)
         if not reminder:
-            reminders = db.fetch_reminders_query_by_deadline_ids([deadline[0]])
+            reminders = await db.fetch_reminders_query_by_deadline_ids([deadline[0]])
             response['text'] = (f'Cannot delete reminder as reminder does not exist\. Please provide the specific '
                                 f'reminder time you want to delete from the following reminders:'
                                 f'```\n{create_reminder_table(reminders)}```')
             response['parse_mode'] = constants.ParseMode.MARKDOWN_V2
             return
 
-        db.delete_reminder_query(reminder[0])
+        await db.delete_reminder_query(reminder[0])
+        scheduler.cancel(reminder[0])
         response['text'] = 'Deleted reminder.'
 
-    def converse():
-        response['text'] = gpt.converse_query(messages, update.message.from_user.username)
+    async def converse():
+        if context.bot_data.get('stream_interval') is None:
+            response['text'] = await gpt.converse_query(messages, update.message.from_user.username)
+            return
+        response['text'] = await stream_reply(
+            update, context, gpt.converse_stream(messages, update.message.from_user.username),
+            context.bot_data['stream_interval'])
+        response['streamed'] = True
+
+    async def filter_deadlines(deadlines, description):
+        if extractor is not gpt:
+            return (await extractor.filter_deadlines_query(deadlines, description)).get('ids', [])
 
-    def extract_deadline():
-        deadlines = db.fetch_deadlines_query(chat_id)
+        if not deadline_index.loaded(chat_id):
+            deadline_index.load(chat_id, await db.fetch_deadlines_query(chat_id))
+
+        # only ask the LLM to pick between the closest candidates when the match is ambiguous
+        deadline_ids, candidates = deadline_index.resolve(chat_id, description, deadlines)
+        if deadline_ids or not candidates:
+            return deadline_ids
+        return (await gpt.filter_deadlines_query(candidates, description)).get('ids', [])
+
+    async def extraction_deadlines():
+        if intention and intention['action'] == Intention.CREATE and intention['target'] == 'deadline':
+            # a new deadline is never referred to by id
+            return []
+
+        deadlines = await db.fetch_deadlines_query(chat_id)
+        if not deadline_index.loaded(chat_id):
+            deadline_index.load(chat_id, deadlines)
+        # follow ups such as a confirmation name the deadline in an earlier message
+        recent = ' '.join([message['content'] for message in messages if message['role'] == 'user'][-3:])
+        return deadline_index.shortlist(chat_id, recent, deadlines)
+
+    async def extract_deadline():
+        deadlines = await db.fetch_deadlines_query(chat_id)
 
         if not deadlines:
             response['text'] = 'There are no deadlines in the database to update.'
             return
 
-        deadline_info = gpt.extract_deadline_description_query(messages)
+        deadline_info = await extractor.extract_deadline_description_query(messages)
 
         if not deadline_info.get('old_deadline_description'):
             response['text'] = 'Please provide a specific description of the deadline you want to update.'
             return
 
-        deadline_ids = gpt.filter_deadlines_query(deadlines, deadline_info['old_deadline_description']).get('ids', [])
+        deadline_ids = await filter_deadlines(deadlines, deadline_info['old_deadline_description'])
 
         # Check if description provided exists in the database
         if not deadline_ids:
@@ -344,23 +455,36 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE, user_
                                 'the deadline you want to update.')
             return
 
-        return db.fetch_deadlines_query_by_ids(deadline_ids)[0]
+        return (await db.fetch_deadlines_query_by_ids(deadline_ids))[0]
 
-    db: PostgresDb = context.bot_data['db']
+    db: AsyncPostgresDb = context.bot_data['db']
     gpt: GPT = context.bot_data['gpt']
+    classifier: IntentClassifier = context.bot_data['intent_classifier']
+    deadline_index: DeadlineIndex = context.bot_data['deadline_index']
+    scheduler: ReminderScheduler = context.bot_data['scheduler']
+    response_cache: ResponseCache = context.bot_data['response_cache']
     chat_id = update.message.chat_id
-    if not db.account_exists_query(chat_id):
-        await update.effective_message.reply_text(
-            'You need to first create an account with the /start command.',
-            reply_to_message_id=update.message.id)
+    if not await db.account_exists_query(chat_id):
+        await reply(update, context, 'You need to first create an account with the /start command.')
         return
 
-    history = db.fetch_latest_messages_query(chat_id)
+    history = await db.fetch_latest_messages_query(chat_id)
     messages = [{'role': 'user' if msg[1] else 'assistant', 'content': msg[0]} for msg in history]
     messages.append({'role': 'user', 'content': user_msg})
-    db.create_message_query(chat_id, user_msg, True)
-    intention = gpt.intention_query(messages)
-    response = {'text': '', 'parse_mode': ''}
+    await db.create_message_query(chat_id, user_msg, True)
+
+    extractor = gpt
+    intention = classifier.classify(messages)
+    if context.bot_data['pipeline_mode'] == 'single' and (
+            intention is None or (intention['action'] != Intention.NONE and intention.get('target'))):
+        # one completion extracts the intention and every field the handlers need
+        extractor = await gpt.extract_all_query(await extraction_deadlines(), messages)
+        intention = extractor.intention
+    elif intention is None:
+        intention = await gpt.intention_query(messages)
+    elif classifier.should_shadow():
+        context.application.create_task(classifier.shadow_check(gpt, messages.copy(), intention))
+    response = {'text': '', 'parse_mode': '', 'streamed': False}
 
     if intention.get('target') == 'deadline':
         action_map = {
@@ -370,7 +494,7 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE, user_
             Intention.DELETE: delete_deadline,
             Intention.NONE: converse
         }
-        action_map.get(intention['action'], converse)()
+        await action_map.get(intention['action'], converse)()
 
     elif intention.get('target') == 'reminder':
         action_map = {
@@ -380,20 +504,21 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE, user_
             Intention.DELETE: delete_reminder,
             Intention.NONE: converse
         }
-        action_map.get(intention['action'], converse)()
+        await action_map.get(intention['action'], converse)()
 
     else:
-        converse()
+        await converse()
 
-    if response['text']:
+    if response['text'] and response['streamed']:
+        # the user has already seen it as it was generated
+        await db.create_message_query(chat_id, response['text'], False)
+    elif response['text']:
         if not response['parse_mode']:
-            response['text'] = gpt.response_query(intention, response['text'])
+            response['text'] = await response_cache.phrase(gpt, intention, response['text'])
 
-        db.create_message_query(chat_id, response['text'], False)
-        await update.effective_message.reply_text(
-            response['text'],
-            parse_mode=response['parse_mode'] or None,
-            reply_to_message_id=update.message.id)
+        # the user sees the full table, later prompts get the rows in a fraction of the tokens
+        await db.create_message_query(chat_id, compact_tables(response['text']), False)
+        await reply(update, context, response['text'], parse_mode=response['parse_mode'] or None)
 
 
 def create_deadline_table(deadlines: list[tuple[int, str, datetime.date]]) -> str:
@@ -415,17 +540,54 @@ def create_reminder_table(reminders: list[tuple[str, list[datetime]]]) -> str:
     return table.get_string()
 
 
-async def reminder_callback(context: CallbackContext):
-    db: PostgresDb = context.bot_data['db']
-    deadlines = db.fetch_reminders_query(datetime.datetime.now().replace(microsecond=0, second=0))
+def compact_tables(text: str) -> str:
+    """Rewrites the tables in a reply as a header line and one line per row, with cells separated by |."""
+    def compact(match: re.Match) -> str:
+        rows = []
+        cells = None
+        for line in match.group(1).splitlines():
+            if line.startswith('+'):
+                if cells:
+                    rows.append('|'.join('; '.join(' '.join(paragraph) for paragraph in cell if paragraph) for cell in cells))
+                cells = None
+            elif line.startswith('|'):
+                parts = [part.strip() for part in line.strip().strip('|').split('|')]
+                cells = cells or [[[]] for _ in parts]
+                for cell, part in zip(cells, parts):
+                    # wrapped lines continue a cell, blank lines separate the values of one cell
+                    if part:
+                        cell[-1].append(part)
+                    elif cell[-1]:
+                        cell.append([])
+        return '\n' + '\n'.join(rows) + '\n'
+
+    return TABLE_PATTERN.sub(compact, text).strip()
+
+
+async def reminder_callback(bot: Bot, db: AsyncPostgresDb, dispatcher: MessageDispatcher, reminder_ids: list[int]) -> list[int]:
+    """Sends the reminders grouped by chat, returning the ids of those that reached their chat."""
+    deadlines = await db.fetch_reminders_query_by_ids(reminder_ids)
 
     user_deadlines = defaultdict(list)
+    user_reminders = defaultdict(list)
     for deadline in deadlines:
-        user_deadlines[deadline[0]].append(deadline[1:])
+        user_deadlines[deadline[0]].append(deadline[1:4])
+        user_reminders[deadline[0]].append(deadline[4])
 
+    sends = []
     for chat_id, deadlines in user_deadlines.items():
         text = f'This is a reminder for the following deadlines:```\n{create_deadline_table(deadlines)}```'
-        await context.bot.sendMessage(
+        sends.append(dispatcher.send(chat_id, partial(
+            bot.sendMessage,
             chat_id,
             text=text,
-            parse_mode=constants.ParseMode.MARKDOWN_V2)
+            parse_mode=constants.ParseMode.MARKDOWN_V2)))
+
+    # one chat failing, e.g. after blocking the bot, should not stop the others from being reminded
+    sent = []
+    for chat_id, result in zip(user_deadlines, await asyncio.gather(*sends, return_exceptions=True)):
+        if isinstance(result, Exception):
+            logger.error('Failed to send reminder to chat %s: %s', chat_id, result)
+        else:
+            sent += user_reminders[chat_id]
+    return sent
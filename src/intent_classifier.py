@@ -0,0 +1,192 @@
+import math
+import random
+import re
+from collections import Counter, defaultdict
+from typing import Optional
+
+from gpt import GPT, GPTMessageType, Intention, IntentionType
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+ACTION_KEYWORDS = {
+    Intention.CREATE: {'create', 'add', 'new', 'make', 'schedule', 'remember', 'track', 'save'},
+    Intention.READ: {'show', 'list', 'what', 'when', 'which', 'see', 'view', 'display', 'check'},
+    Intention.UPDATE: {'change', 'update', 'edit', 'modify', 'move', 'postpone', 'reschedule', 'rename', 'extend',
+                       'delay', 'shift'},
+    Intention.DELETE: {'delete', 'remove', 'cancel', 'clear', 'completed', 'finished', 'done', 'drop'}
+}
+TARGET_KEYWORDS = {
+    # checked in order, a message mentioning a reminder for a submission targets the reminder
+    'reminder': {'reminder', 'reminders', 'remind', 'notification', 'notifications', 'notify'},
+    'deadline': {'deadline', 'deadlines', 'due', 'submission', 'submissions', 'assignment', 'assignments',
+                 'project', 'projects', 'homework', 'lab', 'milestone'}
+}
+# phrases in a bot reply that mean the user is answering a question mid-flow, where the intention
+# depends on the conversation history and only the LLM prompt knows how to resolve it
+FOLLOW_UP_PATTERN = re.compile(r'\?|are you sure|please provide', re.IGNORECASE)
+
+TRAINING_EXAMPLES = [
+    ('I have a project submission due soon, can you help me create a deadline for that?', 'CREATE deadline'),
+    ('Add a deadline for my CS2030S lab 3 on Friday', 'CREATE deadline'),
+    ('Create a new deadline for the orbital milestone due next Monday', 'CREATE deadline'),
+    ('Help me keep track of my essay submission due on 3 March', 'CREATE deadline'),
+    ('When is my orbital submission due?', 'READ deadline'),
+    ('What deadlines do I have next week?', 'READ deadline'),
+    ('Show my deadlines for this month', 'READ deadline'),
+    ('List all my deadlines', 'READ deadline'),
+    ('Can you help me change the due date for one of my deadlines?', 'UPDATE deadline'),
+    ('Move my CS2030S lab deadline to next Friday', 'UPDATE deadline'),
+    ('Rename my project deadline to final report submission', 'UPDATE deadline'),
+    ('I have completed my submission for my orbital milestone. Can you remove it?', 'DELETE deadline'),
+    ('Delete my CS2030S lab 3 deadline', 'DELETE deadline'),
+    ('Remove all my deadlines', 'DELETE deadline'),
+    ('Can you create a reminder for my submission?', 'CREATE reminder'),
+    ('Remind me about my lab submission tomorrow at 9pm', 'CREATE reminder'),
+    ('Add another reminder for my project two days before it is due', 'CREATE reminder'),
+    ('When is the reminder for my orbital submission?', 'READ reminder'),
+    ('Show me my upcoming reminders', 'READ reminder'),
+    ('What reminders do I have?', 'READ reminder'),
+    ('Could you postpone my reminder to next Sunday?', 'UPDATE reminder'),
+    ('Change my lab reminder to 8pm', 'UPDATE reminder'),
+    ('Move the reminder for my essay to Friday morning', 'UPDATE reminder'),
+    ('I want to remove all of my reminders.', 'DELETE reminder'),
+    ('Delete my CS2030S reminder', 'DELETE reminder'),
+    ('Cancel the reminder for my project', 'DELETE reminder'),
+    ('Delete the reminder for my lab', 'DELETE reminder'),
+    ('Remove my reminder for the CS2030S lab', 'DELETE reminder'),
+    ('Hello, how are you?', 'NONE'),
+    ('Thanks for the help!', 'NONE'),
+    ('What can you do?', 'NONE'),
+    ('Tell me a joke', 'NONE'),
+    ('Who are you?', 'NONE'),
+    ('Good morning', 'NONE')
+]
+
+
+def tokenize(text: str) -> list[str]:
+    words = TOKEN_PATTERN.findall(text.lower())
+    return words + [f'{first} {second}' for first, second in zip(words, words[1:])]
+
+
+def label_to_intention(label: str) -> IntentionType:
+    action, _, target = label.partition(' ')
+    return {'action': Intention[action], 'target': target or 'none'}
+
+
+class IntentStats:
+    def __init__(self):
+        self.hits = 0
+        self.fallbacks = 0
+        self.shadow_checked = 0
+        self.shadow_agreed = 0
+
+    def as_dict(self) -> dict:
+        total = self.hits + self.fallbacks
+        return {
+            'hits': self.hits,
+            'fallbacks': self.fallbacks,
+            'hit_rate': self.hits / total if total else 0.0,
+            'shadow_checked': self.shadow_checked,
+            'shadow_accuracy': self.shadow_agreed / self.shadow_checked if self.shadow_checked else 0.0
+        }
+
+
+class IntentClassifier:
+    """Keyword rules plus a naive Bayes model that answer obvious intentions without an LLM call.
+
+    A prediction is only returned when the rules and the model agree and the model's posterior
+    reaches the threshold, otherwise the caller falls back to GPT.intention_query. A shadow rate
+    re-checks that fraction of local answers against the LLM to measure accuracy in production.
+    """
+
+    def __init__(self, threshold: float = 0.8, shadow_rate: float = 0.0,
+                 examples: Optional[list[tuple[str, str]]] = None):
+        self.threshold = threshold
+        self.shadow_rate = shadow_rate
+        self.stats = IntentStats()
+        self.fit(examples or TRAINING_EXAMPLES)
+
+    def fit(self, examples: list[tuple[str, str]]):
+        label_counts = Counter(label for _, label in examples)
+        token_counts: dict[str, Counter] = defaultdict(Counter)
+        for text, label in examples:
+            token_counts[label].update(tokenize(text))
+        self.vocabulary = {token for counts in token_counts.values() for token in counts}
+
+        # precompute laplace smoothed log probabilities so prediction is only lookups and sums
+        self.log_priors = {label: math.log(count / len(examples)) for label, count in label_counts.items()}
+        self.log_likelihoods: dict[str, dict[str, float]] = {}
+        self.log_unseen: dict[str, float] = {}
+        for label, counts in token_counts.items():
+            log_denominator = math.log(sum(counts.values()) + len(self.vocabulary))
+            self.log_likelihoods[label] = {token: math.log(count + 1) - log_denominator for token, count in counts.items()}
+            self.log_unseen[label] = -log_denominator
+
+    def posteriors(self, text: str) -> dict[str, float]:
+        tokens = [token for token in tokenize(text) if token in self.vocabulary]
+        log_probs = {}
+        for label, log_prior in self.log_priors.items():
+            likelihoods, unseen = self.log_likelihoods[label], self.log_unseen[label]
+            log_probs[label] = log_prior + sum(likelihoods.get(token, unseen) for token in tokens)
+
+        peak = max(log_probs.values())
+        exp_probs = {label: math.exp(log_prob - peak) for label, log_prob in log_probs.items()}
+        norm = sum(exp_probs.values())
+        return {label: prob / norm for label, prob in exp_probs.items()}
+
+    @staticmethod
+    def rules(text: str) -> Optional[str]:
+        words = set(TOKEN_PATTERN.findall(text.lower()))
+        actions = [action for action, keywords in ACTION_KEYWORDS.items() if words & keywords]
+        targets = [target for target, keywords in TARGET_KEYWORDS.items() if words & keywords]
+
+        if not actions and not targets:
+            return 'NONE'
+        if len(actions) == 1 and targets:
+            return f'{actions[0].name} {targets[0]}'
+        return None
+
+    def predict(self, text: str) -> tuple[Optional[IntentionType], float]:
+        rule_label = self.rules(text)
+        if rule_label is None:
+            return None, 0.0
+
+        confidence = self.posteriors(text).get(rule_label, 0.0)
+        return label_to_intention(rule_label), confidence
+
+    def classify(self, messages: list[GPTMessageType]) -> Optional[IntentionType]:
+        if len(messages) > 1 and messages[-2]['role'] == 'assistant' and FOLLOW_UP_PATTERN.search(messages[-2]['content']):
+            self.stats.fallbacks += 1
+            return None
+
+        intention, confidence = self.predict(messages[-1]['content'])
+        if intention is None or confidence < self.threshold:
+            self.stats.fallbacks += 1
+            return None
+
+        self.stats.hits += 1
+        return intention
+
+    def should_shadow(self) -> bool:
+        return self.shadow_rate > 0 and random.random() < self.shadow_rate
+
+    async def shadow_check(self, gpt: GPT, messages: list[GPTMessageType], intention: IntentionType):
+        actual = await gpt.intention_query(messages)
+        self.stats.shadow_checked += 1
+        if actual['action'] == intention['action'] and (
+                intention['action'] == Intention.NONE or actual.get('target') == intention['target']):
+            self.stats.shadow_agreed += 1
+
+    def evaluate(self, examples: list[tuple[list[GPTMessageType], IntentionType]]) -> dict:
+        """Coverage and accuracy of the local fast path over labelled conversations."""
+        covered = correct = 0
+        for messages, expected in examples:
+            intention, confidence = self.predict(messages[-1]['content'])
+            if intention is not None and confidence >= self.threshold:
+                covered += 1
+                correct += intention == expected
+
+        return {
+            'coverage': covered / len(examples) if examples else 0.0,
+            'accuracy': correct / covered if covered else 0.0
+        }
@@ -0,0 +1,243 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import logging
+import math
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple[str, ...], object] = {}
+
+    def key(self, labels: dict) -> tuple[str, ...]:
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def label_text(self, key: tuple[str, ...], extra: tuple[tuple[str, str], ...] = ()) -> str:
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{label}="{escape(value)}"' for label, value in pairs) + '}'
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}'] + self.samples()
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value: float = 1.0, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0.0) + value
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{self.label_text(key)} {format_value(value)}' for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * len(self.buckets), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{self.label_text(key, (("le", format_value(bound)),))} {cumulative}')
+            lines.append(f'{self.name}_sum{self.label_text(key)} {format_value(total)}')
+            lines.append(f'{self.name}_count{self.label_text(key)} {cumulative}')
+        return lines
+
+
+class StatsGauges(Metric):
+    """Exposes the numeric values of a component's stats dict as one gauge each, read on scrape."""
+
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, stats: Callable[[], dict]):
+        super().__init__(name, help)
+        self.stats = stats
+
+    def render(self) -> str:
+        lines = []
+        for key, value in self.stats().items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines += [f'# HELP {self.name}_{key} {self.help}', f'# TYPE {self.name}_{key} gauge',
+                          f'{self.name}_{key} {format_value(value)}']
+        return '\n'.join(lines) + '\n' if lines else ''
+
+
+class Registry:
+    """Metrics by unique name, rendered after those of parent.
+
+    A registry per bot instance keeps the stats of each instance apart, with the process-wide
+    histograms and counters shared through the parent.
+    """
+
+    def __init__(self, parent: Optional['Registry'] = None):
+        self.parent = parent
+        self.metrics: dict[str, Metric] = {}
+
+    def names(self) -> set[str]:
+        return set(self.metrics) | (self.parent.names() if self.parent else set())
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.names():
+            raise ValueError(f'Duplicate metric {metric.name}')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return (self.parent.render() if self.parent else '') + ''.join(metric.render() for metric in self.metrics.values())
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'telebot_stage_seconds', 'Time spent in each stage of handling an update.', ('stage', 'name')))
+STAGE_ERRORS = REGISTRY.register(Counter(
+    'telebot_stage_errors_total', 'Stages that raised an exception.', ('stage', 'name')))
+UPDATE_SECONDS = REGISTRY.register(Histogram(
+    'telebot_update_seconds', 'Time to handle an update end to end.', ('handler',)))
+GPT_TOKENS = REGISTRY.register(Counter(
+    'telebot_gpt_tokens_total', 'Tokens used by completions.', ('prompt', 'kind')))
+GPT_FIRST_TOKEN_SECONDS = REGISTRY.register(Histogram(
+    'telebot_gpt_first_token_seconds', 'Time to the first chunk of streamed completions.', ('prompt',)))
+GPT_STREAM_SECONDS = REGISTRY.register(Histogram(
+    'telebot_gpt_stream_seconds', 'Time to the end of streamed completions.', ('prompt',)))
+
+
+class Trace:
+    """The spans of one update, in the order they finished."""
+
+    def __init__(self):
+        self.spans: list[tuple[str, str, float]] = []
+
+    def summary(self) -> str:
+        totals = defaultdict(lambda: [0, 0.0])
+        for stage, name, elapsed in self.spans:
+            total = totals[f'{stage}:{name}' if name else stage]
+            total[0] += 1
+            total[1] += elapsed
+        ranked = sorted(totals.items(), key=lambda total: -total[1][1])
+        return ', '.join(f'{label} {elapsed:.3f}s' + (f' x{count}' if count > 1 else '')
+                         for label, (count, elapsed) in ranked)
+
+
+current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar('current_trace', default=None)
+
+
+@contextmanager
+def span(stage: str, name: str = ''):
+    """Times a block into the stage histogram and the trace of the update being handled."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage, name=name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage, name=name)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.spans.append((stage, name, elapsed))
+
+
+def traced(handler):
+    """Collects the spans of an update handler and logs where the time went on slow updates.
+
+    The threshold in seconds is read from bot_data['slow_update_seconds'], None disables the log.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        trace = Trace()
+        token = current_trace.set(trace)
+        start = time.perf_counter()
+        try:
+            return await handler(update, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_trace.reset(token)
+            UPDATE_SECONDS.observe(elapsed, handler=handler.__name__)
+            threshold = context.bot_data.get('slow_update_seconds')
+            if threshold is not None and elapsed >= threshold:
+                logger.warning('Update %s in %s took %.3fs: %s',
+                               update.update_id, handler.__name__, elapsed, trace.summary())
+    return wrapper
+
+
+class MetricsServer:
+    """Serves the registry in the Prometheus text format on GET /metrics."""
+
+    def __init__(self, registry: Registry = REGISTRY, host: str = '127.0.0.1', port: int = 9100):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = (await reader.readline()).decode('latin-1').split()
+            # the headers are not needed, but have to be read before answering
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            if len(request) >= 2 and request[0] == 'GET' and request[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\n'
+                         f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         f'Content-Length: {len(body)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
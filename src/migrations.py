@@ -0,0 +1,123 @@
+import argparse
+import os
+import re
+from os import getenv
+
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2 import sql
+
+load_dotenv()
+
+MIGRATION_DIR = '../db/migrations'
+MIGRATION_PATTERN = re.compile(r'^(\d+)_(\w+)\.sql$')
+# arbitrary key for pg_advisory_lock so concurrently starting instances migrate one at a time
+MIGRATION_LOCK_ID = 7305112
+
+
+def load_migrations(directory: str = MIGRATION_DIR) -> list[tuple[int, str, str]]:
+    """Returns (version, name, path) of every migration file, ordered by version."""
+    migrations = []
+    for filename in os.listdir(directory):
+        match = MIGRATION_PATTERN.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(directory, filename)))
+
+    migrations.sort()
+    versions = [migration[0] for migration in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError(f'Duplicate migration versions in {directory}')
+    return migrations
+
+
+class MigrationRunner:
+    """Applies versioned SQL files in order, each in its own transaction, recording them in schema_migrations."""
+
+    def __init__(self, conn, directory: str = MIGRATION_DIR):
+        self.conn = conn
+        self.directory = directory
+
+    def create_table(self):
+        with self.conn.cursor() as cursor:
+            cursor.execute(sql.SQL('CREATE TABLE IF NOT EXISTS {table} ('
+                                   '{field1} integer PRIMARY KEY, {field2} varchar, {field3} timestamp DEFAULT (now()))').format(
+                table=sql.Identifier('schema_migrations'),
+                field1=sql.Identifier('version'),
+                field2=sql.Identifier('name'),
+                field3=sql.Identifier('applied_at')
+            ))
+        self.conn.commit()
+
+    def applied(self) -> set[int]:
+        self.create_table()
+        with self.conn.cursor() as cursor:
+            cursor.execute(sql.SQL('SELECT {field} FROM {table}').format(
+                table=sql.Identifier('schema_migrations'),
+                field=sql.Identifier('version')
+            ))
+            versions = {row[0] for row in cursor.fetchall()}
+        self.conn.commit()
+        return versions
+
+    def pending(self) -> list[tuple[int, str, str]]:
+        applied = self.applied()
+        return [migration for migration in load_migrations(self.directory) if migration[0] not in applied]
+
+    def migrate(self) -> list[tuple[int, str, str]]:
+        with self.conn.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_lock(%s)', (MIGRATION_LOCK_ID,))
+        try:
+            pending = self.pending()
+            for version, name, path in pending:
+                with open(path) as infile:
+                    statements = infile.read()
+                with self.conn.cursor() as cursor:
+                    cursor.execute(statements)
+                    cursor.execute(sql.SQL('INSERT INTO {table} ({field1}, {field2}) VALUES(%s, %s)').format(
+                        table=sql.Identifier('schema_migrations'),
+                        field1=sql.Identifier('version'),
+                        field2=sql.Identifier('name')
+                    ), (version, name))
+                self.conn.commit()
+            return pending
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            with self.conn.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s)', (MIGRATION_LOCK_ID,))
+            self.conn.commit()
+
+
+def connect():
+    return psycopg2.connect(
+        dbname=getenv('POSTGRES_DB'),
+        host=getenv('POSTGRES_HOST'),
+        port=int(getenv('POSTGRES_PORT')),
+        user=getenv('POSTGRES_USER'),
+        password=getenv('POSTGRES_PASSWORD'))
+
+
+def migrate():
+    conn = connect()
+    try:
+        return MigrationRunner(conn).migrate()
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply pending database migrations.')
+    parser.add_argument('--status', action='store_true', help='list pending migrations without applying them')
+    args = parser.parse_args()
+
+    conn = connect()
+    try:
+        runner = MigrationRunner(conn)
+        migrations = runner.pending() if args.status else runner.migrate()
+        for version, name, _ in migrations:
+            print(f'{"pending" if args.status else "applied"} {version:03d}_{name}')
+        if not migrations:
+            print('Database is up to date.')
+    finally:
+        conn.close()
@@ -0,0 +1,80 @@
+import os
+import re
+import time
+from typing import Optional
+
+PLACEHOLDER_PATTERN = re.compile(r'%\((\w+)\)s')
+# any % that is not a named placeholder or an escaped %% would break rendering
+STRAY_PERCENT_PATTERN = re.compile(r'%(?!\(\w+\)s|%)')
+
+
+class PromptTemplate:
+    def __init__(self, name: str, text: str):
+        if STRAY_PERCENT_PATTERN.search(PLACEHOLDER_PATTERN.sub('', text).replace('%%', '')):
+            raise ValueError(f'Prompt {name} contains a % that is not a %(name)s placeholder')
+
+        self.name = name
+        self.text = text
+        self.placeholders = frozenset(PLACEHOLDER_PATTERN.findall(text))
+
+    def render(self, **values) -> str:
+        if values.keys() != self.placeholders:
+            raise KeyError(f'Prompt {self.name} expects {sorted(self.placeholders)}, got {sorted(values)}')
+        return self.text % values
+
+
+class PromptRegistry:
+    """Loads every prompt template in a directory once and renders them from memory.
+
+    With a watch interval set, files are re-read when their modification time changes, checked
+    at most once per interval on render.
+    """
+
+    def __init__(self, directory: str, watch_interval: Optional[float] = None):
+        self.directory = directory
+        self.watch_interval = watch_interval
+        self.templates: dict[str, PromptTemplate] = {}
+        self.mtimes: dict[str, float] = {}
+        self.last_check = time.monotonic()
+        self.load()
+
+    def load(self):
+        for filename in sorted(os.listdir(self.directory)):
+            name, ext = os.path.splitext(filename)
+            if ext == '.txt':
+                self._load_file(name)
+
+    def _load_file(self, name: str):
+        path = os.path.join(self.directory, f'{name}.txt')
+        with open(path) as infile:
+            template = PromptTemplate(name, infile.read())
+
+        old = self.templates.get(name)
+        if old and old.placeholders != template.placeholders:
+            raise ValueError(f'Prompt {name} placeholders changed from {sorted(old.placeholders)} '
+                             f'to {sorted(template.placeholders)}')
+        self.templates[name] = template
+        self.mtimes[name] = os.path.getmtime(path)
+
+    def reload_changed(self):
+        for name, mtime in self.mtimes.items():
+            if os.path.getmtime(os.path.join(self.directory, f'{name}.txt')) != mtime:
+                try:
+                    self._load_file(name)
+                except ValueError:
+                    # keep serving the last valid template
+                    pass
+
+    def validate(self, expected: dict[str, set[str]]):
+        for name, placeholders in expected.items():
+            if name not in self.templates:
+                raise ValueError(f'Missing prompt {name} in {self.directory}')
+            if self.templates[name].placeholders != placeholders:
+                raise ValueError(f'Prompt {name} expects {sorted(placeholders)}, '
+                                 f'file has {sorted(self.templates[name].placeholders)}')
+
+    def render(self, name: str, **values) -> str:
+        if self.watch_interval is not None and time.monotonic() - self.last_check >= self.watch_interval:
+            self.last_check = time.monotonic()
+            self.reload_changed()
+        return self.templates[name].render(**values)
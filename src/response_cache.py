@@ -0,0 +1,153 @@
+import random
+import time
+from collections import OrderedDict
+
+from gpt import GPT, IntentionType
+
+# local rephrasings of the fixed handler outputs, used in template mode instead of response_query
+TEMPLATES = {
+    'No deadlines matched your query.': [
+        "I couldn't find any deadlines matching that.",
+        "Sorry, none of your deadlines match that.",
+        "Hmm, no deadlines fit that description."
+    ],
+    'No deadlines in the database.': [
+        "You don't have any deadlines yet.",
+        "Your deadline list is empty right now."
+    ],
+    'No reminders matched your query.': [
+        "I couldn't find any reminders matching that.",
+        "Sorry, none of your reminders match that."
+    ],
+    'There are no deadlines in the database to delete.': [
+        "You don't have any deadlines to delete.",
+        "There's nothing to delete, your deadline list is empty."
+    ],
+    'There are no deadlines in the database to update.': [
+        "You don't have any deadlines to update.",
+        "There's nothing to update, your deadline list is empty."
+    ],
+    'Updated deadline.': [
+        "Done, your deadline has been updated.",
+        "All set, I've updated that deadline."
+    ],
+    'Updated reminder.': [
+        "Done, your reminder has been updated.",
+        "All set, I've updated that reminder."
+    ],
+    'Deleted reminder.': [
+        "Done, that reminder is gone.",
+        "All set, I've deleted that reminder."
+    ],
+    'Your deadline has been saved.': [
+        "Got it, your deadline is saved.",
+        "Done, I've saved your deadline."
+    ],
+    'Your reminder has been created.': [
+        "Got it, I'll remind you.",
+        "Done, your reminder is set."
+    ],
+    'Cannot create reminder in the past.': [
+        "I can't set a reminder in the past.",
+        "That time has already passed, so I can't remind you then."
+    ],
+    'Cannot delete reminder from the past.': [
+        "That reminder is in the past, so I can't delete it."
+    ],
+    'Cannot create deadline as deadline already exists.': [
+        "You already have that deadline.",
+        "That deadline already exists."
+    ]
+}
+
+
+class ResponseCacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.templated = 0
+        self.uncached = 0
+
+    def as_dict(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'templated': self.templated,
+            'uncached': self.uncached
+        }
+
+
+class ResponseCache:
+    """Rephrased handler outputs keyed by intention and canonical text, evicted least recently used first.
+
+    Only the fixed texts listed in TEMPLATES are cached, since texts with details filled in, such as
+    the number of deadlines deleted, rarely repeat and would only crowd them out; those are rephrased
+    by response_query every time. Each key asks response_query variants times before replies are
+    served from the cache, picking one of the distinct rephrasings at random so repeated answers do
+    not read the same. An LLM that keeps answering alike leaves fewer of them. Keys expire ttl
+    seconds after their first variant was stored. In template mode nothing is sent to the LLM: known
+    texts get a local rephrasing from TEMPLATES and everything else is sent as is.
+    """
+
+    def __init__(self, mode: str = 'cache', variants: int = 3, ttl: float = 24 * 60 * 60, max_size: int = 1000):
+        if mode not in ('llm', 'cache', 'template'):
+            raise ValueError(f'Unknown response mode {mode}')
+        self.mode = mode
+        self.variants = variants
+        self.ttl = ttl
+        self.max_size = max_size
+        self.stats = ResponseCacheStats()
+        # stored at, rephrasings asked for, distinct rephrasings
+        self.entries: OrderedDict[tuple[str, str, str], tuple[float, int, list[str]]] = OrderedDict()
+
+    @staticmethod
+    def key(intention: IntentionType, text: str) -> tuple[str, str, str]:
+        return intention['action'].name, intention.get('target') or '', text.strip()
+
+    def get(self, intention: IntentionType, text: str):
+        """Returns a cached rephrasing once the key was asked for all its variants, otherwise None."""
+        key = self.key(intention, text)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        stored_at, asked, variants = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        if asked < self.variants:
+            return None
+        return random.choice(variants)
+
+    def put(self, intention: IntentionType, text: str, response: str):
+        key = self.key(intention, text)
+        stored_at, asked, variants = self.entries.get(key, (time.monotonic(), 0, []))
+        if response not in variants:
+            variants.append(response)
+        self.entries[key] = (stored_at, asked + 1, variants[-self.variants:])
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def phrase(self, gpt: GPT, intention: IntentionType, text: str) -> str:
+        if self.mode == 'template':
+            self.stats.templated += 1
+            return random.choice(TEMPLATES.get(text.strip(), [text]))
+        if self.mode == 'llm':
+            return await gpt.response_query(intention, text)
+
+        if text.strip() not in TEMPLATES:
+            self.stats.uncached += 1
+            return await gpt.response_query(intention, text)
+
+        cached = self.get(intention, text)
+        if cached is not None:
+            self.stats.hits += 1
+            return cached
+
+        self.stats.misses += 1
+        response = await gpt.response_query(intention, text)
+        self.put(intention, text, response)
+        return response
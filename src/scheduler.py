@@ -0,0 +1,157 @@
+import asyncio
+import heapq
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional
+
+from database import AsyncPostgresDb
+
+logger = logging.getLogger(__name__)
+
+
+class SchedulerStats:
+    def __init__(self):
+        self.leased = 0
+        self.delivered = 0
+        self.failed = 0
+
+    def as_dict(self) -> dict:
+        return {'leased': self.leased, 'delivered': self.delivered, 'failed': self.failed}
+
+
+class ReminderScheduler:
+    """Delivers due reminders, claimed through row leases so several instances can share the work.
+
+    An in-memory min-heap of (reminder_time, reminder_id) wakes the scheduler at the exact time of
+    the reminders this instance knows about, and it otherwise polls every poll_interval seconds for
+    reminders scheduled elsewhere. Either way it leases whatever is due in batches of batch_size,
+    each row to one instance only, delivers the batch and marks the reminders the callback reports
+    as sent. The lease is renewed while the batch is being delivered, so a slow batch is not taken
+    over. Reminders that failed to send, and batches whose instance dies, are picked up by any
+    instance once their lease runs out.
+
+    Handlers keep the heap current through schedule() and cancel(). Rescheduled reminders leave a
+    stale entry behind, which is skipped when popped because it no longer matches self.times.
+    Reminder contents are fetched when they fire, so reminders of deleted deadlines drop out and
+    edited descriptions are picked up without touching the heap.
+
+    When several processes share the database, owns(chat_id) limits start() to the reminders of
+    the chats routed to this one, which schedules everything created through its handlers anyway.
+    """
+
+    def __init__(
+            self,
+            db: AsyncPostgresDb,
+            callback: Callable[[list[int]], Awaitable[list[int]]],
+            owns: Optional[Callable[[int], bool]] = None,
+            lease: float = 60,
+            batch_size: int = 100,
+            poll_interval: Optional[float] = 30):
+        self.db = db
+        self.callback = callback
+        self.owns = owns
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.lease = timedelta(seconds=lease)
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.heap: list[tuple[datetime, int]] = []
+        self.times: dict[int, datetime] = {}
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.stats = SchedulerStats()
+
+    async def start(self):
+        for reminder_id, reminder_time, chat_id in await self.db.fetch_reminder_times_query(datetime.now()):
+            if self.owns is None or self.owns(chat_id):
+                self.schedule(reminder_id, reminder_time)
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def schedule(self, reminder_id: int, reminder_time: datetime):
+        self.times[reminder_id] = reminder_time
+        heapq.heappush(self.heap, (reminder_time, reminder_id))
+        self.wakeup.set()
+
+    def cancel(self, reminder_id: int):
+        self.times.pop(reminder_id, None)
+
+    def pop_due(self, now: datetime) -> list[int]:
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            reminder_time, reminder_id = heapq.heappop(self.heap)
+            if self.times.get(reminder_id) == reminder_time:
+                del self.times[reminder_id]
+                due.append(reminder_id)
+        return due
+
+    async def deliver(self, now: datetime) -> int:
+        """Leases and delivers one batch of due reminders, returning how many were leased."""
+        leased = await self.db.lease_due_reminders_query(now, self.owner, self.lease, self.batch_size)
+        if not leased:
+            return 0
+        self.stats.leased += len(leased)
+        renewal = asyncio.create_task(self.renew(leased))
+        try:
+            sent = await self.callback(leased)
+        except Exception:
+            # the lease runs out and the batch is retried by whichever instance gets to it first
+            self.stats.failed += len(leased)
+            logger.exception('Failed to deliver reminders %s', leased)
+            return 0
+        finally:
+            renewal.cancel()
+        self.stats.failed += len(leased) - len(sent)
+        if sent:
+            marked = await self.db.mark_reminders_sent_query(sent, self.owner, datetime.now())
+            self.stats.delivered += marked
+            if marked < len(sent):
+                logger.warning('Lost the lease on %s of reminders %s before marking them sent, they may be sent again',
+                               len(sent) - marked, sent)
+        return len(leased)
+
+    async def renew(self, leased: list[int]):
+        while True:
+            await asyncio.sleep(self.lease.total_seconds() / 3)
+            try:
+                held = await self.db.renew_reminder_leases_query(leased, self.owner, datetime.now() + self.lease)
+            except Exception:
+                logger.exception('Failed to renew the lease on reminders %s', leased)
+                continue
+            if held < len(leased):
+                logger.warning('Lost the lease on %s of reminders %s while delivering them', len(leased) - held, leased)
+
+    async def run(self):
+        # the first pass catches up on whatever fell due while no instance was running
+        polled = None
+        while True:
+            self.wakeup.clear()
+            now = datetime.now()
+            poll_due = polled is None or (
+                self.poll_interval is not None and now - polled >= timedelta(seconds=self.poll_interval))
+            if self.pop_due(now) or poll_due:
+                polled = now
+                try:
+                    while await self.deliver(now) == self.batch_size:
+                        pass
+                except Exception:
+                    logger.exception('Failed to lease due reminders')
+                continue
+
+            timeouts = []
+            if self.heap:
+                timeouts.append((self.heap[0][0] - now).total_seconds())
+            if self.poll_interval is not None:
+                timeouts.append((polled + timedelta(seconds=self.poll_interval) - now).total_seconds())
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), min(timeouts) if timeouts else None)
+            except asyncio.TimeoutError:
+                pass
@@ -1,33 +1,138 @@
 import asyncio
-import datetime
+import json
+import multiprocessing
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from os import getenv
+from typing import Optional
 
 from dotenv import load_dotenv
-from faster_whisper import WhisperModel
+from openai import AsyncOpenAI
+from telegram import Update
+from telegram.request import BaseRequest
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters
 
-from database import PostgresDb
+from cassette import Cassette
+from database import AsyncPostgresDb
+from deadline_index import DeadlineIndex
+from dispatcher import MessageDispatcher
 from gpt import GPT
 from handlers import reminder_callback, handle_start, handle_message, handle_unknown, handle_voice
+from intent_classifier import IntentClassifier
+from metrics import REGISTRY, MetricsServer, Registry, StatsGauges
+from migrations import migrate
+from response_cache import ResponseCache
+from scheduler import ReminderScheduler
+from transcriber import Transcriber
+from update_processor import ChatUpdateProcessor
+from webhook import HashRing, run_webhook
 
 load_dotenv()
 
 
 class Telebot:
-    def __init__(self):
-        self.token = getenv('TELEGRAM_TOKEN')
-        self.db = PostgresDb(
+    def __init__(
+            self,
+            token: Optional[str] = None,
+            request: Optional[BaseRequest] = None,
+            llm: Optional[AsyncOpenAI] = None,
+            worker: Optional[int] = None,
+            workers: int = 1):
+        self.token = token or getenv('TELEGRAM_TOKEN')
+        # webhook workers are started after the router process has migrated
+        self.worker = worker
+        # migrating and connecting wait on the network, so the rest is built in the meantime
+        startup = ThreadPoolExecutor(max_workers=2, thread_name_prefix='startup')
+        steps = []
+        if worker is None and getenv('MIGRATE_ON_STARTUP', '1') == '1':
+            steps.append(startup.submit(migrate))
+        self.db = AsyncPostgresDb(
             getenv('POSTGRES_DB'),
             getenv('POSTGRES_HOST'),
             int(getenv('POSTGRES_PORT')),
             getenv('POSTGRES_USER'),
-            getenv('POSTGRES_PASSWORD')
+            getenv('POSTGRES_PASSWORD'),
+            pool_size=int(getenv('POSTGRES_POOL_SIZE', 10)),
+            acquire_timeout=float(getenv('POSTGRES_ACQUIRE_TIMEOUT', 10)),
+            identity_cache_size=int(getenv('POSTGRES_IDENTITY_CACHE_SIZE', 10000)),
+            conversation_cache_bytes=int(getenv('CONVERSATION_CACHE_BYTES', 32 * 1024 * 1024)),
+            deadline_cache_users=int(getenv('DEADLINE_CACHE_USERS', 1000)),
+            write_behind=getenv('MESSAGE_WRITE_BEHIND', '0') == '1',
+            flush_size=int(getenv('MESSAGE_FLUSH_SIZE', 100)),
+            flush_interval=float(getenv('MESSAGE_FLUSH_INTERVAL', 1))
         )
-        self.db.connect()
-        self.gpt = GPT()
-        self.app = ApplicationBuilder().token(self.token).build()
-        self.whisper = WhisperModel('small.en', device='cpu')
+        steps.append(startup.submit(self.db.connect))
+        self.gpt = GPT(
+            max_concurrency=int(getenv('OPENAI_MAX_CONCURRENCY', 16)),
+            timeout=float(getenv('OPENAI_TIMEOUT', 30)),
+            prompt_watch_interval=float(getenv('PROMPT_WATCH_INTERVAL')) if getenv('PROMPT_WATCH_INTERVAL') else None,
+            llm=llm,
+            deadline_token_budget=int(getenv('DEADLINE_TOKEN_BUDGET')) if getenv('DEADLINE_TOKEN_BUDGET') else None,
+            conversation_token_budget=int(getenv('CONVERSATION_TOKEN_BUDGET')) if getenv('CONVERSATION_TOKEN_BUDGET') else None,
+            cassette=Cassette(
+                getenv('OPENAI_CASSETTE'),
+                mode=getenv('OPENAI_CASSETTE_MODE', 'replay'),
+                inject_latency=getenv('OPENAI_CASSETTE_LATENCY', '0') == '1'
+            ) if getenv('OPENAI_CASSETTE') else None
+        )
+        self.intent_classifier = IntentClassifier(
+            threshold=float(getenv('INTENT_THRESHOLD', 0.8)),
+            shadow_rate=float(getenv('INTENT_SHADOW_RATE', 0))
+        )
+        self.deadline_index = DeadlineIndex(
+            threshold=float(getenv('DEADLINE_INDEX_THRESHOLD', 0.65)),
+            margin=float(getenv('DEADLINE_INDEX_MARGIN', 0.2)),
+            top_k=int(getenv('DEADLINE_INDEX_TOP_K', 10))
+        )
+        self.response_cache = ResponseCache(
+            mode=getenv('RESPONSE_MODE', 'cache'),
+            variants=int(getenv('RESPONSE_CACHE_VARIANTS', 3)),
+            ttl=float(getenv('RESPONSE_CACHE_TTL', 24 * 60 * 60)),
+            max_size=int(getenv('RESPONSE_CACHE_SIZE', 1000))
+        )
+        self.update_processor = ChatUpdateProcessor(
+            max_concurrency=int(getenv('UPDATE_CONCURRENCY', 16)),
+            max_pending=int(getenv('UPDATE_MAX_PENDING', 1024))
+        )
+        builder = (ApplicationBuilder().token(self.token).concurrent_updates(self.update_processor)
+                   .post_init(self.startup).post_shutdown(self.shutdown))
+        if request:
+            builder = builder.request(request)
+        self.app = builder.build()
+        self.dispatcher = MessageDispatcher(
+            global_rate=float(getenv('TELEGRAM_GLOBAL_RATE', 30)),
+            chat_rate=float(getenv('TELEGRAM_CHAT_RATE', 1)),
+            max_retries=int(getenv('TELEGRAM_MAX_RETRIES', 3))
+        )
+        ring = HashRing(workers)
+        self.scheduler = ReminderScheduler(
+            self.db,
+            partial(reminder_callback, self.app.bot, self.db, self.dispatcher),
+            owns=(lambda chat_id: ring.worker(chat_id) == worker) if worker is not None else None,
+            lease=float(getenv('REMINDER_LEASE_SECONDS', 60)),
+            batch_size=int(getenv('REMINDER_BATCH_SIZE', 100)),
+            poll_interval=float(getenv('REMINDER_POLL_INTERVAL', 30))
+        )
+        self.transcriber = Transcriber(
+            model=getenv('WHISPER_MODEL', 'small.en'),
+            compute_type=getenv('WHISPER_COMPUTE_TYPE', 'default'),
+            workers=int(getenv('WHISPER_WORKERS', 0)),
+            queue_size=int(getenv('WHISPER_QUEUE_SIZE', 8)),
+            warm_up=getenv('WHISPER_WARM_UP', '0') == '1',
+            idle_timeout=float(getenv('WHISPER_IDLE_TIMEOUT')) if getenv('WHISPER_IDLE_TIMEOUT') else None
+        )
+        self.registry = Registry(REGISTRY)
+        self.metrics_server = MetricsServer(
+            self.registry,
+            host=getenv('METRICS_HOST', '127.0.0.1'),
+            # every webhook worker serves its own metrics on the next port
+            port=int(getenv('METRICS_PORT')) + (worker or 0)
+        ) if getenv('METRICS_PORT') else None
+        for step in steps:
+            step.result()
+        startup.shutdown()
         self.setup()
 
     def setup(self):
@@ -39,26 +144,84 @@ class Telebot:
         # pass useful objects to context for handlers
         self.app.context_types.context.bot_data = {
             'db': self.db,
+            'dispatcher': self.dispatcher,
             'gpt': self.gpt,
-            'whisper': self.whisper
+            'intent_classifier': self.intent_classifier,
+            'deadline_index': self.deadline_index,
+            'scheduler': self.scheduler,
+            'response_cache': self.response_cache,
+            'pipeline_mode': getenv('PIPELINE_MODE', 'chain'),
+            'stream_interval': float(getenv('STREAM_EDIT_INTERVAL')) if getenv('STREAM_EDIT_INTERVAL') else None,
+            'transcriber': self.transcriber,
+            'slow_update_seconds': float(getenv('SLOW_UPDATE_SECONDS')) if getenv('SLOW_UPDATE_SECONDS') else None
         }
-        job_queue = self.app.job_queue
-        # for testing purposes
-        # job_queue.run_once(callback=hourly_reminder, when=5)
+        for name, stats in [
+                ('updates', self.update_processor.stats.as_dict),
+                ('pool', self.db.stats.as_dict),
+                ('identity_cache', self.db.identity_cache.as_dict),
+                ('conversations', self.db.conversations.as_dict),
+                ('deadline_cache', self.db.deadlines.as_dict),
+                ('write_behind', self.db.write_behind_stats.as_dict),
+                ('gpt', lambda: {'in_flight': self.gpt.in_flight}),
+                ('intent_classifier', self.intent_classifier.stats.as_dict),
+                ('deadline_index', self.deadline_index.stats.as_dict),
+                ('response_cache', self.response_cache.stats.as_dict),
+                ('dispatcher', self.dispatcher.stats.as_dict),
+                ('scheduler', self.scheduler.stats.as_dict),
+                ('transcriber', self.transcriber.stats.as_dict)]:
+            self.registry.register(StatsGauges(f'telebot_{name}', f'Current {name.replace("_", " ")} stats.', stats))
+
+    async def startup(self, app):
+        if self.metrics_server:
+            await self.metrics_server.start()
+        await self.db.start()
+        await self.scheduler.start()
+        await self.transcriber.start()
 
-        start = datetime.datetime.now().replace(microsecond=0, second=0)
-        job_queue.run_repeating(
-            callback=reminder_callback,
-            interval=datetime.timedelta(minutes=1),
-            first=start.astimezone(),
-            job_kwargs={'misfire_grace_time': 58})
+    async def shutdown(self, app):
+        await self.scheduler.stop()
+        await self.transcriber.stop()
+        self.transcriber.close()
+        await self.db.stop()
+        self.db.close()
+        if self.metrics_server:
+            await self.metrics_server.stop()
 
     def run(self):
         self.app.run_polling()
 
+    def serve(self, updates: multiprocessing.Queue):
+        """Handles the updates a webhook router puts on the queue, until it puts None."""
+        asyncio.run(self.serve_updates(updates))
+
+    async def serve_updates(self, updates: multiprocessing.Queue):
+        loop = asyncio.get_running_loop()
+        await self.app.initialize()
+        await self.startup(self.app)
+        await self.app.start()
+        try:
+            while (data := await loop.run_in_executor(None, updates.get)) is not None:
+                await self.app.update_queue.put(Update.de_json(json.loads(data), self.app.bot))
+        finally:
+            await self.app.stop()
+            await self.app.shutdown()
+            await self.shutdown(self.app)
+
 
 if __name__ == '__main__':
     if sys.platform == 'win32':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-    bot = Telebot()
-    bot.run()
+    if getenv('WEBHOOK_URL'):
+        if getenv('MIGRATE_ON_STARTUP', '1') == '1':
+            migrate()
+        run_webhook(
+            int(getenv('WEBHOOK_WORKERS', 0)) or os.cpu_count(),
+            url=getenv('WEBHOOK_URL'),
+            token=getenv('TELEGRAM_TOKEN'),
+            secret=getenv('WEBHOOK_SECRET') or None,
+            host=getenv('WEBHOOK_HOST', '127.0.0.1'),
+            port=int(getenv('WEBHOOK_PORT', 8443))
+        )
+    else:
+        bot = Telebot()
+        bot.run()
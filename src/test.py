@@ -1,14 +1,50 @@
+import asyncio
 import datetime
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from os import getenv
+from types import SimpleNamespace
+from typing import Optional
 
 from dotenv import load_dotenv
+from telegram import Update
+from telegram.error import RetryAfter, TimedOut
 
-from database import PostgresDb
-from gpt import GPT, Intention
+from cassette import Cassette, CassetteMiss
+from database import AsyncPostgresDb, ConversationCache, DeadlineCache, DeadlineSnapshot, IdentityCache, PostgresDb
+from deadline_index import DeadlineIndex
+from dispatcher import MessageDispatcher
+from gpt import GPT, Intention, PROMPT_DIR, PROMPT_PLACEHOLDERS, StructuredExtraction, serialize_deadlines, window_messages
+from handlers import compact_tables, create_deadline_table, create_reminder_table, stream_reply
+from intent_classifier import IntentClassifier
+from metrics import Histogram, MetricsServer, Registry, StatsGauges, Trace, current_trace, span
+from migrations import load_migrations
+from prompt_registry import PromptRegistry, PromptTemplate
+from response_cache import ResponseCache, TEMPLATES
+from scheduler import ReminderScheduler
+from transcriber import Transcriber
+from update_processor import ChatUpdateProcessor
+from webhook import HashRing, WebhookRouter
 
 load_dotenv()
 
+INTENTION_EXAMPLES = [
+    ([{'role': 'user', 'content': 'I have a project submission due soon, can you help me create a deadline for that?'}], {'action': Intention.CREATE, 'target': 'deadline'}),
+    ([{'role': 'user', 'content': 'When is my orbital submission due?'}], {'action': Intention.READ, 'target': 'deadline'}),
+    ([{'role': 'user', 'content': 'What deadlines do I have next week?'}], {'action': Intention.READ, 'target': 'deadline'}),
+    ([{'role': 'user', 'content': 'Can you help me change the due date for one of my deadlines?'}], {'action': Intention.UPDATE, 'target': 'deadline'}),
+    ([{'role': 'user', 'content': 'I have completed my submission for my orbital milestone. Can you remove it?'}], {'action': Intention.DELETE, 'target': 'deadline'}),
+    ([{'role': 'user', 'content': 'Can you create a reminder for my submission?'}], {'action': Intention.CREATE, 'target': 'reminder'}),
+    ([{'role': 'user', 'content': 'When is the reminder for my orbital submission?'}], {'action': Intention.READ, 'target': 'reminder'}),
+    ([{'role': 'user', 'content': 'Could you postpone my reminder to next Sunday?'}], {'action': Intention.UPDATE, 'target': 'reminder'}),
+    ([{'role': 'user', 'content': 'I want to remove all of my reminders.'}], {'action': Intention.DELETE, 'target': 'reminder'}),
+]
+
 
 class DbAccountTest(unittest.TestCase):
     @classmethod
@@ -36,6 +72,256 @@ class DbAccountTest(unittest.TestCase):
         self.assertFalse(self.db.account_exists_query(chat_id))
 
 
+class AsyncDbPoolTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.db = AsyncPostgresDb(
+            getenv('POSTGRES_DB'),
+            getenv('POSTGRES_HOST'),
+            int(getenv('POSTGRES_PORT')),
+            getenv('POSTGRES_USER'),
+            getenv('POSTGRES_PASSWORD'),
+            pool_size=2,
+            acquire_timeout=0.5
+        )
+        self.db.connect()
+
+    def tearDown(self):
+        self.db.close()
+
+    async def test_account(self):
+        username = 'TestUsername'
+        chat_id = 2
+        await self.db.create_user_account_query(username, chat_id)
+        self.assertTrue(await self.db.account_exists_query(chat_id))
+        await self.db.delete_user_account_query(chat_id)
+        self.assertFalse(await self.db.account_exists_query(chat_id))
+
+    async def test_identity_cache(self):
+        chat_id = 3
+        self.assertFalse(await self.db.account_exists_query(chat_id))
+        await self.db.create_user_account_query('TestUsername', chat_id)
+        self.assertTrue(await self.db.account_exists_query(chat_id))
+        await self.db.create_message_query(chat_id, 'This is a test', True)
+        await self.db.fetch_latest_messages_query(chat_id)
+        self.assertEqual(2, self.db.identity_cache.misses)
+        self.assertEqual(2, self.db.identity_cache.hits)
+        await self.db.delete_user_account_query(chat_id)
+        self.assertFalse(await self.db.account_exists_query(chat_id))
+
+    async def test_write_behind(self):
+        self.db.write_behind = True
+        await self.db.start()
+        chat_id = 4
+        await self.db.create_user_account_query('TestUsername', chat_id)
+        created_messages = [('This is a test', True), ('This is another test message', False)]
+        for msg in created_messages:
+            await self.db.create_message_query(chat_id, msg[0], msg[1])
+        self.assertEqual(2, self.db.write_behind_stats.backlog)
+
+        await self.db.stop()
+        self.assertEqual(0, self.db.write_behind_stats.backlog)
+        self.db.conversations.evict(chat_id)
+        self.assertEqual(created_messages, await self.db.fetch_latest_messages_query(chat_id))
+        await self.db.delete_user_account_query(chat_id)
+
+    async def test_write_behind_rehydrate(self):
+        self.db.write_behind = True
+        self.db.flush_size = 2
+        chat_id = 5
+        await self.db.create_user_account_query('TestUsername', chat_id)
+        created_messages = [('This is a test', True), ('This is another test message', False)]
+        for msg in created_messages:
+            await self.db.create_message_query(chat_id, msg[0], msg[1])
+        self.assertTrue(self.db.flush_event.is_set())
+
+        self.db.conversations.evict(chat_id)
+        self.assertEqual(created_messages, await self.db.fetch_latest_messages_query(chat_id))
+        self.assertEqual(0, self.db.write_behind_stats.backlog)
+        await self.db.delete_user_account_query(chat_id)
+
+    async def test_write_behind_bad_row(self):
+        self.db.write_behind = True
+        chat_id = 6
+        await self.db.create_user_account_query('TestUsername', chat_id)
+        await self.db.create_message_query(chat_id, 'This is a test', True)
+        # a row of an account that no longer exists
+        self.db.message_buffer.append((-1, 'This is an orphan', True, datetime.datetime.now()))
+        await self.db.create_message_query(chat_id, 'This is another test message', False)
+
+        await self.db.flush()
+        self.assertEqual(0, self.db.write_behind_stats.backlog)
+        self.assertEqual(1, self.db.write_behind_stats.dropped)
+        self.assertEqual(2, self.db.write_behind_stats.flushed)
+        await self.db.delete_user_account_query(chat_id)
+
+    async def test_concurrent_queries(self):
+        results = await asyncio.gather(*[self.db.account_exists_query(chat_id) for chat_id in range(10)])
+        self.assertEqual(10, len(results))
+        self.assertEqual(0, self.db.stats.in_use)
+        self.assertEqual(10, self.db.stats.acquired)
+
+    async def test_acquire_timeout(self):
+        async with self.db.acquire(), self.db.acquire():
+            with self.assertRaises(asyncio.TimeoutError):
+                await self.db.account_exists_query(1)
+        self.assertEqual(1, self.db.stats.timeouts)
+
+
+class AsyncDbCancelTest(unittest.IsolatedAsyncioTestCase):
+    class FakePool:
+        def __init__(self):
+            self.events = []
+
+        def getconn(self):
+            return SimpleNamespace(cursor=lambda: SimpleNamespace(close=lambda: None))
+
+        def putconn(self, conn):
+            self.events.append('putconn')
+
+    async def test_cancelled_query(self):
+        db = AsyncPostgresDb('db', 'localhost', 5432, 'user', 'password', pool_size=1)
+        db.pool = pool = self.FakePool()
+        db.executor = ThreadPoolExecutor(max_workers=1)
+        db.semaphore = asyncio.Semaphore(1)
+        started, finish = threading.Event(), threading.Event()
+
+        def slow_query(session):
+            started.set()
+            finish.wait(5)
+            pool.events.append('query')
+
+        task = asyncio.create_task(db.run(slow_query))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+        task.cancel()
+        await asyncio.sleep(0.05)
+        # the connection stays checked out while its query runs
+        self.assertEqual([], pool.events)
+        self.assertFalse(task.done())
+
+        finish.set()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(['query', 'putconn'], pool.events)
+        db.executor.shutdown()
+
+    async def test_stop_during_flush(self):
+        db = AsyncPostgresDb('db', 'localhost', 5432, 'user', 'password', write_behind=True, flush_interval=60)
+        inserted = []
+
+        async def run(method, messages):
+            await asyncio.sleep(0.05)
+            inserted.extend(messages)
+
+        db.run = run
+        await db.start()
+        db.message_buffer = [(1, 'This is a test', True, datetime.datetime.now())]
+        db.flush_event.set()
+        await asyncio.sleep(0.01)
+        await db.stop()
+        self.assertEqual(1, len(inserted))
+        self.assertEqual([], db.message_buffer)
+
+        # rows of a flush cancelled some other way go back to the buffer
+        db.message_buffer = [(1, 'This is another test message', False, datetime.datetime.now())]
+        flush = asyncio.create_task(db.flush())
+        await asyncio.sleep(0.01)
+        flush.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await flush
+        self.assertEqual(1, len(db.message_buffer))
+        self.assertEqual(1, db.write_behind_stats.backlog)
+
+
+class IdentityCacheTest(unittest.TestCase):
+    def test_eviction(self):
+        cache = IdentityCache(max_size=2)
+        cache.put(1, 10)
+        cache.put(2, None)
+        self.assertEqual((True, 10), cache.get(1))
+        cache.put(3, 30)
+        self.assertEqual((False, None), cache.get(2))
+        self.assertEqual((True, 30), cache.get(3))
+        cache.invalidate(3)
+        self.assertEqual((False, None), cache.get(3))
+        self.assertEqual({'size': 1, 'hits': 2, 'misses': 2}, cache.as_dict())
+
+
+class ConversationCacheTest(unittest.TestCase):
+    def test_ring_buffer(self):
+        cache = ConversationCache(max_bytes=20, history_limit=2)
+        self.assertIsNone(cache.get(1))
+        cache.load(1, [('first', True), ('second', False)])
+        cache.append(1, ('third', True))
+        self.assertEqual([('second', False), ('third', True)], cache.get(1))
+        self.assertEqual(11, cache.size)
+
+        cache.append(2, ('ignored until loaded', True))
+        cache.load(2, [('0123456789', True)])
+        self.assertIsNone(cache.get(1))
+        self.assertEqual([('0123456789', True)], cache.get(2))
+        self.assertEqual(10, cache.size)
+
+
+class DeadlineCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.future = datetime.datetime.now() + datetime.timedelta(days=1)
+        self.snapshot = DeadlineSnapshot(
+            [(3, 'Lab 3', datetime.date(2024, 7, 20)), (1, 'Lab 1', datetime.date(2024, 7, 1)),
+             (2, 'Lab 2', datetime.date(2024, 7, 10))],
+            [(7, 1, self.future), (8, 3, datetime.datetime(2024, 7, 19, 8)), (9, 1, self.future - datetime.timedelta(hours=1))])
+
+    def test_snapshot(self):
+        self.assertEqual([(1, 'Lab 1', datetime.date(2024, 7, 1)), (2, 'Lab 2', datetime.date(2024, 7, 10))],
+                         self.snapshot.in_range(datetime.date(2024, 7, 1), datetime.date(2024, 7, 10)))
+        self.assertEqual([], self.snapshot.in_range(datetime.date(2024, 7, 11), datetime.date(2024, 7, 19)))
+        self.assertEqual([2, 3], [deadline[0] for deadline in self.snapshot.by_ids([3, 2])])
+        self.assertTrue(self.snapshot.exists('Lab 2'))
+        # reminders already past are left out, like in fetch_reminders_query_by_deadline_ids
+        self.assertEqual([('Lab 1', [self.future - datetime.timedelta(hours=1), self.future])],
+                         self.snapshot.upcoming_reminders([1, 3]))
+
+    def test_invalidation(self):
+        cache = DeadlineCache()
+        self.assertTrue(cache.load(42, cache.version, self.snapshot))
+        self.assertIs(self.snapshot, cache.owner([1, 2]))
+        self.assertIsNone(cache.owner([1, 4]))
+
+        cache.invalidate_reminder(7)
+        self.assertIsNone(cache.get(42))
+
+        # a write while the snapshot was read keeps it from being installed
+        version = cache.version
+        cache.invalidate_deadlines([5])
+        self.assertFalse(cache.load(42, version, self.snapshot))
+        self.assertTrue(cache.load(42, cache.version, self.snapshot))
+        cache.invalidate_deadlines([2])
+        self.assertIsNone(cache.get(42))
+        self.assertEqual({}, cache.deadline_owners)
+
+    def test_per_user_version(self):
+        cache = DeadlineCache()
+        version = cache.version
+        cache.invalidate(7)
+        self.assertTrue(cache.load(42, version, self.snapshot))
+        # a reminder the snapshot does not know yet is traced to it through its deadline
+        cache.invalidate_reminder(10, 3)
+        self.assertIsNone(cache.get(42))
+        self.assertFalse(cache.load(42, version, self.snapshot))
+
+        # without a known owner every load in flight is failed
+        version = cache.version
+        cache.invalidate_reminder(11, 5)
+        self.assertFalse(cache.load(42, version, self.snapshot))
+        self.assertTrue(cache.load(42, cache.version, self.snapshot))
+
+    def test_eviction(self):
+        cache = DeadlineCache(max_users=1)
+        cache.load(1, cache.version, self.snapshot)
+        cache.load(2, cache.version, DeadlineSnapshot([(4, 'Lab 4', datetime.date(2024, 8, 1))], []))
+        self.assertIsNone(cache.get(1))
+        self.assertEqual({4: 2}, cache.deadline_owners)
+
+
 class DbQueryTest(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -109,31 +395,741 @@ class DbQueryTest(unittest.TestCase):
         self.db.delete_reminder_query(db_reminder[0])
         self.assertIsNone(self.db.fetch_reminder_query(db_deadlines[0][0], new_reminder_datetime))
 
+    def test_reminder_lease(self):
+        self.db.create_deadline_query(self.chat_id, 'Lease Test Submission', datetime.date(2100, 6, 15))
+        deadline_id = self.db.fetch_deadlines_query(self.chat_id)[-1][0]
+        now = datetime.datetime(2100, 6, 14, 9, 0, 0)
+        ids = {self.db.create_reminders_query(deadline_id, now - datetime.timedelta(minutes=minutes)) for minutes in range(5)}
+        future = self.db.create_reminders_query(deadline_id, now + datetime.timedelta(minutes=1))
+        lease = datetime.timedelta(minutes=1)
 
-class GPTQueryTest(unittest.TestCase):
-    @classmethod
-    def setUpClass(cls):
-        cls.gpt = GPT()
+        first = self.db.lease_due_reminders_query(now, 'first', lease, 3)
+        second = self.db.lease_due_reminders_query(now, 'second', lease, 3)
+        self.assertEqual(3, len(first))
+        self.assertEqual(ids, set(first) | set(second))
+        self.assertFalse(set(first) & set(second))
+        self.assertNotIn(future, first + second)
 
-    @classmethod
-    def tearDownClass(cls):
-        del cls.gpt
-
-    def test_intention(self):
-        tests = [
-            ([{'role': 'user', 'content': 'I have a project submission due soon, can you help me create a deadline for that?'}], {'action': Intention.CREATE, 'target': 'deadline'}),
-            ([{'role': 'user', 'content': 'When is my orbital submission due?'}], {'action': Intention.READ, 'target': 'deadline'}),
-            ([{'role': 'user', 'content': 'What deadlines do I have next week?'}], {'action': Intention.READ, 'target': 'deadline'}),
-            ([{'role': 'user', 'content': 'Can you help me change the due date for one of my deadlines?'}], {'action': Intention.UPDATE, 'target': 'deadline'}),
-            ([{'role': 'user', 'content': 'I have completed my submission for my orbital milestone. Can you remove it?'}], {'action': Intention.DELETE, 'target': 'deadline'}),
-            ([{'role': 'user', 'content': 'Can you create a reminder for my submission?'}], {'action': Intention.CREATE, 'target': 'reminder'}),
-            ([{'role': 'user', 'content': 'When is the reminder for my orbital submission?'}], {'action': Intention.READ, 'target': 'reminder'}),
-            ([{'role': 'user', 'content': 'Could you postpone my reminder to next Sunday?'}], {'action': Intention.UPDATE, 'target': 'reminder'}),
-            ([{'role': 'user', 'content': 'I want to remove all of my reminders.'}], {'action': Intention.DELETE, 'target': 'reminder'}),
-        ]
-        for test in tests:
+        # the first instance delivers, the second lets its lease run out and another takes over
+        self.assertEqual(0, self.db.mark_reminders_sent_query(first, 'second', now))
+        self.assertEqual(3, self.db.mark_reminders_sent_query(first, 'first', now))
+        self.assertEqual([], self.db.lease_due_reminders_query(now, 'third', lease, 10))
+        self.assertEqual(set(second), set(self.db.lease_due_reminders_query(now + 2 * lease, 'third', lease, 10)))
+
+        # moving a delivered reminder delivers it again
+        self.db.update_reminder_query(first[0], now + lease)
+        self.assertEqual([first[0]], self.db.lease_due_reminders_query(now + lease, 'first', lease, 10))
+        # moving a reminder while it is being delivered keeps it due at its new time
+        self.db.update_reminder_query(first[0], now + 2 * lease)
+        self.assertEqual(0, self.db.mark_reminders_sent_query([first[0]], 'first', now + lease))
+        self.assertEqual([first[0]], self.db.lease_due_reminders_query(now + 2 * lease, 'third', lease, 10))
+        self.db.delete_deadlines_query([deadline_id])
+
+
+class DeadlineIndexTest(unittest.TestCase):
+    def test_resolve(self):
+        due_date = datetime.date(2024, 7, 10)
+        deadlines = [
+            (1, 'CS2030S Lab 3 Submission', due_date),
+            (2, 'CS2030S Lab 4 Submission', due_date),
+            (3, 'Orbital Milestone Submission', due_date)]
+        index = DeadlineIndex()
+        index.load(1, deadlines)
+
+        self.assertEqual(([3], []), index.resolve(1, 'orbital milestone', deadlines))
+        self.assertEqual(([2], []), index.resolve(1, 'cs2030s lab 4 submission', deadlines))
+        ids, candidates = index.resolve(1, 'CS2030S lab', deadlines)
+        self.assertEqual([], ids)
+        self.assertEqual({1, 2}, {deadline[0] for deadline in candidates[:2]})
+
+        index.update(1, 2, 'Project slides')
+        index.remove(1, [3])
+        index.add(1, 4, 'GEA1000 Quiz')
+        deadlines = [(1, 'CS2030S Lab 3 Submission', due_date), (2, 'Project slides', due_date), (4, 'GEA1000 Quiz', due_date)]
+        self.assertEqual(([1], []), index.resolve(1, 'CS2030S lab', deadlines))
+        self.assertEqual(([4], []), index.resolve(1, 'gea1000 quiz', deadlines))
+        self.assertEqual(([2], []), index.resolve(1, 'project slides', deadlines[1:]))
+        # words the deadline lacks leave the choice to the LLM, however close the n-grams are
+        self.assertEqual([], index.resolve(1, 'slides for project', deadlines[1:])[0])
+
+    def test_near_miss(self):
+        due_date = datetime.date(2024, 7, 10)
+        deadlines = [(1, 'CS2030S Lab 3 Submission', due_date), (2, 'Orbital Milestone Submission', due_date)]
+        index = DeadlineIndex()
+        index.load(1, deadlines)
+
+        for description in ['CS2030S Lab 4 Submission', 'CS2030S Lab 4']:
+            ids, candidates = index.resolve(1, description, deadlines)
+            self.assertEqual([], ids)
+            self.assertEqual(1, candidates[0][0])
+        self.assertEqual(([1], []), index.resolve(1, 'cs2030s  lab 3 submission', deadlines))
+        self.assertEqual(([1], []), index.resolve(1, 'CS2030S Lab 3', deadlines))
+
+    def test_shortlist(self):
+        due_date = datetime.date(2024, 7, 10)
+        deadlines = [(id, f'CS2030S Lab {id} Submission', due_date) for id in range(1, 6)]
+        deadlines.append((6, 'Orbital Milestone Submission', due_date))
+        index = DeadlineIndex(top_k=2)
+        index.load(1, deadlines[:5])
+
+        self.assertEqual(deadlines[:2], index.shortlist(1, 'lab 1', deadlines[:2]))
+        # the deadline the index has not seen yet is always kept
+        shortlist = index.shortlist(1, 'Remove my lab 3 submission please', deadlines)
+        self.assertEqual(3, len(shortlist))
+        self.assertLessEqual({3, 6}, {deadline[0] for deadline in shortlist})
+
+
+class ReminderSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_schedule(self):
+        delivered = []
+
+        async def callback(reminder_ids):
+            delivered.append(reminder_ids)
+
+        scheduler = ReminderScheduler(None, callback)
+        now = datetime.datetime(2100, 6, 14, 8, 0, 0)
+        scheduler.schedule(1, now)
+        scheduler.schedule(2, now - datetime.timedelta(minutes=5))
+        scheduler.schedule(3, now + datetime.timedelta(minutes=1))
+        scheduler.schedule(4, now)
+        scheduler.schedule(4, now + datetime.timedelta(days=1))
+        scheduler.cancel(1)
+
+        self.assertEqual([2], scheduler.pop_due(now))
+        self.assertEqual([3], scheduler.pop_due(now + datetime.timedelta(minutes=1)))
+        self.assertEqual([], scheduler.pop_due(now + datetime.timedelta(hours=1)))
+        self.assertEqual([4], scheduler.pop_due(now + datetime.timedelta(days=1)))
+        self.assertEqual({}, scheduler.times)
+
+
+class LeaseDb:
+    """The leasing queries of AsyncPostgresDb over a dict, yielding to other tasks like a real query."""
+
+    def __init__(self, times: dict[int, datetime.datetime]):
+        self.rows = {id: {'time': time, 'sent_at': None, 'leased_by': None, 'leased_until': None}
+                     for id, time in times.items()}
+
+    async def lease_due_reminders_query(self, now, owner, lease, limit):
+        await asyncio.sleep(0)
+        due = sorted((row['time'], id) for id, row in self.rows.items() if row['sent_at'] is None and row['time'] <= now
+                     and (row['leased_until'] is None or row['leased_until'] < now))
+        leased = [id for _, id in due[:limit]]
+        for id in leased:
+            self.rows[id].update(leased_by=owner, leased_until=now + lease)
+        return leased
+
+    async def renew_reminder_leases_query(self, ids, owner, leased_until):
+        await asyncio.sleep(0)
+        held = [id for id in ids if self.rows[id]['leased_by'] == owner and self.rows[id]['sent_at'] is None]
+        for id in held:
+            self.rows[id]['leased_until'] = leased_until
+        return len(held)
+
+    async def mark_reminders_sent_query(self, ids, owner, sent_at):
+        await asyncio.sleep(0)
+        marked = [id for id in ids if self.rows[id]['leased_by'] == owner and self.rows[id]['sent_at'] is None
+                  and self.rows[id]['leased_until'] is not None]
+        for id in marked:
+            self.rows[id].update(sent_at=sent_at, leased_until=None)
+        return len(marked)
+
+    def update_reminder_query(self, reminder_id, reminder_time):
+        self.rows[reminder_id].update(time=reminder_time, sent_at=None, leased_by=None, leased_until=None)
+
+
+class ReminderLeaseTest(unittest.IsolatedAsyncioTestCase):
+    async def test_deliver(self):
+        now = datetime.datetime(2100, 6, 14, 8, 0, 0)
+        db = LeaseDb({id: now - datetime.timedelta(seconds=id) for id in range(1, 51)})
+        delivered = []
+
+        async def callback(reminder_ids):
+            await asyncio.sleep(0)
+            delivered.extend(reminder_ids)
+            return reminder_ids
+
+        schedulers = [ReminderScheduler(db, callback, batch_size=10) for _ in range(3)]
+        for index, scheduler in enumerate(schedulers):
+            scheduler.owner = f'instance {index}'
+
+        async def drain(scheduler):
+            while await scheduler.deliver(now):
+                pass
+
+        await asyncio.gather(*(drain(scheduler) for scheduler in schedulers))
+        # every reminder went out exactly once, with the batches spread over the instances
+        self.assertEqual(list(range(1, 51)), sorted(delivered))
+        self.assertTrue(all(scheduler.stats.delivered > 0 for scheduler in schedulers))
+        self.assertEqual(50, sum(scheduler.stats.delivered for scheduler in schedulers))
+
+    async def test_retry(self):
+        now = datetime.datetime(2100, 6, 14, 8, 0, 0)
+        db = LeaseDb({1: now, 2: now})
+
+        async def fail(reminder_ids):
+            raise RuntimeError('Telegram is down')
+
+        async def succeed(reminder_ids):
+            return reminder_ids
+
+        crashed = ReminderScheduler(db, fail, lease=60)
+        crashed.owner = 'crashed'
+        self.assertEqual(0, await crashed.deliver(now))
+        self.assertEqual(2, crashed.stats.failed)
+
+        # the leased batch stays with the failed instance until its lease runs out
+        healthy = ReminderScheduler(db, succeed, lease=60)
+        healthy.owner = 'healthy'
+        self.assertEqual(0, await healthy.deliver(now + datetime.timedelta(seconds=30)))
+        self.assertEqual(2, await healthy.deliver(now + datetime.timedelta(seconds=61)))
+        self.assertEqual(2, healthy.stats.delivered)
+
+    async def test_partial(self):
+        now = datetime.datetime(2100, 6, 14, 8, 0, 0)
+        db = LeaseDb({1: now, 2: now})
+
+        async def blocked(reminder_ids):
+            # the chat of reminder 2 could not be reached
+            return [1]
+
+        scheduler = ReminderScheduler(db, blocked, lease=60)
+        self.assertEqual(2, await scheduler.deliver(now))
+        self.assertEqual((1, 1), (scheduler.stats.delivered, scheduler.stats.failed))
+        self.assertIsNotNone(db.rows[1]['sent_at'])
+        self.assertIsNone(db.rows[2]['sent_at'])
+        self.assertEqual([2], await db.lease_due_reminders_query(now + datetime.timedelta(seconds=61), 'other', scheduler.lease, 10))
+
+    async def test_moved_while_sending(self):
+        now = datetime.datetime(2100, 6, 14, 8, 0, 0)
+        db = LeaseDb({1: now})
+
+        async def move(reminder_ids):
+            db.update_reminder_query(1, now + datetime.timedelta(hours=1))
+            return reminder_ids
+
+        scheduler = ReminderScheduler(db, move, lease=60)
+        self.assertEqual(1, await scheduler.deliver(now))
+        self.assertEqual(0, scheduler.stats.delivered)
+        self.assertIsNone(db.rows[1]['sent_at'])
+        self.assertEqual([1], await db.lease_due_reminders_query(now + datetime.timedelta(hours=1), 'other', scheduler.lease, 10))
+
+    async def test_renew(self):
+        db = LeaseDb({1: datetime.datetime.now()})
+        sent = []
+
+        async def slow(reminder_ids):
+            await asyncio.sleep(0.3)
+            sent.extend(reminder_ids)
+            return reminder_ids
+
+        first, second = ReminderScheduler(db, slow, lease=0.15), ReminderScheduler(db, slow, lease=0.15)
+        first.owner, second.owner = 'first', 'second'
+        delivery = asyncio.create_task(first.deliver(datetime.datetime.now()))
+        await asyncio.sleep(0.2)
+        # the first instance is still sending past its original lease, which it has kept renewing
+        self.assertEqual(0, await second.deliver(datetime.datetime.now()))
+        self.assertEqual(1, await delivery)
+        self.assertEqual([1], sent)
+        self.assertEqual(1, first.stats.delivered)
+
+
+class ChatUpdateProcessorTest(unittest.IsolatedAsyncioTestCase):
+    def update(self, update_id: int, chat_id: int) -> Update:
+        return Update.de_json({'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': 0, 'text': 'hi', 'chat': {'id': chat_id, 'type': 'private'}}}, None)
+
+    async def test_order(self):
+        processor = ChatUpdateProcessor(max_concurrency=3)
+        handled = []
+        running = {'now': 0, 'most': 0, 'chats': set()}
+
+        async def handle(update: Update):
+            chat_id = update.effective_chat.id
+            self.assertNotIn(chat_id, running['chats'])
+            running['chats'].add(chat_id)
+            running['now'] += 1
+            running['most'] = max(running['most'], running['now'])
+            await asyncio.sleep(0.01 * (update.update_id % 3))
+            handled.append((chat_id, update.update_id))
+            running['now'] -= 1
+            running['chats'].remove(chat_id)
+
+        updates = [self.update(update_id, update_id % 5) for update_id in range(40)]
+        async with processor:
+            await asyncio.gather(*(processor.process_update(update, handle(update)) for update in updates))
+
+        # every chat's updates ran one at a time in order, chats ran alongside each other up to the cap
+        for chat_id in range(5):
+            self.assertEqual(list(range(chat_id, 40, 5)), [update_id for chat, update_id in handled if chat == chat_id])
+        self.assertEqual(3, running['most'])
+        self.assertEqual({}, processor.queues)
+        self.assertEqual(40, processor.stats.processed)
+        self.assertEqual(0, processor.stats.queued)
+
+    async def test_error(self):
+        processor = ChatUpdateProcessor()
+
+        async def fail():
+            raise RuntimeError('handler failed')
+
+        async def succeed():
+            return None
+
+        async with processor:
+            results = await asyncio.gather(processor.process_update(self.update(1, 1), fail()),
+                                           processor.process_update(self.update(2, 1), succeed()),
+                                           return_exceptions=True)
+        self.assertIsInstance(results[0], RuntimeError)
+        self.assertIsNone(results[1])
+
+    async def test_shutdown(self):
+        processor = ChatUpdateProcessor()
+        started = asyncio.Event()
+
+        async def hang():
+            started.set()
+            await asyncio.sleep(60)
+
+        async with processor:
+            pending = [asyncio.create_task(processor.process_update(self.update(update_id, 1), hang()))
+                       for update_id in range(3)]
+            await started.wait()
+        # shutting down cancels the running update and those queued behind it instead of leaving them waiting
+        results = await asyncio.wait_for(asyncio.gather(*pending, return_exceptions=True), 1)
+        self.assertTrue(all(isinstance(result, asyncio.CancelledError) for result in results))
+        self.assertEqual({}, processor.queues)
+        self.assertEqual(0, processor.stats.queued)
+
+
+class StreamReplyTest(unittest.IsolatedAsyncioTestCase):
+    async def test_stream(self):
+        sent = []
+
+        class Message:
+            async def edit_text(self, text):
+                sent.append(('edit', text, time.perf_counter()))
+
+        async def reply_text(text, **kwargs):
+            sent.append(('reply', text, time.perf_counter()))
+            return Message()
+
+        async def chunks():
+            for word in ['Happy ', 'to ', 'help, ', 'good ', 'luck ', 'with ', 'your ', 'deadlines!']:
+                await asyncio.sleep(0.02)
+                yield word
+
+        update = SimpleNamespace(message=SimpleNamespace(chat_id=1, id=2), effective_message=SimpleNamespace(reply_text=reply_text))
+        context = SimpleNamespace(bot_data={'dispatcher': MessageDispatcher(global_rate=1000, chat_rate=1000)})
+
+        start = time.perf_counter()
+        text = await stream_reply(update, context, chunks(), 0.05)
+        self.assertEqual('Happy to help, good luck with your deadlines!', text)
+        # the first chunk goes out as it arrives, the rest in a few edits spaced by the interval
+        self.assertEqual(('reply', 'Happy '), sent[0][:2])
+        self.assertLess(sent[0][2] - start, 0.05)
+        self.assertEqual(('edit', text), sent[-1][:2])
+        self.assertLess(len(sent), 6)
+        for previous, edit in zip(sent[1:], sent[2:]):
+            self.assertGreaterEqual(edit[2] - previous[2], 0.045)
+
+
+class TranscriberTest(unittest.IsolatedAsyncioTestCase):
+    async def test_idle_unload(self):
+        transcriber = Transcriber(idle_timeout=0.05)
+        # nothing is loaded until a voice message needs it
+        self.assertIsNone(transcriber.model)
+        self.assertEqual(0, transcriber.stats.as_dict()['loaded'])
+
+        transcriber.model = object()
+        transcriber.stats.loaded = True
+        await transcriber.start()
+        try:
+            transcriber.stats.pending = 1
+            await asyncio.sleep(0.1)
+            self.assertIsNotNone(transcriber.model)
+
+            transcriber.stats.pending = 0
+            await asyncio.sleep(0.15)
+            self.assertIsNone(transcriber.model)
+            self.assertEqual(0, transcriber.stats.as_dict()['loaded'])
+        finally:
+            await transcriber.stop()
+            transcriber.close()
+
+    async def test_failed_warm_up(self):
+        transcriber = Transcriber(warm_up=True)
+
+        def load():
+            raise OSError('model not found')
+
+        transcriber.load = load
+        with self.assertLogs('transcriber', 'ERROR'):
+            await transcriber.start()
+            await transcriber.stop()
+        self.assertIsInstance(transcriber.warming.exception(), OSError)
+        transcriber.close()
+
+
+class MessageDispatcherTest(unittest.IsolatedAsyncioTestCase):
+    async def test_retry(self):
+        dispatcher = MessageDispatcher(backoff=0.01)
+        errors = [RetryAfter(0.05), TimedOut()]
+
+        async def send():
+            if errors:
+                raise errors.pop(0)
+            return 'sent'
+
+        start = time.monotonic()
+        self.assertEqual('sent', await dispatcher.send(1, send))
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        self.assertEqual(2, dispatcher.stats.retries)
+        self.assertEqual(1, dispatcher.stats.sent)
+
+    async def test_rate_limit(self):
+        dispatcher = MessageDispatcher(global_rate=100, chat_rate=20)
+        sent = []
+
+        async def send(chat_id):
+            sent.append((chat_id, time.monotonic()))
+
+        await asyncio.gather(*[dispatcher.send(chat_id % 2, lambda chat_id=chat_id: send(chat_id % 2)) for chat_id in range(6)])
+        chat_times = [sent_at for chat_id, sent_at in sent if chat_id == 0]
+        self.assertEqual(6, len(sent))
+        self.assertGreaterEqual(chat_times[-1] - chat_times[0], 0.09)
+        self.assertEqual(0, dispatcher.stats.pending)
+
+
+class MigrationTest(unittest.TestCase):
+    def test_versions(self):
+        versions = [migration[0] for migration in load_migrations()]
+        self.assertEqual(list(range(1, len(versions) + 1)), versions)
+
+
+class MetricsTest(unittest.IsolatedAsyncioTestCase):
+    def test_histogram(self):
+        histogram = Histogram('test_seconds', 'Test durations.', ('stage',), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value, stage='db')
+        self.assertEqual([
+            '# HELP test_seconds Test durations.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{stage="db",le="0.1"} 2',
+            'test_seconds_bucket{stage="db",le="1.0"} 3',
+            'test_seconds_bucket{stage="db",le="+Inf"} 4',
+            'test_seconds_sum{stage="db"} 2.65',
+            'test_seconds_count{stage="db"} 4'
+        ], histogram.render().splitlines())
+
+    def test_trace(self):
+        trace = Trace()
+        token = current_trace.set(trace)
+        with span('db', 'fetch_deadlines_query'):
+            pass
+        with self.assertRaises(ValueError):
+            with span('llm', 'intention'):
+                raise ValueError()
+        current_trace.reset(token)
+        self.assertEqual([('db', 'fetch_deadlines_query'), ('llm', 'intention')], [s[:2] for s in trace.spans])
+
+    async def test_server(self):
+        registry = Registry()
+        registry.register(Histogram('test_seconds', 'Test durations.')).observe(0.2)
+        server = MetricsServer(registry, port=0)
+        await server.start()
+        port = server.server.sockets[0].getsockname()[1]
+        responses = {}
+        for path in ('/metrics', '/'):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+            responses[path] = await reader.read()
+            writer.close()
+        await server.stop()
+
+        self.assertEqual(b'200', responses['/metrics'].split()[1])
+        self.assertIn(b'test_seconds_count 1', responses['/metrics'])
+        self.assertEqual(b'404', responses['/'].split()[1])
+
+    def test_registry(self):
+        parent = Registry()
+        parent.register(Histogram('test_seconds', 'Test durations.')).observe(0.2)
+        registries = [Registry(parent), Registry(parent)]
+        for value, registry in enumerate(registries):
+            registry.register(StatsGauges('test_cache', 'Test cache stats.', lambda value=value: {'hits': value}))
+            with self.assertRaises(ValueError):
+                registry.register(Histogram('test_seconds', 'Test durations.'))
+
+        for value, registry in enumerate(registries):
+            text = registry.render()
+            self.assertEqual(1, text.count('test_seconds_count 1'))
+            self.assertEqual(1, text.count('\ntest_cache_hits '))
+            self.assertIn(f'test_cache_hits {float(value)!r}', text)
+
+
+class PromptRegistryTest(unittest.TestCase):
+    def test_prompts(self):
+        prompts = PromptRegistry(PROMPT_DIR)
+        prompts.validate(PROMPT_PLACEHOLDERS)
+        prompt = prompts.render('filter_deadlines', deadlines='1|CS2030S Lab 3|2024-07-10')
+        self.assertTrue(prompt.endswith('1|CS2030S Lab 3|2024-07-10'))
+        with self.assertRaises(KeyError):
+            prompts.render('create_deadline')
+
+    def test_template(self):
+        self.assertEqual({'now'}, PromptTemplate('test', '{"ok": 100%%} at %(now)s').placeholders)
+        self.assertEqual('{"ok": 100%} at noon', PromptTemplate('test', '{"ok": 100%%} at %(now)s').render(now='noon'))
+        with self.assertRaises(ValueError):
+            PromptTemplate('test', 'Use {now} as 50% of %(now)s')
+
+
+class IntentClassifierTest(unittest.TestCase):
+    def test_examples(self):
+        classifier = IntentClassifier()
+        for messages, intent in INTENTION_EXAMPLES:
+            with self.subTest(messages=messages, intent=intent):
+                self.assertIn(classifier.classify(messages), (None, intent))
+        self.assertEqual({'coverage': 1.0, 'accuracy': 1.0}, IntentClassifier(threshold=0.0).evaluate(INTENTION_EXAMPLES))
+
+    def test_fallback(self):
+        classifier = IntentClassifier()
+        self.assertIsNone(classifier.classify([{'role': 'user', 'content': 'Remind me to do my lab tomorrow'}]))
+        self.assertIsNone(classifier.classify([
+            {'role': 'assistant', 'content': 'Are you sure to delete the following deadlines?'},
+            {'role': 'user', 'content': 'Yes, delete my CS2030S lab deadline'}]))
+        self.assertEqual(
+            {'action': Intention.DELETE, 'target': 'reminder'},
+            classifier.classify([{'role': 'user', 'content': 'delete my CS2030S reminder'}]))
+        self.assertEqual(1, classifier.stats.hits)
+        self.assertEqual(2, classifier.stats.fallbacks)
+
+
+class SerializeDeadlinesTest(unittest.TestCase):
+    def test_compact(self):
+        deadlines = [(2, 'CS2030S  Lab 3\nSubmission', datetime.date(2024, 7, 10)), (1, 'Orbital', datetime.date(2024, 7, 1))]
+        self.assertEqual('1|Orbital|2024-07-01\n2|CS2030S Lab 3 Submission|2024-07-10', serialize_deadlines(deadlines))
+
+    def test_budget(self):
+        today = datetime.date(2024, 7, 10)
+        deadlines = [(id, f'Deadline {id}', today + datetime.timedelta(days=offset))
+                     for id, offset in enumerate([-30, -1, 0, 3, 60, 90], 1)]
+        # each line is 6 estimated tokens, so a budget of 18 keeps the three most relevant
+        self.assertEqual('2|Deadline 2|2024-07-09\n3|Deadline 3|2024-07-10\n4|Deadline 4|2024-07-13\n'
+                         '(3 deadlines further from today left out)',
+                         serialize_deadlines(deadlines, token_budget=18, today=today))
+
+
+class ConversationWindowTest(unittest.TestCase):
+    def test_compact_tables(self):
+        deadlines = [(1, 'CS2030S Lab 3 Submission on Coursemology', datetime.date(2024, 7, 1))]
+        reminders = [('Orbital', [datetime.datetime(2024, 7, 1, 8), datetime.datetime(2024, 7, 2, 9)])]
+        self.assertEqual(
+            'Are you sure to delete the following deadlines:\n'
+            'Deadline|Due Date\nCS2030S Lab 3 Submission on Coursemology|Mon 01 Jul 2024',
+            compact_tables(f'Are you sure to delete the following deadlines:```\n{create_deadline_table(deadlines)}```'))
+        self.assertEqual(
+            'Deadline|Upcoming Reminders\nOrbital|Mon 01 Jul 2024, 08:00; Tue 02 Jul 2024, 09:00',
+            compact_tables(f'```\n{create_reminder_table(reminders)}```'))
+        self.assertEqual('Updated deadline.', compact_tables('Updated deadline.'))
+
+    def test_window(self):
+        messages = [{'role': 'system', 'content': 'x' * 400}] + [
+            {'role': 'user' if i % 2 else 'assistant', 'content': f'message {i:02d}'} for i in range(6)]
+        # the system prompt is not counted, and each message is 3 estimated tokens
+        self.assertEqual(['x' * 400, 'message 03', 'message 04', 'message 05'],
+                         [message['content'] for message in window_messages(messages, 10)])
+        self.assertEqual(['x' * 400, 'message 05'], [message['content'] for message in window_messages(messages, 1)])
+        self.assertEqual(messages, window_messages(messages))
+
+
+class StructuredExtractionTest(unittest.IsolatedAsyncioTestCase):
+    async def test_extraction(self):
+        extraction = StructuredExtraction({
+            'action': Intention.UPDATE,
+            'target': 'deadline',
+            'description': 'CS2030S Lab 3',
+            'new_due_date': '2024-07-12',
+            'ids': [2, 5],
+            'confirmation': False
+        })
+        deadlines = [(2, 'CS2030S Lab 3 Submission', datetime.date(2024, 7, 10))]
+        self.assertEqual({'action': Intention.UPDATE, 'target': 'deadline'}, extraction.intention)
+        self.assertEqual(
+            {'old_deadline_description': 'CS2030S Lab 3'},
+            await extraction.extract_deadline_description_query([]))
+        self.assertEqual({'ids': [2]}, await extraction.filter_deadlines_query(deadlines, 'CS2030S Lab 3'))
+        self.assertEqual(
+            {'new_description': None, 'new_due_date': '2024-07-12', 'confirmation': False},
+            await extraction.extract_update_info_query([]))
+
+
+class ResponseCacheTest(unittest.IsolatedAsyncioTestCase):
+    class CountingGPT:
+        def __init__(self):
+            self.calls = 0
+
+        async def response_query(self, intention, message):
+            self.calls += 1
+            return f'{message} ({self.calls})'
+
+    class SameGPT:
+        async def response_query(self, intention, message):
+            return 'Done, your deadline is updated.'
+
+    async def test_variants(self):
+        gpt = self.CountingGPT()
+        cache = ResponseCache(variants=2)
+        intention = {'action': Intention.UPDATE, 'target': 'deadline'}
+        responses = {await cache.phrase(gpt, intention, 'Updated deadline.') for _ in range(10)}
+        self.assertEqual(2, gpt.calls)
+        self.assertEqual({'Updated deadline. (1)', 'Updated deadline. (2)'}, responses)
+
+        await cache.phrase(gpt, {'action': Intention.UPDATE, 'target': 'reminder'}, 'Updated deadline.')
+        self.assertEqual(3, gpt.calls)
+
+    async def test_same_rephrasing(self):
+        gpt = self.SameGPT()
+        cache = ResponseCache(variants=3)
+        intention = {'action': Intention.UPDATE, 'target': 'deadline'}
+        for _ in range(10):
+            self.assertEqual('Done, your deadline is updated.', await cache.phrase(gpt, intention, 'Updated deadline.'))
+        self.assertEqual(3, cache.stats.misses)
+        self.assertEqual(7, cache.stats.hits)
+
+    async def test_free_form(self):
+        gpt = self.CountingGPT()
+        cache = ResponseCache(variants=1)
+        intention = {'action': Intention.DELETE, 'target': 'deadline'}
+        for calls in range(1, 4):
+            self.assertEqual(f'Deleted 2 deadlines. ({calls})', await cache.phrase(gpt, intention, 'Deleted 2 deadlines.'))
+        self.assertEqual(0, len(cache.entries))
+        self.assertEqual(3, cache.stats.uncached)
+
+    async def test_eviction(self):
+        gpt = self.CountingGPT()
+        cache = ResponseCache(variants=1, max_size=1)
+        intention = {'action': Intention.READ, 'target': 'deadline'}
+        await cache.phrase(gpt, intention, 'No deadlines matched your query.')
+        await cache.phrase(gpt, intention, 'No deadlines in the database.')
+        await cache.phrase(gpt, intention, 'No deadlines matched your query.')
+        self.assertEqual(3, gpt.calls)
+
+        cache = ResponseCache(variants=1, ttl=0)
+        await cache.phrase(gpt, intention, 'No deadlines matched your query.')
+        time.sleep(0.01)
+        await cache.phrase(gpt, intention, 'No deadlines matched your query.')
+        self.assertEqual(5, gpt.calls)
+
+    async def test_template(self):
+        gpt = self.CountingGPT()
+        cache = ResponseCache(mode='template')
+        intention = {'action': Intention.CREATE, 'target': 'reminder'}
+        self.assertIn(
+            await cache.phrase(gpt, intention, 'Cannot create reminder in the past.'),
+            TEMPLATES['Cannot create reminder in the past.'])
+        self.assertEqual('Deleted 2 deadlines.', await cache.phrase(gpt, intention, 'Deleted 2 deadlines.'))
+        self.assertEqual(0, gpt.calls)
+
+
+class CassetteTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'cassette.jsonl.gz')
+
+    async def test_record_replay(self):
+        recorded = [{'role': 'system', 'content': 'The current date and time is 09:15AM on July 01, 2024.'},
+                    {'role': 'user', 'content': 'What deadlines do I have?'}]
+        cassette = Cassette(self.path, mode='record')
+        cassette.record('gpt-4o-mini', recorded, True, '{"action": "READ", "target": "deadline"}', 0.05)
+        cassette.record('gpt-4o-mini', recorded, False, 'Here are your deadlines.', 0.05)
+
+        cassette = Cassette(self.path, inject_latency=True)
+        # recordings still match once the time rendered into the prompt has moved on
+        replayed = [{'role': 'system', 'content': 'The current date and time is 10:40PM on October 18, 2026.'},
+                    {'role': 'user', 'content': 'What deadlines do I have?'}]
+        start = time.perf_counter()
+        self.assertEqual('{"action": "READ", "target": "deadline"}', await cassette.replay('gpt-4o-mini', replayed, True))
+        self.assertGreaterEqual(time.perf_counter() - start, 0.05)
+        self.assertEqual('Here are your deadlines.', await cassette.replay('gpt-4o-mini', replayed, False))
+
+        with self.assertRaises(CassetteMiss):
+            await cassette.replay('gpt-4o-mini', [{'role': 'user', 'content': 'Something else'}], True)
+        self.assertEqual({'mode': 'replay', 'entries': 2, 'hits': 2, 'misses': 1}, cassette.as_dict())
+
+
+class ListQueue(list):
+    put = list.append
+
+
+class WebhookRouterTest(unittest.IsolatedAsyncioTestCase):
+    def test_hash_ring(self):
+        ring = HashRing(4)
+        owners = {chat_id: ring.worker(chat_id) for chat_id in range(10000)}
+        rebuilt = HashRing(4)
+        self.assertEqual(owners, {chat_id: rebuilt.worker(chat_id) for chat_id in range(10000)})
+        for worker in range(4):
+            self.assertGreater(list(owners.values()).count(worker), 1500)
+
+        # a fifth worker only takes chats over, the rest stay where they were
+        grown = HashRing(5)
+        moved = [chat_id for chat_id, worker in owners.items() if grown.worker(chat_id) != worker]
+        self.assertTrue(all(grown.worker(chat_id) == 4 for chat_id in moved))
+        self.assertLess(len(moved), 3000)
+
+    async def post(
+            self, port: int, body: bytes, secret: str = 'secret', path: str = '/telegram', length: Optional[str] = None) -> str:
+        # what Telegram sends to a webhook
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'POST {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n'
+                     f'X-Telegram-Bot-Api-Secret-Token: {secret}\r\nContent-Length: {length or len(body)}\r\n\r\n'.encode() + body)
+        await writer.drain()
+        status = (await reader.read()).decode().split('\r\n')[0]
+        writer.close()
+        return status
+
+    async def test_route(self):
+        queues = [ListQueue() for _ in range(3)]
+        router = WebhookRouter(queues, secret='secret', port=0)
+        await router.start()
+        try:
+            updates = [{'update_id': id, 'message': {'message_id': id, 'date': 0, 'text': f'message {id}',
+                                                     'chat': {'id': chat_id, 'type': 'private'}}}
+                       for id, chat_id in enumerate([11, 12, 13, 11, 14, 12, 11])]
+            updates.append({'update_id': 7, 'callback_query': {'id': '1', 'from': {'id': 13, 'is_bot': False},
+                                                               'message': {'chat': {'id': 13}}}})
+            for update in updates:
+                self.assertEqual('HTTP/1.1 200 OK', await self.post(router.port, json.dumps(update).encode()))
+
+            self.assertEqual('HTTP/1.1 403 Forbidden', await self.post(router.port, b'{}', secret='wrong'))
+            self.assertEqual('HTTP/1.1 404 Not Found', await self.post(router.port, b'{}', path='/other'))
+            self.assertEqual('HTTP/1.1 400 Bad Request', await self.post(router.port, b'not json'))
+            self.assertEqual('HTTP/1.1 400 Bad Request', await self.post(router.port, b'{}', length='two'))
+        finally:
+            await router.stop()
+
+        routed = {}
+        for worker, queue in enumerate(queues):
+            for body in queue:
+                update = json.loads(body)
+                chat_id = (update.get('message') or update['callback_query']['message'])['chat']['id']
+                routed.setdefault(chat_id, []).append((worker, update['update_id']))
+        # every chat went to its own worker, in the order it was sent
+        self.assertEqual({11: [0, 3, 6], 12: [1, 5], 13: [2, 7], 14: [4]},
+                         {chat_id: [id for _, id in sent] for chat_id, sent in routed.items()})
+        for chat_id, sent in routed.items():
+            self.assertEqual({router.ring.worker(chat_id)}, {worker for worker, _ in sent})
+        self.assertEqual(8, router.stats.received)
+        self.assertEqual(4, router.stats.rejected)
+
+
+class GPTQueryTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # with OPENAI_CASSETTE set the queries are replayed offline, or recorded in record mode
+        cassette = getenv('OPENAI_CASSETTE')
+        self.gpt = GPT(cassette=Cassette(cassette, getenv('OPENAI_CASSETTE_MODE', 'replay')) if cassette else None)
+
+    async def test_intention(self):
+        for test in INTENTION_EXAMPLES:
             with self.subTest(messages=test[0], intent=test[1]):
-                self.assertEqual(self.gpt.intention_query(test[0]), test[1])
+                self.assertEqual(await self.gpt.intention_query(test[0]), test[1])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,169 @@
+import asyncio
+import gc
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+
+class TranscriberBusy(Exception):
+    pass
+
+
+class TranscriberStats:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.loaded = False
+        self.loads = 0
+        self.load_seconds = 0.0
+
+    def record_latency(self, latency: float):
+        self.completed += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self) -> dict:
+        return {
+            'queue_depth': max(0, self.pending - self.workers),
+            'running': min(self.pending, self.workers),
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'avg_latency': self.total_latency / self.completed if self.completed else 0.0,
+            'max_latency': self.max_latency,
+            'loaded': int(self.loaded),
+            'loads': self.loads,
+            'load_seconds': self.load_seconds
+        }
+
+
+class Transcriber:
+    """Runs Whisper transcription on a pool of worker threads off the event loop.
+
+    CTranslate2 releases the GIL while decoding, so a single model with one worker per thread
+    transcribes in parallel without the memory cost of a model copy per process.
+
+    faster_whisper is only imported and the model only loaded for the first voice message, or in
+    the background after start() with warm_up, so instances that never get one skip both. With
+    idle_timeout the model is unloaded after that many seconds without a transcription and loaded
+    again on the next. A failed warm up is logged, and the first transcription tries loading again.
+    """
+
+    def __init__(
+            self,
+            model: str = 'small.en',
+            compute_type: str = 'default',
+            workers: int = 0,
+            queue_size: int = 8,
+            warm_up: bool = False,
+            idle_timeout: Optional[float] = None):
+        cpu_count = os.cpu_count() or 1
+        self.model_name = model
+        self.compute_type = compute_type
+        self.workers = workers or max(1, cpu_count // 4)
+        self.cpu_threads = max(1, cpu_count // self.workers)
+        self.queue_size = queue_size
+        self.warm_up = warm_up
+        self.idle_timeout = idle_timeout
+        self.stats = TranscriberStats(self.workers)
+        self.model = None
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.idle_task: Optional[asyncio.Task] = None
+        self.warming: Optional[asyncio.Future] = None
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='whisper')
+
+    async def start(self):
+        if self.warm_up:
+            self.warming = asyncio.get_running_loop().run_in_executor(self.executor, self.load)
+            self.warming.add_done_callback(self.warmed_up)
+        if self.idle_timeout is not None:
+            self.idle_task = asyncio.create_task(self.unload_when_idle())
+
+    def warmed_up(self, future: asyncio.Future):
+        if not future.cancelled() and future.exception():
+            logger.error('Failed to warm up Whisper %s', self.model_name, exc_info=future.exception())
+
+    async def wait_warm_up(self):
+        # without raising, a failed warm up is logged by warmed_up
+        if self.warming and not self.warming.done():
+            await asyncio.wait([self.warming])
+
+    async def stop(self):
+        await self.wait_warm_up()
+        if self.idle_task:
+            self.idle_task.cancel()
+            try:
+                await self.idle_task
+            except asyncio.CancelledError:
+                pass
+
+    def load(self):
+        with self.lock:
+            if self.model is None:
+                start = time.perf_counter()
+                from faster_whisper import WhisperModel
+
+                self.model = WhisperModel(
+                    self.model_name,
+                    device='cpu',
+                    compute_type=self.compute_type,
+                    cpu_threads=self.cpu_threads,
+                    num_workers=self.workers)
+                self.stats.loaded = True
+                self.stats.loads += 1
+                self.stats.load_seconds = time.perf_counter() - start
+                logger.info('Loaded Whisper %s (%s) in %.1fs', self.model_name, self.compute_type, self.stats.load_seconds)
+            self.last_used = time.monotonic()
+            return self.model
+
+    def unload(self):
+        with self.lock:
+            # transcriptions still running hold their own reference and finish on it
+            self.model = None
+            self.stats.loaded = False
+        gc.collect()
+
+    async def unload_when_idle(self):
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            await self.wait_warm_up()
+            if self.model is not None and not self.stats.pending and time.monotonic() - self.last_used >= self.idle_timeout:
+                await asyncio.get_running_loop().run_in_executor(None, self.unload)
+                logger.info('Unloaded Whisper after %.0fs idle', self.idle_timeout)
+
+    def _transcribe(self, filename: str) -> str:
+        segments, _ = self.load().transcribe(filename)
+        # segments is a lazy generator, so decoding happens while joining
+        return ''.join(map(lambda x: x.text, segments)).strip()
+
+    async def transcribe(self, filename: str) -> str:
+        # jobs beyond the busy workers wait in the executor queue, which is capped at queue_size
+        if self.stats.pending >= self.workers + self.queue_size:
+            self.stats.rejected += 1
+            raise TranscriberBusy()
+
+        start = time.perf_counter()
+        self.stats.pending += 1
+        try:
+            await self.wait_warm_up()
+            with span('whisper', 'transcribe'):
+                speech = await asyncio.get_running_loop().run_in_executor(self.executor, self._transcribe, filename)
+        finally:
+            self.stats.pending -= 1
+        self.last_used = time.monotonic()
+        self.stats.record_latency(time.perf_counter() - start)
+        return speech
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,106 @@
+import asyncio
+import contextvars
+import inspect
+from collections import deque
+from typing import Any, Awaitable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class UpdateProcessorStats:
+    def __init__(self):
+        self.processed = 0
+        self.running = 0
+        self.queued = 0
+        self.max_queue_depth = 0
+
+    def as_dict(self) -> dict:
+        return {'processed': self.processed, 'running': self.running, 'queued': self.queued,
+                'max_queue_depth': self.max_queue_depth}
+
+
+def chat_key(update: object) -> Optional[int]:
+    if isinstance(update, Update):
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+    return None
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """Processes the updates of different chats concurrently and the updates of one chat in order.
+
+    Every chat with updates in flight gets a queue drained by its own task, one update at a time,
+    while at most max_concurrency updates run across all chats. A chat's queue and task are dropped
+    as soon as it drains, so only chats with something pending hold any state. max_pending bounds
+    the updates accepted but not finished, past which the application stops fetching new ones.
+    Updates that belong to no chat run without any ordering. Each update runs in the context it
+    was handed over in rather than that of the chat's task, so context variables stay per update.
+    """
+
+    def __init__(self, max_concurrency: int = 16, max_pending: int = 1024):
+        super().__init__(max_pending)
+        self.running = asyncio.Semaphore(max_concurrency)
+        self.queues: dict[int, deque[tuple[Awaitable[Any], asyncio.Future, contextvars.Context]]] = {}
+        self.tasks: set[asyncio.Task] = set()
+        self.stats = UpdateProcessorStats()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def run(self, coroutine: Awaitable[Any]):
+        async with self.running:
+            self.stats.running += 1
+            try:
+                await coroutine
+            finally:
+                self.stats.running -= 1
+                self.stats.processed += 1
+
+    async def drain(self, key: int, queue: deque):
+        try:
+            while queue:
+                coroutine, done, context = queue[0]
+                try:
+                    await context.run(asyncio.create_task, self.run(coroutine))
+                    if not done.done():
+                        done.set_result(None)
+                except Exception as e:
+                    if not done.done():
+                        done.set_exception(e)
+                queue.popleft()
+                self.stats.queued -= 1
+        finally:
+            # when cancelled at shutdown, the update running and those still queued are cancelled with it
+            while queue:
+                coroutine, done, _ = queue.popleft()
+                self.stats.queued -= 1
+                if inspect.iscoroutine(coroutine) and inspect.getcoroutinestate(coroutine) == inspect.CORO_CREATED:
+                    coroutine.close()
+                done.cancel()
+            del self.queues[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        key = chat_key(update)
+        if key is None:
+            await self.run(coroutine)
+            return
+
+        done = asyncio.get_running_loop().create_future()
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = deque()
+            task = asyncio.create_task(self.drain(key, queue))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        queue.append((coroutine, done, contextvars.copy_context()))
+        self.stats.queued += 1
+        self.stats.max_queue_depth = max(self.stats.max_queue_depth, len(queue))
+        await done
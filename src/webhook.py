@@ -0,0 +1,202 @@
+import asyncio
+import bisect
+import hashlib
+import hmac
+import json
+import logging
+import multiprocessing
+import signal
+import sys
+from typing import Optional, Protocol
+from urllib.parse import urlparse
+
+from telegram import Bot, Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+MAX_BODY_BYTES = 1024 * 1024
+
+
+class UpdateQueue(Protocol):
+    def put(self, item: Optional[bytes]): ...
+
+
+def hash_key(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hashing of chat ids onto workers.
+
+    Every worker is placed on the ring at replicas points, and a chat belongs to the first point at
+    or after its own hash. The same chat always lands on the same worker, and adding or removing a
+    worker only moves the chats of the points that changed hands.
+    """
+
+    def __init__(self, workers: int, replicas: int = 100):
+        self.points: list[tuple[int, int]] = sorted(
+            (hash_key(f'{worker}:{replica}'), worker) for worker in range(workers) for replica in range(replicas))
+        self.hashes = [point for point, _ in self.points]
+
+    def worker(self, chat_id: int) -> int:
+        index = bisect.bisect_left(self.hashes, hash_key(str(chat_id))) % len(self.points)
+        return self.points[index][1]
+
+
+def update_chat_id(update: dict) -> Optional[int]:
+    """The chat an update belongs to, or the user for updates without a chat such as inline queries."""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        for entity in (value, value.get('message') or {}):
+            if isinstance(entity.get('chat'), dict) and 'id' in entity['chat']:
+                return entity['chat']['id']
+        if isinstance(value.get('from'), dict) and 'id' in value['from']:
+            return value['from']['id']
+    return None
+
+
+class WebhookStats:
+    def __init__(self):
+        self.received = 0
+        self.rejected = 0
+        self.routed: dict[int, int] = {}
+
+    def as_dict(self) -> dict:
+        return {'received': self.received, 'rejected': self.rejected, **{
+            f'worker_{worker}': count for worker, count in sorted(self.routed.items())}}
+
+
+class WebhookRouter:
+    """Accepts Telegram webhook posts and hands each update to the worker that owns its chat.
+
+    Updates are put on the worker's queue as the raw json and acknowledged straight away, so a
+    slow worker never holds up Telegram's delivery to the others. Posts to any other path, or
+    without the secret token Telegram was given in setWebhook, are refused.
+    """
+
+    def __init__(
+            self,
+            queues: list[UpdateQueue],
+            path: str = '/telegram',
+            secret: Optional[str] = None,
+            host: str = '127.0.0.1',
+            port: int = 8443,
+            replicas: int = 100):
+        self.queues = queues
+        self.ring = HashRing(len(queues), replicas)
+        self.path = path
+        self.secret = secret
+        self.host = host
+        self.port = port
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.stats = WebhookStats()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        if not self.port:
+            self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def route(self, body: bytes) -> int:
+        update = json.loads(body)
+        if not isinstance(update, dict):
+            raise ValueError('Update is not an object')
+        chat_id = update_chat_id(update)
+        worker = self.ring.worker(chat_id if chat_id is not None else update.get('update_id', 0))
+        self.queues[worker].put(body)
+        self.stats.routed[worker] = self.stats.routed.get(worker, 0) + 1
+        return worker
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            length = headers.get('content-length', '0')
+
+            if len(request) < 2 or request[0] != 'POST' or request[1].split('?')[0] != self.path:
+                status = '404 Not Found'
+            elif self.secret and not hmac.compare_digest(headers.get(SECRET_HEADER, ''), self.secret):
+                status = '403 Forbidden'
+            elif not length.isdigit():
+                status = '400 Bad Request'
+            elif int(length) > MAX_BODY_BYTES:
+                status = '413 Payload Too Large'
+            else:
+                try:
+                    self.route(await reader.readexactly(int(length)))
+                    status = '200 OK'
+                except ValueError:
+                    status = '400 Bad Request'
+
+            if status == '200 OK':
+                self.stats.received += 1
+            else:
+                self.stats.rejected += 1
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'.encode())
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def run_worker(worker: int, workers: int, queue: multiprocessing.Queue):
+    # the router stops the workers through their queues once it has stopped taking updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # imported here so the router process does not load the bot, its models and its connections
+    from telebot import Telebot
+
+    Telebot(worker=worker, workers=workers).serve(queue)
+
+
+async def serve_router(router: WebhookRouter, url: Optional[str] = None, token: Optional[str] = None):
+    stopped = asyncio.Event()
+    if sys.platform != 'win32':
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(signum, stopped.set)
+    await router.start()
+    if url:
+        async with Bot(token) as bot:
+            await bot.set_webhook(url, secret_token=router.secret, allowed_updates=Update.ALL_TYPES)
+    logger.info('Routing webhook updates on %s:%s%s to %s workers',
+                router.host, router.port, router.path, len(router.queues))
+    try:
+        await stopped.wait()
+    finally:
+        await router.stop()
+
+
+def run_webhook(
+        workers: int,
+        url: Optional[str] = None,
+        token: Optional[str] = None,
+        secret: Optional[str] = None,
+        host: str = '127.0.0.1',
+        port: int = 8443):
+    """Starts the worker processes, points Telegram at url and routes its updates until interrupted."""
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(workers)]
+    processes = [context.Process(target=run_worker, args=(worker, workers, queue), name=f'telebot-worker-{worker}')
+                 for worker, queue in enumerate(queues)]
+    for process in processes:
+        process.start()
+
+    router = WebhookRouter(queues, (urlparse(url).path or '/') if url else '/telegram', secret, host, port)
+    try:
+        asyncio.run(serve_router(router, url, token))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join()